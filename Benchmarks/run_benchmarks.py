@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""
+Performance benchmarks of the hot paths: tokenization, encoding, decoding,
+IC50 scoring, RDKit descriptors and fingerprints, and one GA generation,
+each at several batch sizes, so that a change that slows them down shows
+up before it reaches a long optimization run.
+
+    python -m Benchmarks.run_benchmarks --out results.json
+    python -m Benchmarks.run_benchmarks --baseline Benchmarks/baseline.json
+    python -m Benchmarks.run_benchmarks --only encode_vae decode_vae --batch-sizes 1 64
+
+Everything is synthetic: SMILE_VAE, SMILE_IMPLICIT_VAE, Transformer,
+IC50_MCA and CHAR_TCN are built with their notebook hyper-parameters and
+random weights over a vocabulary of SMILES characters, and the molecules
+are random joins of drug-like fragments, so no checkpoint or dataset is
+needed and the run is the same on any machine. GPUs are hidden, the numbers
+are CPU numbers.
+
+Each benchmark is timed <repeat> times after a warm up call (which also
+traces the tf.functions); the JSON holds per benchmark and batch size the
+median and fastest time and the items per second of the median. With
+--baseline, every result is compared with the stored one and the ratios
+above --threshold are reported as regressions (exit status 1).
+Benchmarks/baseline.json holds the default run on the reference machine
+(its 'environment'); on other hardware write a local baseline with --out
+first and compare against that.
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+
+import numpy as np
+
+DEFAULT_BATCH_SIZES = (1, 32, 256)
+LATENT_DIM = 64
+PAD_SIZE = 160
+## Characters of the synthetic vocabulary, Br and Cl written as R and L
+CHARACTERS = 'CNOSPFILRcnos()[]=#@+-123456789H/\\'
+FRAGMENTS = ('C', 'CC', 'CCC', 'N', 'O', 'C(=O)', 'C(=O)O', 'C(=O)N', 'c1ccccc1', 'c1ccncc1',
+             'C1CCCCC1', 'C1CCNCC1', 'S(=O)(=O)C', 'OC', 'N(C)C')
+## Only as the last fragment
+TERMINAL = ('F', 'Cl', 'Br', 'C#N')
+
+def synthetic_vocab():
+  """
+  (vocab, vocab_index) over CHARACTERS with the special tokens first.
+  """
+  tokens = ['<PAD>', '<BOS>', '<EOS>'] + list(CHARACTERS)
+  vocab = {t: i for i, t in enumerate(tokens)}
+  return vocab, {i: t for t, i in vocab.items()}
+
+def synthetic_smiles(num, rng, max_fragments=6):
+  """
+  Valid SMILES made of 2 to max_fragments fragments and an optional
+  terminal group.
+  """
+  out = []
+  for _ in range(num):
+    n = rng.randint(2, max_fragments + 1)
+    parts = [FRAGMENTS[i] for i in rng.randint(len(FRAGMENTS), size=n)]
+    if rng.uniform() < 0.3:
+      parts.append(TERMINAL[rng.randint(len(TERMINAL))])
+    out.append(''.join(parts))
+  return out
+
+def timeit(fn, repeat=5, warmup=1):
+  for _ in range(warmup):
+    fn()
+  times = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    fn()
+    times.append(time.perf_counter() - start)
+  return times
+
+class Context(object):
+  """
+  The synthetic models and data, built on first use and shared by the
+  benchmarks.
+  """
+  def __init__(self, seed=0):
+    self.rng = np.random.RandomState(seed)
+    self.vocab, self.vocab_index = synthetic_vocab()
+    self.smiles = synthetic_smiles(4096, self.rng)
+    self._cache = {}
+
+  def _get(self, name, build):
+    if name not in self._cache:
+      self._cache[name] = build()
+    return self._cache[name]
+
+  def model(self, family):
+    """
+    Random weights LatentModel: 'vae', 'implicit' or 'transformer' (VAE
+    encoder, Transformer decoder), all with the IC50_MCA predictor.
+    """
+    def build():
+      import tensorflow as tf
+      import models.registry as registry
+      from Utils.latent_model import LatentModel
+      tf.random.set_seed(0)
+      vocab_size = len(self.vocab)
+      vae = registry.build('smiles', 'implicit' if family == 'implicit' else 'vae', vocab_size)
+      decoder = registry.build('smiles', 'transformer', vocab_size) if family == 'transformer' else None
+      return LatentModel(vae, self.vocab, self.vocab_index, 'smiles', PAD_SIZE, decoder=decoder,
+                         predictor=self.predictor(), implicit=family == 'implicit')
+    return self._get('model_' + family, build)
+
+  def predictor(self):
+    def build():
+      import models.registry as registry
+      return registry.build('smiles', 'ic50mca', len(self.vocab))
+    return self._get('predictor', build)
+
+  def char_tcn(self):
+    def build():
+      from models.autoencoders.char_tcn import CHAR_TCN
+      model = CHAR_TCN(len(self.vocab), [192, 192, 192], kernel_size=3, dropout=0.2,
+                       embedding_dim=192, max_length=PAD_SIZE - 1, pad_index=0)
+      model(np.ones((1, PAD_SIZE - 1), dtype=np.int32), training=False)
+      return model
+    return self._get('char_tcn', build)
+
+  def tokens(self, n):
+    import Utils.tokenization as tokenization
+    return tokenization.encode_batch(self.smiles[:n], self.vocab, PAD_SIZE, 'smiles')[0]
+
+  def latents(self, n):
+    return self.rng.normal(size=(n, LATENT_DIM)).astype(np.float32)
+
+  def genes(self, n):
+    from Utils.latent_model import NUM_GENES
+    return self.rng.normal(size=(n, NUM_GENES)).astype(np.float32)
+
+## Benchmarks: (context, batch size) -> function timed
+
+def bench_tokenize(ctx, n):
+  import Utils.tokenization as tokenization
+  smiles = ctx.smiles[:n]
+  return lambda: tokenization.encode_batch(smiles, ctx.vocab, PAD_SIZE, 'smiles')
+
+def bench_encode_vae(ctx, n):
+  model, X = ctx.model('vae'), ctx.tokens(n)
+  return lambda: model.encode_tokens(X)
+
+def bench_encode_implicit(ctx, n):
+  model, X = ctx.model('implicit'), ctx.tokens(n)
+  return lambda: model.encode_tokens(X)
+
+def bench_decode_vae(ctx, n):
+  model, Z = ctx.model('vae'), ctx.latents(n)
+  return lambda: model.decode(Z)
+
+def bench_decode_transformer(ctx, n):
+  model, Z = ctx.model('transformer'), ctx.latents(n)
+  return lambda: model.decode(Z)
+
+def bench_char_tcn(ctx, n):
+  model, X = ctx.char_tcn(), ctx.tokens(n)[:, :PAD_SIZE - 1]
+  return lambda: model(X, training=False)
+
+def bench_ic50(ctx, n):
+  model, Z, genes = ctx.model('vae'), ctx.latents(n), ctx.genes(1)
+  return lambda: model.predict(Z, genes)
+
+def bench_ic50_panel(ctx, n):
+  ## Eight cell lines per latent, as ic50_panel_objective
+  model, Z, genes = ctx.model('vae'), ctx.latents(n), ctx.genes(8)
+  return lambda: model.predict(Z, genes, average=False)
+
+def bench_descriptors(ctx, n):
+  import Evaluations.metrics as metrics
+  smiles = ctx.smiles[:n]
+  return lambda: metrics.parse(smiles)
+
+def bench_fingerprints(ctx, n):
+  import Utils.fingerprints as fingerprints
+  smiles = ctx.smiles[:n]
+  return lambda: fingerprints.morgan_fingerprints(smiles)
+
+def bench_ga_generation(ctx, n):
+  ## A population of n, n children, 8 decodes per member and child
+  import Optimizations.genetic as genetic
+  model = ctx.model('vae')
+  objective = genetic.ic50_objective(model, ctx.genes(1))
+  def optimizer():
+    return genetic.GeneticOptimizer(model, objective, num_out=n, num_children=n,
+                                    decode_attempts=8, verbose=False, seed=0)
+  population = optimizer().initial_population(ctx.smiles[:n])
+  def generation():
+    ## A fresh optimizer every call, so that no call dedups against the
+    ## molecules of the previous ones
+    ga = optimizer()
+    ga.seen.update(population.smiles)
+    return ga.step(population)
+  return generation
+
+BENCHMARKS = (('tokenize', bench_tokenize),
+              ('encode_vae', bench_encode_vae),
+              ('encode_implicit', bench_encode_implicit),
+              ('decode_vae', bench_decode_vae),
+              ('decode_transformer', bench_decode_transformer),
+              ('char_tcn', bench_char_tcn),
+              ('ic50', bench_ic50),
+              ('ic50_panel', bench_ic50_panel),
+              ('descriptors', bench_descriptors),
+              ('fingerprints', bench_fingerprints),
+              ('ga_generation', bench_ga_generation))
+
+def environment():
+  import tensorflow as tf
+  return {'python': platform.python_version(), 'platform': platform.platform(),
+          'processor': platform.processor(), 'cpu_count': os.cpu_count(),
+          'numpy': np.__version__, 'tensorflow': tf.__version__,
+          'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+def run(names=None, batch_sizes=DEFAULT_BATCH_SIZES, repeat=5, seed=0, verbose=True):
+  """
+  :return: {'environment': ..., 'results': {name: {batch size: timings}}}
+  """
+  ctx = Context(seed)
+  results = {}
+  for name, bench in BENCHMARKS:
+    if names and name not in names:
+      continue
+    results[name] = {}
+    for n in batch_sizes:
+      times = np.array(timeit(bench(ctx, n), repeat))
+      median = float(np.median(times))
+      results[name][str(n)] = {'median': median, 'min': float(times.min()),
+                               'items_per_sec': n/median}
+      if verbose:
+        print(name + ", Batch = " + str(n) + ", Median = " + "{:.4f}".format(median) + \
+              "s, Items/sec = " + "{:.1f}".format(n/median))
+  return {'environment': environment(), 'results': results}
+
+def compare(current, baseline, threshold=1.2):
+  """
+  Ratios of the current median times to the baseline ones.
+  :return: List of (name, batch size, ratio) above threshold.
+  """
+  regressions = []
+  print("{:<20} {:>6} {:>10} {:>10} {:>7}".format('benchmark', 'batch', 'baseline', 'current',
+                                                  'ratio'))
+  for name, sizes in current['results'].items():
+    for n, timing in sizes.items():
+      old = baseline['results'].get(name, {}).get(n)
+      if old is None:
+        continue
+      ratio = timing['median']/old['median']
+      flag = ' <' if ratio > threshold else ''
+      print("{:<20} {:>6} {:>10.4f} {:>10.4f} {:>7.2f}{}".format(name, n, old['median'],
+                                                                  timing['median'], ratio, flag))
+      if ratio > threshold:
+        regressions.append((name, int(n), ratio))
+  return regressions
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='CPU benchmarks of the model, tokenization and '
+                                               'chemistry hot paths.')
+  parser.add_argument('--out', default=None, help='JSON file for the results')
+  parser.add_argument('--baseline', default=None, help='JSON results to compare with')
+  parser.add_argument('--threshold', type=float, default=1.2,
+                      help='Slowdown ratio reported as a regression')
+  parser.add_argument('--only', nargs='*', default=None, choices=[n for n, _ in BENCHMARKS])
+  parser.add_argument('--batch-sizes', nargs='*', type=int, default=list(DEFAULT_BATCH_SIZES))
+  parser.add_argument('--repeat', type=int, default=5)
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args(argv)
+
+  results = run(args.only, args.batch_sizes, args.repeat, args.seed)
+  if args.out:
+    with open(args.out, 'w') as f:
+      json.dump(results, f, indent=2)
+  if args.baseline:
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+      print(str(len(regressions)) + " regressions above " + str(args.threshold) + "x")
+      return 1
+  return 0
+
+if __name__ == '__main__':
+  ## CPU only, before TensorFlow is imported; the models are tf.keras 2
+  ## models
+  os.environ.setdefault('CUDA_VISIBLE_DEVICES', '-1')
+  os.environ.setdefault('TF_USE_LEGACY_KERAS', '1')
+  sys.exit(main())
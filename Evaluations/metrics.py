@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+GuacaMol style distribution metrics (validity, uniqueness, novelty and the
+KL divergence benchmark) in one pass over RDKit, in place of running
+ValidityBenchmark, UniquenessBenchmark, NoveltyBenchmark and KLDivBenchmark
+on a MockGenerator one after another, each of them parsing every molecule
+again.
+
+parse() sends the generated SMILES to a pool of worker processes, which
+parse each molecule once and return from that one Mol its canonical SMILES,
+a 64 bit hash of it, the physchem descriptors of the KL benchmark and its
+ECFP4 fingerprint. All the metrics are then computed in NumPy from the
+parsed columns:
+  validity    share of the generated SMILES RDKit accepts
+  uniqueness  share of the valid ones that are distinct molecules
+  novelty     share of the distinct ones not in the training set
+  kl_score    mean over the descriptors of exp(-KL(training || generated))
+Novelty is checked against a TrainingIndex: the sorted hashes of the
+canonical training SMILES (8 bytes per molecule, membership by binary
+search), saved with the descriptors of a training sample so the training
+set is parsed once, not at every evaluation.
+"""
+
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import Utils.fingerprints as fingerprints
+
+## Descriptors of GuacaMol's KLDivBenchmark, RDKit Descriptors names
+DESCRIPTORS = ('BertzCT', 'MolLogP', 'MolWt', 'TPSA', 'NumHAcceptors', 'NumHDonors',
+               'NumRotatableBonds', 'NumAliphaticRings', 'NumAromaticRings')
+## Compared through Gaussian KDEs, the others through histograms
+CONTINUOUS = ('BertzCT', 'MolLogP', 'MolWt', 'TPSA', 'internal_similarity')
+## ECFP4, as in GuacaMol's internal similarity
+RADIUS = 2
+N_BITS = 4096
+
+def smiles_hash(smiles):
+  """
+  Stable 64 bit hash of a (canonical) SMILES; Python's hash() differs
+  between processes.
+  """
+  return np.uint64(int.from_bytes(hashlib.blake2b(smiles.encode(), digest_size=8).digest(),
+                                  'little'))
+
+def _quiet_worker():
+  ## Worker processes only: the parse errors of invalid samples would flood
+  ## the output, but the caller's own RDKit logging is left alone
+  from rdkit import RDLogger
+  RDLogger.DisableLog('rdApp.*')
+
+def _parse(smiles, features, radius, n_bits):
+  ## One MolFromSmiles per molecule, in the worker processes or in process
+  import rdkit.Chem as rkc
+  from rdkit.Chem import Descriptors
+  functions = [getattr(Descriptors, name) for name in DESCRIPTORS]
+  n = len(smiles)
+  features = np.broadcast_to(np.asarray(features, dtype=bool), (n,))
+  canonical = [None]*n
+  hashes = np.zeros(n, dtype=np.uint64)
+  descriptors = np.full((n, len(DESCRIPTORS)), np.nan)
+  fps = np.zeros((n, n_bits//64), dtype=np.uint64)
+  generator = fingerprints.morgan_generator(radius, n_bits)
+  for i, s in enumerate(smiles):
+    try:
+      mol = rkc.MolFromSmiles(s) if s else None
+    except Exception:
+      mol = None
+    if mol is None:
+      continue
+    canonical[i] = rkc.MolToSmiles(mol)
+    hashes[i] = smiles_hash(canonical[i])
+    if features[i]:
+      descriptors[i] = [f(mol) for f in functions]
+      fps[i] = fingerprints.pack_morgan(mol, radius, n_bits, generator)
+  return canonical, hashes, descriptors, fps
+
+class ParsedSet(object):
+  """
+  Columns of a parsed list of SMILES, row for row.
+  :ivar smiles: Canonical SMILES, None where RDKit failed.
+  :ivar valid: Boolean [N].
+  :ivar hashes: uint64 [N] of the canonical SMILES, 0 for invalid rows.
+  :ivar descriptors: float64 [N, len(DESCRIPTORS)], NaN where not computed.
+  :ivar fps: Packed ECFP4 uint64 [N, N_BITS / 64], 0 where not computed.
+  """
+  def __init__(self, smiles, hashes, descriptors, fps):
+    self.smiles = smiles
+    self.valid = np.array([s is not None for s in smiles], dtype=bool)
+    self.hashes = hashes
+    self.descriptors = descriptors
+    self.fps = fps
+
+  def __len__(self):
+    return len(self.smiles)
+
+  def unique(self):
+    """
+    Rows of the first occurrence of every valid molecule.
+    """
+    rows = np.flatnonzero(self.valid)
+    _, first = np.unique(self.hashes[rows], return_index=True)
+    return rows[np.sort(first)]
+
+def parse(smiles, features=True, num_workers=None, chunk_size=5000,
+          radius=RADIUS, n_bits=N_BITS):
+  """
+  Parses SMILES once each.
+  :param features: Whether to compute descriptors and fingerprints, or a
+                   boolean mask of the rows to compute them for.
+  :param num_workers: Processes (None: in process).
+  """
+  smiles = list(smiles)
+  features = np.broadcast_to(np.asarray(features, dtype=bool), (len(smiles),))
+  bounds = [(i, i + chunk_size) for i in range(0, len(smiles), chunk_size)]
+  args = ([smiles[a:b] for a, b in bounds], [features[a:b] for a, b in bounds],
+          [radius]*len(bounds), [n_bits]*len(bounds))
+  if num_workers and len(bounds) > 1:
+    with ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_quiet_worker) as pool:
+      results = list(pool.map(_parse, *args))
+  else:
+    results = list(map(_parse, *args))
+  if not results:
+    results = [_parse([], features, radius, n_bits)]
+  return ParsedSet([s for r in results for s in r[0]],
+                   np.concatenate([r[1] for r in results]),
+                   np.concatenate([r[2] for r in results]),
+                   np.concatenate([r[3] for r in results]))
+
+def internal_similarity(fps, chunk_size=1024):
+  """
+  Tanimoto similarity of every fingerprint to its nearest other one in the
+  set, without the full [N, N] matrix.
+  """
+  fps = np.asarray(fps, dtype=np.uint64)
+  counts = fingerprints.bit_counts(fps)
+  fps_t = np.ascontiguousarray(fps.T)
+  out = np.zeros(len(fps), dtype=np.float32)
+  for start in range(0, len(fps), chunk_size):
+    sims = fingerprints._tanimoto_t(fps[start:start + chunk_size], fps_t,
+                                    counts[start:start + chunk_size], counts)
+    rows = np.arange(len(sims))
+    sims[rows, rows + start] = 0.0
+    out[start:start + len(sims)] = sims.max(axis=1) if len(fps) > 1 else 0.0
+  return out
+
+def kl_features(parsed, rows):
+  """
+  Descriptor matrix of the KL benchmark for <rows> of a ParsedSet, with the
+  internal similarity as last column.
+  """
+  return np.concatenate([parsed.descriptors[rows],
+                         internal_similarity(parsed.fps[rows])[:, None]], axis=1)
+
+def gaussian_kde(samples, points, chunk_size=1024):
+  """
+  Gaussian kernel density of 1-D <samples> at <points>, with Scott's
+  bandwidth as scipy.stats.gaussian_kde.
+  """
+  samples = np.asarray(samples, dtype=np.float64)
+  std = samples.std(ddof=1) if len(samples) > 1 else 0.0
+  bandwidth = max(std*len(samples)**(-1./5), 1e-12)
+  density = np.zeros(len(points))
+  for i in range(0, len(samples), chunk_size):
+    u = (points[:, None] - samples[None, i:i + chunk_size])/bandwidth
+    density += np.exp(-0.5*u**2).sum(axis=1)
+  return density/(len(samples)*bandwidth*np.sqrt(2*np.pi))
+
+def _entropy(P, Q):
+  P, Q = P/P.sum(), Q/Q.sum()
+  return float(np.sum(P*np.log(P/Q)))
+
+def continuous_kl(reference, generated, num_points=1000):
+  values = np.concatenate([reference, generated])
+  points = np.linspace(values.min(), values.max(), num_points)
+  return _entropy(gaussian_kde(reference, points) + 1e-10, gaussian_kde(generated, points) + 1e-10)
+
+def discrete_kl(reference, generated, bins=10):
+  ## Both histograms on the bin edges of the reference, as GuacaMol
+  P, edges = np.histogram(reference, bins=bins, density=True)
+  Q = np.histogram(generated, bins=edges, density=True)[0]
+  return _entropy(P + 1e-10, Q + 1e-10)
+
+def kl_divergence(reference, generated):
+  """
+  GuacaMol KL divergence score of two kl_features matrices.
+  :return: (score in [0, 1], dict of the KL divergence per descriptor)
+  """
+  kls = {}
+  for j, name in enumerate(DESCRIPTORS + ('internal_similarity',)):
+    kl = continuous_kl if name in CONTINUOUS else discrete_kl
+    kls[name] = kl(reference[:, j], generated[:, j])
+  return float(np.mean(np.exp(-np.array(list(kls.values()))))), kls
+
+class TrainingIndex(object):
+  """
+  Hashed canonical training set, and the KL features of a sample of it.
+  Build one with TrainingIndex.build.
+  :param hashes: Sorted unique uint64 hashes of the canonical SMILES.
+  :param reference: kl_features of the training sample.
+  """
+  def __init__(self, hashes, reference=None):
+    self.hashes = np.asarray(hashes, dtype=np.uint64)
+    self.reference = reference
+
+  def __len__(self):
+    return len(self.hashes)
+
+  @classmethod
+  def build(cls, smiles, kl_samples=10000, num_workers=None, seed=None):
+    """
+    Parses the training SMILES once; descriptors are only computed for the
+    <kl_samples> sampled as KL reference.
+    """
+    smiles = list(smiles)
+    rng = np.random.RandomState(seed)
+    sample = np.zeros(len(smiles), dtype=bool)
+    sample[rng.choice(len(smiles), size=min(kl_samples, len(smiles)), replace=False)] = True
+    parsed = parse(smiles, features=sample, num_workers=num_workers)
+    rows = np.flatnonzero(sample & parsed.valid)
+    return cls(np.unique(parsed.hashes[parsed.valid]), kl_features(parsed, rows))
+
+  def contains(self, hashes):
+    """
+    Boolean mask of the hashes found in the training set.
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    if not len(self.hashes):
+      return np.zeros(len(hashes), dtype=bool)
+    pos = np.minimum(np.searchsorted(self.hashes, hashes), len(self.hashes) - 1)
+    return self.hashes[pos] == hashes
+
+  def save(self, path):
+    arrays = {'hashes': self.hashes}
+    if self.reference is not None:
+      arrays['reference'] = self.reference
+    np.savez(path, **arrays)
+
+  @classmethod
+  def load(cls, path):
+    arrays = np.load(path)
+    return cls(arrays['hashes'], arrays['reference'] if 'reference' in arrays else None)
+
+def evaluate(generated, training, kl_samples=10000, num_workers=None, seed=None, verbose=True):
+  """
+  Validity, uniqueness, novelty and KL divergence score of generated SMILES.
+  :param generated: List of SMILES, None or '' for failed decodes.
+  :param training: A TrainingIndex.
+  :param kl_samples: Distinct molecules compared in the KL benchmark.
+  :return: Dict of the scores, counts and the KL divergence per descriptor.
+  """
+  parsed = parse(generated, num_workers=num_workers)
+  unique = parsed.unique()
+  novel = ~training.contains(parsed.hashes[unique])
+  n, n_valid = len(parsed), int(parsed.valid.sum())
+  results = {'num_samples': n,
+             'num_valid': n_valid,
+             'num_unique': len(unique),
+             'num_novel': int(novel.sum()),
+             'validity': n_valid/float(max(n, 1)),
+             'uniqueness': len(unique)/float(max(n_valid, 1)),
+             'novelty': int(novel.sum())/float(max(len(unique), 1))}
+  if training.reference is not None and len(unique) > 1:
+    rng = np.random.RandomState(seed)
+    rows = unique if len(unique) <= kl_samples else \
+      np.sort(rng.choice(unique, size=kl_samples, replace=False))
+    results['kl_score'], results['kl'] = kl_divergence(training.reference, kl_features(parsed, rows))
+  if verbose:
+    for name in ('validity', 'uniqueness', 'novelty', 'kl_score'):
+      if name in results:
+        print("The model's " + name + " is: " + "{:.3f}".format(results[name]))
+  return results
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Samples N unique valid molecules from a trained model for the distribution
+learning benchmarks, in place of decoding a hand picked surplus of prior
+samples and dropping the duplicates afterwards.
+
+UniqueSampler draws latents from a prior in batches, decodes them to
+canonical SMILES, and keeps the ones that are valid and not seen before.
+stream() yields every batch of new molecules as soon as it is decoded, until
+N have been found. The next batch is sized from the yield so far (new unique
+valid molecules per latent), so that it should just reach N, within
+[min_batch, max_batch]. The yield drops as the sample fills up with the
+model's most likely molecules. The sampler counts latents, valid decodes,
+unique molecules and time, and reports samples/sec and yield.
+
+generate() is GuacaMol's DistributionMatchingGenerator interface (in place
+of MockGenerator over a hand made list). It returns the raw decodes of
+independent prior draws, invalid and repeated molecules included, since
+GuacaMol measures validity and uniqueness on them and samples its valid /
+unique sets itself; it does not touch the molecules found by stream().
+
+Priors are functions (num, rng) -> Z:
+  normal_prior           N(0, I), the VAE prior
+  aggregate_posterior    the encoded training set, a random training latent
+                         plus its posterior noise; for the implicit VAE,
+                         whose prior is not N(0, I)
+"""
+
+import time
+
+import numpy as np
+
+import Utils.tokenization as tokenization
+
+def normal_prior(latent_dim=64, scale=1.0):
+  def sample(num, rng):
+    return (scale*rng.normal(size=(num, latent_dim))).astype(np.float32)
+  return sample
+
+def aggregate_posterior(Z_mean, Z_log_var=None, noise=0.0):
+  """
+  :param Z_mean: Encoded training latents [N, D] (array, memmap or the
+                 z_mean of a Utils.latent_store.LatentStore chunk).
+  :param Z_log_var: Their log variances; None (or the zeros of the
+                    implicit VAE) for no posterior noise.
+  :param noise: Extra isotropic noise std.
+  """
+  def sample(num, rng):
+    rows = np.sort(rng.randint(len(Z_mean), size=num))
+    Z = np.asarray(Z_mean[rows], dtype=np.float32)
+    std = np.full(Z.shape, noise, dtype=np.float32)
+    if Z_log_var is not None:
+      std = np.sqrt(std**2 + np.exp(np.asarray(Z_log_var[rows], dtype=np.float32)))
+    return Z + std*rng.normal(size=Z.shape).astype(np.float32)
+  return sample
+
+class UniqueSampler(object):
+  """
+  :param model: A Utils.latent_model.LatentModel (or FilteredModel).
+  :param prior: Function (num, rng) -> latents, normal_prior by default.
+  :param batch_size: First batch.
+  :param min_batch: Smallest batch once the yield is known.
+  :param max_batch: Largest batch.
+  :param max_samples: Latents decoded at most per stream, in case the model
+                      cannot give N distinct molecules (None: no limit).
+  """
+  def __init__(self, model, prior=None, batch_size=1024, min_batch=256, max_batch=16384,
+               max_samples=None, seed=None, verbose=True):
+    self.model = model
+    self.prior = prior or normal_prior(model.vae.latent_dim)
+    self.batch_size = batch_size
+    self.min_batch = min_batch
+    self.max_batch = max_batch
+    self.max_samples = max_samples
+    self.rng = np.random.RandomState(seed)
+    self.verbose = verbose
+    self.seen = set()
+    self.stats = {'samples': 0, 'valid': 0, 'unique': 0, 'seconds': 0.0}
+
+  def reset(self):
+    """
+    Forgets the molecules found so far.
+    """
+    self.seen = set()
+    self.stats = {'samples': 0, 'valid': 0, 'unique': 0, 'seconds': 0.0}
+
+  @property
+  def samples_per_sec(self):
+    return self.stats['samples']/max(self.stats['seconds'], 1e-9)
+
+  @property
+  def unique_yield(self):
+    return self.stats['unique']/float(max(self.stats['samples'], 1))
+
+  def report(self):
+    return dict(self.stats, samples_per_sec=self.samples_per_sec,
+                validity=self.stats['valid']/float(max(self.stats['samples'], 1)),
+                unique_yield=self.unique_yield)
+
+  def _next_batch(self, remaining, batch_yield):
+    if batch_yield is None:
+      return self.batch_size
+    ## 10% extra, as the yield keeps dropping
+    size = int(np.ceil(1.1*remaining/max(batch_yield, 1e-3)))
+    return int(np.clip(size, self.min_batch, self.max_batch))
+
+  def stream(self, n, return_latents=False):
+    """
+    Yields lists of new unique valid canonical SMILES (with their latents
+    if return_latents) until n have been found.
+    """
+    found, samples, batch_yield = 0, 0, None
+    while found < n:
+      if self.max_samples is not None and samples >= self.max_samples:
+        if self.verbose:
+          print("Stopped after " + str(samples) + " samples with " + str(found) + " molecules")
+        return
+      num = self._next_batch(n - found, batch_yield)
+      if self.max_samples is not None:
+        num = min(num, self.max_samples - samples)
+      start = time.time()
+      Z = self.prior(num, self.rng)
+      decoded = self.model.decode(Z, canonical=True)
+      new, rows = [], []
+      for i, s in enumerate(decoded):
+        if s is None:
+          continue
+        self.stats['valid'] += 1
+        if s not in self.seen and found + len(new) < n:
+          self.seen.add(s)
+          new.append(s)
+          rows.append(i)
+      self.stats['seconds'] += time.time() - start
+      self.stats['samples'] += num
+      self.stats['unique'] += len(new)
+      samples += num
+      found += len(new)
+      batch_yield = len(new)/float(num)
+      if self.verbose:
+        print("Sampled " + str(self.stats['samples']) + ", Unique = " + str(found) + "/" + str(n) + \
+              ", Yield = " + "{:.3f}".format(batch_yield) + \
+              ", Samples/sec = " + "{:.1f}".format(self.samples_per_sec))
+      if new:
+        yield (new, Z[rows]) if return_latents else new
+
+  def sample(self, n):
+    """
+    List of n unique valid canonical SMILES (fewer if max_samples ran out).
+    Molecules found by earlier calls are not found again, reset() first for
+    an independent sample.
+    """
+    return [s for batch in self.stream(n) for s in batch]
+
+  def generate(self, number_samples):
+    """
+    SMILES decoded from number_samples prior draws, one per draw: invalid
+    decodes are kept as the decoded string and duplicates are kept.
+    """
+    out = []
+    while len(out) < number_samples:
+      Z = self.prior(min(self.max_batch, number_samples - len(out)), self.rng)
+      strings = self.model.decode_strings(Z)
+      smiles = tokenization.strings_to_smiles(strings, self.model.representation)
+      out.extend(m or s for s, m in zip(strings, smiles))
+    return out
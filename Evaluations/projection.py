@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+Property maps (QED / SA / logP, Tanimoto to a query) of the latent space
+over a whole encoded corpus, in place of KernelPCA(kernel="linear") fit on
+4000 sampled latents and a MinMaxScaler.transform call per point.
+
+LatentProjection is the same linear PCA fit in streaming form: the latent
+sum and the [D, D] scatter matrix are accumulated chunk by chunk (float64),
+and the components are the top eigenvectors of the covariance. With
+LATENT_DIM = 64 this is exact and costs one pass over the latents, so
+neither randomized nor incremental PCA is needed. The min-max scaling of
+the notebooks is fit on a second pass over the projected chunks.
+
+Maps are then built in another streaming pass: every chunk of latents is
+projected with one matrix product and its property values are folded into
+an accumulator that only keeps per cell counts, sums and sums of squares:
+  GridAccumulator     a rectangular [nx, ny] grid
+  HexbinAccumulator   matplotlib's hexbin lattice, drawn with plot()
+so the memory of a map does not depend on the number of molecules.
+property_map runs the second pass over a Utils.latent_store.LatentStore.
+"""
+
+import numpy as np
+
+class LatentProjection(object):
+  """
+  :param n_components: Dimensions kept, 2 for maps.
+  """
+  def __init__(self, n_components=2):
+    self.n_components = n_components
+    self.mean = None
+    self.components = None
+    self.explained_variance = None
+    self.low = None
+    self.high = None
+
+  def fit(self, chunks):
+    """
+    :param chunks: Latent array [N, D], or a list of chunks [n, D]; it is
+                   read twice, for the moments and for the range.
+    """
+    chunks = [chunks] if isinstance(chunks, np.ndarray) else chunks
+    self.fit_moments(chunks)
+    return self.fit_range(chunks)
+
+  def fit_moments(self, chunks):
+    """
+    Components from one pass over an iterable of latent chunks.
+    """
+    total, count, scatter = None, 0, None
+    for Z in chunks:
+      Z = np.asarray(Z, dtype=np.float64)
+      if total is None:
+        total, scatter = np.zeros(Z.shape[1]), np.zeros((Z.shape[1], Z.shape[1]))
+      total += Z.sum(axis=0)
+      scatter += Z.T.dot(Z)
+      count += len(Z)
+    self.mean = total/count
+    cov = (scatter - count*np.outer(self.mean, self.mean))/max(count - 1, 1)
+    values, vectors = np.linalg.eigh(cov)
+    order = np.argsort(values)[::-1][:self.n_components]
+    self.explained_variance = values[order]
+    self.components = vectors[:, order].T.astype(np.float32)
+    ## Same sign convention as sklearn (largest loading positive)
+    signs = np.sign(self.components[np.arange(len(order)), np.argmax(np.abs(self.components), axis=1)])
+    self.components *= signs[:, None]
+    return self
+
+  def fit_range(self, chunks):
+    """
+    Min-max scaling of the projection, from a second pass.
+    """
+    self.low, self.high = None, None
+    for Z in chunks:
+      P = self.transform(Z, scaled=False)
+      if not len(P):
+        continue
+      low, high = P.min(axis=0), P.max(axis=0)
+      self.low = low if self.low is None else np.minimum(self.low, low)
+      self.high = high if self.high is None else np.maximum(self.high, high)
+    return self
+
+  def fit_store(self, store, field='z_mean'):
+    """
+    Fits on a LatentStore in two passes over its chunks, each id once with
+    its latest latent.
+    """
+    self.fit_moments(Z for _, Z in store.scan(field))
+    return self.fit_range(Z for _, Z in store.scan(field))
+
+  def transform(self, Z, scaled=True):
+    """
+    Projection of latents [N, D] to [N, n_components], min-max scaled to
+    [0, 1] per component if scaled.
+    """
+    P = (np.asarray(Z, dtype=np.float32) - self.mean.astype(np.float32)).dot(self.components.T)
+    if scaled:
+      P = (P - self.low)/np.maximum(self.high - self.low, 1e-12)
+    return P
+
+class GridAccumulator(object):
+  """
+  Streaming per cell count, sum and sum of squares of values on a grid.
+  :param bounds: (xmin, xmax, ymin, ymax); (0, 1, 0, 1) for scaled
+                 projections.
+  :param shape: (nx, ny) cells.
+  :param num_values: Properties accumulated together.
+  """
+  def __init__(self, bounds=(0., 1., 0., 1.), shape=(100, 100), num_values=1):
+    self.bounds = bounds
+    self.shape = shape
+    self.num_values = num_values
+    size = self.num_cells()
+    self.counts = np.zeros(size, dtype=np.int64)
+    self.sums = np.zeros((size, num_values))
+    self.squares = np.zeros((size, num_values))
+
+  def num_cells(self):
+    return self.shape[0]*self.shape[1]
+
+  def cells(self, P):
+    xmin, xmax, ymin, ymax = self.bounds
+    nx, ny = self.shape
+    ix = np.clip(((P[:, 0] - xmin)/(xmax - xmin)*nx).astype(np.int64), 0, nx - 1)
+    iy = np.clip(((P[:, 1] - ymin)/(ymax - ymin)*ny).astype(np.int64), 0, ny - 1)
+    return ix*ny + iy
+
+  def add(self, P, values=None):
+    """
+    :param P: Projected points [n, 2].
+    :param values: [n] or [n, num_values]; None to only count.
+    """
+    cells = self.cells(np.asarray(P))
+    size = len(self.counts)
+    self.counts += np.bincount(cells, minlength=size)
+    if values is None:
+      return self
+    values = np.asarray(values, dtype=np.float64).reshape(len(cells), self.num_values)
+    for j in range(self.num_values):
+      self.sums[:, j] += np.bincount(cells, weights=values[:, j], minlength=size)
+      self.squares[:, j] += np.bincount(cells, weights=values[:, j]**2, minlength=size)
+    return self
+
+  def mean(self):
+    """
+    Mean value per cell [cells, num_values], NaN for empty cells.
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+      return self.sums/self.counts[:, None]
+
+  def std(self):
+    with np.errstate(invalid='ignore', divide='ignore'):
+      mean = self.mean()
+      return np.sqrt(np.maximum(self.squares/self.counts[:, None] - mean**2, 0.0))
+
+  def grid(self, stat='mean', column=0):
+    """
+    [nx, ny] image of 'count', 'mean' or 'std', e.g. for plt.imshow(grid.T,
+    origin='lower').
+    """
+    values = self.counts.astype(np.float64) if stat == 'count' else getattr(self, stat)()[:, column]
+    return values.reshape(self.shape)
+
+class HexbinAccumulator(GridAccumulator):
+  """
+  The cells of plt.hexbin(gridsize=gridsize, extent=bounds): two offset
+  rectangular lattices, each point in the cell of the nearest centre.
+  """
+  def __init__(self, bounds=(0., 1., 0., 1.), gridsize=50, num_values=1):
+    self.nx = gridsize
+    self.ny = int(gridsize/np.sqrt(3))
+    GridAccumulator.__init__(self, bounds, (self.nx, self.ny), num_values)
+
+  def num_cells(self):
+    return (self.nx + 1)*(self.ny + 1) + self.nx*self.ny
+
+  def _lattice(self):
+    ## Origin and steps, x padded as in matplotlib against round off
+    xmin, xmax, ymin, ymax = self.bounds
+    padding = 1e-9*(xmax - xmin)
+    xmin, xmax = xmin - padding, xmax + padding
+    return xmin, ymin, (xmax - xmin)/self.nx, (ymax - ymin)/self.ny
+
+  def cells(self, P):
+    ## Points outside the extent go to the border cells (hexbin drops them)
+    xmin, ymin, sx, sy = self._lattice()
+    x, y = (P[:, 0] - xmin)/sx, (P[:, 1] - ymin)/sy
+    ix1, iy1 = np.round(x).astype(np.int64), np.round(y).astype(np.int64)
+    ix2, iy2 = np.floor(x).astype(np.int64), np.floor(y).astype(np.int64)
+    first = (x - ix1)**2 + 3.0*(y - iy1)**2 < (x - ix2 - 0.5)**2 + 3.0*(y - iy2 - 0.5)**2
+    ix1, iy1 = np.clip(ix1, 0, self.nx), np.clip(iy1, 0, self.ny)
+    ix2, iy2 = np.clip(ix2, 0, self.nx - 1), np.clip(iy2, 0, self.ny - 1)
+    return np.where(first, ix1*(self.ny + 1) + iy1,
+                    (self.nx + 1)*(self.ny + 1) + ix2*self.ny + iy2)
+
+  def centers(self):
+    """
+    Hexagon centres [cells, 2], in the order of the accumulated values.
+    """
+    xmin, ymin, sx, sy = self._lattice()
+    ix1, iy1 = np.meshgrid(np.arange(self.nx + 1), np.arange(self.ny + 1), indexing='ij')
+    ix2, iy2 = np.meshgrid(np.arange(self.nx), np.arange(self.ny), indexing='ij')
+    x = np.concatenate([ix1.ravel(), ix2.ravel() + 0.5])*sx + xmin
+    y = np.concatenate([iy1.ravel(), iy2.ravel() + 0.5])*sy + ymin
+    return np.stack([x, y], axis=1)
+
+  def plot(self, ax=None, stat='mean', column=0, **kwargs):
+    """
+    Draws the map with plt.hexbin over the cell centres, each alone in its
+    hexagon; empty cells are left out.
+    """
+    import matplotlib.pyplot as plt
+    ax = ax or plt.gca()
+    values = self.counts.astype(np.float64) if stat == 'count' else getattr(self, stat)()[:, column]
+    keep = self.counts > 0
+    centers = self.centers()[keep]
+    return ax.hexbin(centers[:, 0], centers[:, 1], C=values[keep], gridsize=(self.nx, self.ny),
+                     extent=self.bounds, reduce_C_function=np.mean, **kwargs)
+
+def property_map(store, projection, values, accumulator=None, field='z_mean'):
+  """
+  Streams a LatentStore through the projection into an accumulator; ids
+  re-encoded by a later checkpoint are counted once.
+  :param values: Property values per molecule id, an array (or memmap)
+                 indexed by id, [num_ids] or [num_ids, k], or a function
+                 (ids, Z) -> values [n] or [n, k], e.g. the Tanimoto to a
+                 query of the molecules with these ids.
+  :param accumulator: A GridAccumulator or HexbinAccumulator over the scaled
+                      projection, a 50 hexbin by default.
+  """
+  if accumulator is None:
+    columns = 1 if callable(values) or np.ndim(values) == 1 else np.shape(values)[1]
+    accumulator = HexbinAccumulator(num_values=columns)
+  for ids, Z in store.scan(field):
+    ids = np.asarray(ids)
+    v = values(ids, Z) if callable(values) else np.asarray(values[ids])
+    accumulator.add(projection.transform(Z), v)
+  return accumulator
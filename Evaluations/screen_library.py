@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+Command line screener: predicted IC50 of every compound of a SMILES library
+(a vendor catalogue, an SDF converted to SMILES) against a panel of cell
+lines, written to disk chunk by chunk.
+
+    python -m Evaluations.screen_library library.smi out_dir \\
+        --histology sarcoma --vocab vocab/smiles_vocab.npy \\
+        --vocab-index vocab/smiles_vocab_index.npy --num-workers 8
+
+The library is read lazily, <chunk_size> lines at a time. Worker processes
+tokenize the next chunks while this process encodes the current one with
+the IC50 VAE encoder and scores it with IC50_MCA against every cell line of
+the panel, so memory is bounded by a few chunks whatever the library size.
+Every chunk is written as a part directory, renamed into place once
+complete:
+  row.npy       int64 [n]            index of the compound in the library
+  ok.npy        bool [n]             tokenized and scored
+  ic50.npy      float32 [n, C]       prediction per cell line, NaN if not ok
+  smiles.npy    uint8                the SMILES back to back
+  offsets.npy   int64 [n + 1]        where each SMILES starts
+  Z.npy         float16 [n, D]       latents, with --save-latents
+Running the same command again skips the completed parts, so an interrupted
+screen resumes at its first missing chunk; --shard i/n splits the chunks
+between machines writing to the same directory.
+
+The panel is taken from the IC50 training data (gene_expressions.npy,
+cell_lines.npy, histologies.npy in --data-dir): one expression profile per
+selected cell line, standardized with the mean and std of all the rows as
+the notebooks' StandardScaler. Predictions are in the (MinMax scaled) units
+the predictor was trained on.
+"""
+
+import os
+import csv
+import json
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import Utils.tokenization as tokenization
+
+META_FILE = 'screen.json'
+
+def read_smiles(path, smiles_column=None):
+  """
+  Yields the SMILES of a library file: the first field of every line of a
+  .smi / .txt file (blank and '#' lines skipped), or <smiles_column>
+  ('smiles' by default, any case) of a .csv / .tsv file.
+  """
+  ext = os.path.splitext(path)[1].lower()
+  with open(path, newline='') as f:
+    if ext in ('.csv', '.tsv'):
+      reader = csv.reader(f, delimiter='\t' if ext == '.tsv' else ',')
+      header = [h.strip().lower() for h in next(reader)]
+      column = header.index((smiles_column or 'smiles').lower())
+      for row in reader:
+        yield row[column].strip() if len(row) > column else ''
+    else:
+      for line in f:
+        line = line.strip()
+        if line and not line.startswith('#'):
+          yield line.split()[0]
+
+def read_chunks(smiles, chunk_size):
+  """
+  Yields (chunk index, first row, list of SMILES) from an iterable.
+  """
+  chunk, start, index = [], 0, 0
+  for s in smiles:
+    chunk.append(s)
+    if len(chunk) == chunk_size:
+      yield index, start, chunk
+      chunk, start, index = [], start + chunk_size, index + 1
+  if chunk:
+    yield index, start, chunk
+
+def load_panel(data_dir, histologies=None, cell_lines=None, chunk_size=10000):
+  """
+  Standardized expression profiles of a cell line panel.
+  :param histologies: Histologies whose cell lines are screened.
+  :param cell_lines: Or / and explicit cell line names.
+  :return: (cell line names, genes [C, NUM_GENES]).
+  """
+  genes = np.load(os.path.join(data_dir, 'gene_expressions.npy'), mmap_mode='r')
+  names = np.load(os.path.join(data_dir, 'cell_lines.npy'), allow_pickle=True).astype(str)
+  tissues = np.load(os.path.join(data_dir, 'histologies.npy'), allow_pickle=True).astype(str)
+  selected = np.zeros(len(names), dtype=bool)
+  if histologies:
+    selected |= np.isin(np.char.lower(tissues), [h.lower() for h in histologies])
+  if cell_lines:
+    selected |= np.isin(names, cell_lines)
+  if not histologies and not cell_lines:
+    selected[:] = True
+  ## First row of every selected cell line
+  panel, rows = np.unique(names[selected], return_index=True)
+  if not len(panel):
+    raise ValueError('No cell line matches the panel')
+  rows = np.flatnonzero(selected)[rows]
+  ## StandardScaler over all the rows, in chunks of the memmap
+  total = np.zeros(genes.shape[1])
+  squares = np.zeros(genes.shape[1])
+  for i in range(0, len(genes), chunk_size):
+    g = np.asarray(genes[i:i + chunk_size], dtype=np.float64)
+    total += g.sum(axis=0)
+    squares += (g**2).sum(axis=0)
+  mean = total/len(genes)
+  std = np.sqrt(np.maximum(squares/len(genes) - mean**2, 0.0))
+  std[std == 0] = 1.0
+  profiles = ((np.asarray(genes[rows], dtype=np.float64) - mean)/std).astype(np.float32)
+  return panel.tolist(), profiles
+
+def _tokenize(smiles, vocab, pad_size, representation):
+  ## Runs in the worker processes
+  return tokenization.encode_batch(smiles, vocab, pad_size, representation)
+
+def _part_path(out_dir, index):
+  return os.path.join(out_dir, 'part-{:06d}'.format(index))
+
+def completed_parts(out_dir):
+  return set(int(p[len('part-'):]) for p in os.listdir(out_dir)
+             if p.startswith('part-') and p[len('part-'):].isdigit())
+
+def _write_part(out_dir, index, start, smiles, ok, ic50, Z=None):
+  path = _part_path(out_dir, index)
+  tmp = path + '.tmp'
+  os.makedirs(tmp, exist_ok=True)
+  encoded = [s.encode() for s in smiles]
+  offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+  offsets[1:] = np.cumsum([len(e) for e in encoded])
+  np.save(os.path.join(tmp, 'row.npy'), np.arange(start, start + len(smiles), dtype=np.int64))
+  np.save(os.path.join(tmp, 'ok.npy'), ok)
+  np.save(os.path.join(tmp, 'ic50.npy'), ic50)
+  np.save(os.path.join(tmp, 'smiles.npy'), np.frombuffer(b''.join(encoded), dtype=np.uint8))
+  np.save(os.path.join(tmp, 'offsets.npy'), offsets)
+  if Z is not None:
+    np.save(os.path.join(tmp, 'Z.npy'), Z.astype(np.float16))
+  os.rename(tmp, path)
+
+def scan(out_dir, columns=('row', 'ok', 'ic50')):
+  """
+  Yields one dict of memory mapped columns per completed part, in order.
+  """
+  for index in sorted(completed_parts(out_dir)):
+    path = _part_path(out_dir, index)
+    yield {c: np.load(os.path.join(path, c + '.npy'), mmap_mode='r') for c in columns}
+
+def _check_meta(out_dir, meta):
+  ## A resumed screen must cut the library the same way
+  path = os.path.join(out_dir, META_FILE)
+  if os.path.exists(path):
+    with open(path) as f:
+      old = json.load(f)
+    for key in ('chunk_size', 'cell_lines'):
+      if old[key] != meta[key]:
+        raise ValueError('Output directory was screened with another ' + key)
+    return
+  with open(path + '.tmp', 'w') as f:
+    json.dump(meta, f)
+  os.replace(path + '.tmp', path)
+
+def screen(model, smiles, out_dir, genes, cell_lines, chunk_size=100000, num_workers=1,
+           shard=(0, 1), save_latents=False, verbose=True):
+  """
+  Scores a library against a panel, resuming in <out_dir>.
+  :param model: A Utils.latent_model.LatentModel with an IC50 predictor.
+  :param smiles: Iterable of SMILES, e.g. read_smiles(path).
+  :param genes: Panel profiles [C, NUM_GENES], from load_panel.
+  :param shard: (i, n), only chunks with index % n == i.
+  :return: Number of compounds scored by this run.
+  """
+  os.makedirs(out_dir, exist_ok=True)
+  _check_meta(out_dir, {'chunk_size': chunk_size, 'cell_lines': list(cell_lines)})
+  done = completed_parts(out_dir)
+  todo = ((i, s, c) for i, s, c in read_chunks(smiles, chunk_size)
+          if i % shard[1] == shard[0] and i not in done)
+  pool = ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context('spawn'))
+  window = num_workers + 1
+  pending = []
+  def submit():
+    item = next(todo, None)
+    if item is not None:
+      index, start, chunk = item
+      pending.append((index, start, chunk, pool.submit(_tokenize, chunk, model.vocab,
+                                                       model.pad_size, model.representation)))
+  scored, begin = 0, time.time()
+  try:
+    for _ in range(window):
+      submit()
+    while pending:
+      index, start, chunk, future = pending.pop(0)
+      X, ok = future.result()
+      ## Keep <window> chunks tokenizing while this one is scored
+      submit()
+      ic50 = np.full((len(chunk), len(genes)), np.nan, dtype=np.float32)
+      Z = np.zeros((len(chunk), model.vae.latent_dim), dtype=np.float32)
+      rows = np.flatnonzero(ok)
+      if len(rows):
+        Z[rows] = model.encode_tokens(X[rows])[0]
+        ic50[rows] = model.predict(Z[rows], genes, average=False)
+      _write_part(out_dir, index, start, chunk, ok, ic50, Z if save_latents else None)
+      scored += len(rows)
+      if verbose:
+        print("Chunk " + str(index) + ", Scored = " + str(scored) + \
+              ", Compounds/sec = " + "{:.1f}".format(scored/max(time.time() - begin, 1e-9)))
+  finally:
+    pool.shutdown(cancel_futures=True)
+  return scored
+
+def _load_dict(path):
+  return dict(np.load(path, allow_pickle=True).ravel()[0])
+
+def build_model(args):
+  """
+  LatentModel of the IC50 VAE encoder and the IC50_MCA predictor.
+  """
+  import models.registry as registry
+  from Utils.latent_model import LatentModel
+  vocab, vocab_index = _load_dict(args.vocab), _load_dict(args.vocab_index)
+  vae = registry.load(args.representation, args.family, len(vocab_index), args.latent_dim,
+                      weights_dir=args.weights_dir)
+  predictor = registry.load(args.representation, 'ic50mca', len(vocab_index), args.latent_dim,
+                            weights_dir=args.weights_dir)
+  return LatentModel(vae, vocab, vocab_index, args.representation,
+                     registry.PAD_SIZES[args.representation], predictor=predictor,
+                     batch_size=args.batch_size)
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Predicted IC50 of a SMILES library over a '
+                                               'cell line panel, streamed to disk.')
+  parser.add_argument('library', help='.smi / .txt (SMILES first on each line) or .csv / .tsv')
+  parser.add_argument('out_dir')
+  parser.add_argument('--smiles-column', default=None, help='Column of a .csv / .tsv library')
+  parser.add_argument('--data-dir', default='.', help='Directory of gene_expressions.npy, '
+                                                      'cell_lines.npy and histologies.npy')
+  parser.add_argument('--histology', nargs='*', default=None)
+  parser.add_argument('--cell-lines', nargs='*', default=None)
+  parser.add_argument('--vocab', required=True)
+  parser.add_argument('--vocab-index', required=True)
+  parser.add_argument('--representation', default='smiles', choices=('smiles', 'deep', 'selfies'))
+  parser.add_argument('--family', default='ic50vae', help='Encoder the predictor was trained on')
+  parser.add_argument('--latent-dim', type=int, default=64)
+  parser.add_argument('--weights-dir', default='.')
+  parser.add_argument('--chunk-size', type=int, default=100000)
+  parser.add_argument('--batch-size', type=int, default=1024)
+  parser.add_argument('--num-workers', type=int, default=max(os.cpu_count() - 1, 1))
+  parser.add_argument('--shard', default='0/1', help='i/n: screen every n-th chunk from i')
+  parser.add_argument('--save-latents', action='store_true')
+  args = parser.parse_args(argv)
+
+  shard = tuple(int(x) for x in args.shard.split('/'))
+  cell_lines, genes = load_panel(args.data_dir, args.histology, args.cell_lines)
+  print("Screening against " + str(len(cell_lines)) + " cell lines")
+  model = build_model(args)
+  screen(model, read_smiles(args.library, args.smiles_column), args.out_dir, genes, cell_lines,
+         chunk_size=args.chunk_size, num_workers=args.num_workers, shard=shard,
+         save_latents=args.save_latents)
+
+if __name__ == '__main__':
+  ## The registry's models are tf.keras 2 models, set before TensorFlow is
+  ## imported
+  os.environ.setdefault('TF_USE_LEGACY_KERAS', '1')
+  main()
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+Batched Bayesian optimization over the latent space, for the BO cells of
+Optimization_EvaluateSmileModel.ipynb.
+
+The notebook hands every sampled latent to GPyOpt and proposes one latent
+per predictor call. An exact GP costs O(N^3) in the number of observations,
+so it cannot be seeded with tens of thousands of known ChEMBL latents. Here
+the surrogate is a Bayesian linear model on D random Fourier features of an
+RBF kernel (Rahimi & Recht), which approximates the same GP:
+  - fitting costs O(N D^2) and adding observations O(n D^2),
+  - the posterior is kept as the D x D precision matrix and its right hand
+    side, so new observations are folded in without a refit.
+Every round proposes <batch_size> latents by batched Thompson sampling: q
+weight vectors are drawn from the posterior, every draw is a sample function
+that is minimized over a shared candidate pool (perturbations of the best
+observations and draws from the prior) and refined by a few projected
+gradient steps, and the q minimizers are scored with one batched predictor
+call.
+"""
+
+import time
+
+import numpy as np
+
+def median_lengthscale(X, num_samples=2000, rng=np.random):
+  """
+  Median heuristic for the RBF lengthscale on a subsample of X.
+  """
+  X = np.asarray(X, dtype=np.float64)
+  idx = rng.choice(len(X), size=min(num_samples, len(X)), replace=False)
+  S = X[idx]
+  sq = np.sum(S**2, axis=1)
+  d2 = sq[:, None] + sq[None, :] - 2*S.dot(S.T)
+  d2 = d2[np.triu_indices(len(S), k=1)]
+  return float(np.sqrt(np.median(np.maximum(d2, 0.0)))) if len(d2) else 1.0
+
+class RFFSurrogate(object):
+  """
+  Bayesian linear regression on random Fourier features,
+  phi(x) = sqrt(2/D) cos(W x + b) with W ~ N(0, 1/lengthscale^2), and
+  weights with prior N(0, I) on standardized targets.
+  :param num_features: D, the cost of a fit grows as D^2 per observation.
+  :param lengthscale: RBF lengthscale, by default the median heuristic at
+                      the first fit.
+  :param noise: Observation noise variance (of the standardized targets).
+  """
+  def __init__(self, latent_dim, num_features=1024, lengthscale=None, noise=0.1,
+               seed=None):
+    self.latent_dim = latent_dim
+    self.num_features = num_features
+    self.lengthscale = lengthscale
+    self.noise = noise
+    self.rng = np.random.RandomState(seed)
+    self.omega = None
+    self.phase = None
+    self.precision = None
+    self.rhs = None
+    self.y_mean, self.y_std = 0.0, 1.0
+    self.num_observations = 0
+
+  def features(self, X):
+    X = np.asarray(X, dtype=np.float64)
+    return np.sqrt(2.0/self.num_features)*np.cos(X.dot(self.omega.T) + self.phase)
+
+  def fit(self, X, y, batch_size=4096):
+    """
+    Fits the posterior from scratch on all observations.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64).reshape(-1)
+    if self.lengthscale is None:
+      self.lengthscale = median_lengthscale(X, rng=self.rng)
+    self.omega = self.rng.normal(0, 1.0/self.lengthscale,
+                                 size=(self.num_features, self.latent_dim))
+    self.phase = self.rng.uniform(0, 2*np.pi, size=self.num_features)
+    self.y_mean, self.y_std = y.mean(), max(y.std(), 1e-12)
+    self.precision = np.eye(self.num_features)
+    self.rhs = np.zeros(self.num_features)
+    self.num_observations = 0
+    self.update(X, y, batch_size)
+    return self
+
+  def update(self, X, y, batch_size=4096):
+    """
+    Adds observations to the posterior, in batches of rows so that only
+    [batch_size, D] features are held at once. The target scaling of the
+    first fit is kept.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    y = (np.asarray(y, dtype=np.float64).reshape(-1) - self.y_mean)/self.y_std
+    for i in range(0, len(X), batch_size):
+      phi = self.features(X[i:i + batch_size])
+      self.precision += phi.T.dot(phi)/self.noise
+      self.rhs += phi.T.dot(y[i:i + batch_size])/self.noise
+    self.num_observations += len(X)
+    self._factorize()
+    return self
+
+  def _factorize(self):
+    self.chol = np.linalg.cholesky(self.precision)
+    self.weights_mean = self._solve(self.rhs)
+
+  def _solve(self, b):
+    ## precision^-1 b through the Cholesky factor
+    return np.linalg.solve(self.chol.T, np.linalg.solve(self.chol, b))
+
+  def predict(self, X, return_std=False):
+    """
+    Posterior mean (and standard deviation) of the objective at X.
+    """
+    phi = self.features(X)
+    mean = phi.dot(self.weights_mean)*self.y_std + self.y_mean
+    if not return_std:
+      return mean
+    var = np.sum(phi*self._solve(phi.T).T, axis=1) + self.noise
+    return mean, np.sqrt(var)*self.y_std
+
+  def sample_weights(self, num):
+    """
+    <num> weight vectors from the posterior, [num, D].
+    """
+    eps = self.rng.normal(size=(self.num_features, num))
+    ## precision = L L^T, so L^-T eps has covariance precision^-1
+    return (self.weights_mean[:, None] + np.linalg.solve(self.chol.T, eps)).T
+
+class BayesianOptimizer(object):
+  """
+  :param objective: Function Z -> scores, batched, e.g. latent_objective.
+  :param latent_dim: Dimension of the latents.
+  :param surrogate: An RFFSurrogate, by default one with 1024 features.
+  :param batch_size: Latents proposed (and scored) per round.
+  :param num_candidates: Size of the candidate pool every sample function is
+                         minimized over.
+  :param local_fraction: Part of the pool perturbed from the best
+                         observations rather than drawn from the prior.
+  :param local_norm: Perturbation norm of the local candidates.
+  :param refine_steps: Projected gradient steps on every sample function.
+  :param bounds: Box the latents are kept in, as the notebook's domains.
+  :param minimize: Lower scores are better (IC50).
+  :param validity_filter: Anything with accept(Z) -> mask, e.g. a
+                          validity_filter.FilteredModel; candidates it
+                          rejects are not proposed.
+  :param run_log: An Optimizations.run_log.RunLog that every scored
+                  proposal and, every round, the state to resume from is
+                  written to.
+  """
+  def __init__(self, objective, latent_dim=64, surrogate=None, batch_size=256,
+               num_candidates=20000, local_fraction=0.5, local_norm=1.0,
+               refine_steps=20, step_size=0.05, bounds=(-4.0, 4.0),
+               minimize=True, seed=None, verbose=True, validity_filter=None,
+               run_log=None):
+    self.objective = objective
+    self.latent_dim = latent_dim
+    self.surrogate = surrogate or RFFSurrogate(latent_dim, seed=seed)
+    self.batch_size = batch_size
+    self.num_candidates = num_candidates
+    self.local_fraction = local_fraction
+    self.local_norm = local_norm
+    self.refine_steps = refine_steps
+    self.step_size = step_size
+    self.bounds = bounds
+    self.sign = 1.0 if minimize else -1.0
+    self.rng = np.random.RandomState(seed)
+    self.verbose = verbose
+    self.validity_filter = validity_filter
+    self.run_log = run_log
+    self.X = np.zeros((0, latent_dim), dtype=np.float32)
+    self.Y = np.zeros(0)
+    self.history = []
+
+  def observe(self, X, Y):
+    """
+    Adds scored latents, e.g. the encoded ChEMBL molecules and their
+    predictions to seed the search.
+    """
+    X = np.asarray(X, dtype=np.float32).reshape(-1, self.latent_dim)
+    Y = np.asarray(Y, dtype=np.float64).reshape(-1)
+    ok = np.isfinite(Y)
+    X, Y = X[ok], Y[ok]
+    if self.surrogate.precision is None:
+      self.surrogate.fit(X, self.sign*Y)
+    else:
+      self.surrogate.update(X, self.sign*Y)
+    self.X = np.concatenate([self.X, X])
+    self.Y = np.concatenate([self.Y, Y])
+
+  def candidates(self):
+    num_local = int(self.num_candidates*self.local_fraction)
+    best = np.argsort(self.sign*self.Y)[:max(1, self.batch_size)]
+    centers = self.X[self.rng.choice(best, size=num_local)]
+    noise = self.rng.normal(size=centers.shape)
+    noise /= np.linalg.norm(noise, axis=1, keepdims=True)
+    local = centers + self.rng.uniform(0, self.local_norm, size=(num_local, 1))*noise
+    prior = self.rng.normal(size=(self.num_candidates - num_local, self.latent_dim))
+    pool = np.clip(np.concatenate([local, prior]), *self.bounds)
+    if self.validity_filter is not None:
+      accepted = self.validity_filter.accept(pool)
+      ## Keep the whole pool rather than propose nothing
+      if accepted.sum() >= self.batch_size:
+        pool = pool[accepted]
+    return pool
+
+  def propose(self):
+    """
+    Batched Thompson sampling: the minimizer of each of batch_size sample
+    functions. Before any observation, draws from the prior (kept by the
+    validity filter if there is one).
+    :return: Latents [batch_size, LATENT_DIM].
+    """
+    if len(self.Y) == 0:
+      return self.prior_sample()
+    s = self.surrogate
+    W = s.sample_weights(self.batch_size)
+    pool = self.candidates()
+    ## Sample functions on the pool in chunks, [C, q] values at a time
+    best_val = np.full(self.batch_size, np.inf)
+    best_idx = np.zeros(self.batch_size, dtype=np.int64)
+    for i in range(0, len(pool), 4096):
+      values = s.features(pool[i:i + 4096]).dot(W.T)
+      idx = np.argmin(values, axis=0)
+      val = values[idx, np.arange(self.batch_size)]
+      better = val < best_val
+      best_val[better] = val[better]
+      best_idx[better] = idx[better] + i
+    Z = pool[best_idx]
+
+    ## Gradient of f_q(z) = sqrt(2/D) sum_j w_qj cos(omega_j z + b_j)
+    scale = np.sqrt(2.0/s.num_features)
+    for _ in range(self.refine_steps):
+      sin = np.sin(Z.dot(s.omega.T) + s.phase)
+      grad = -scale*(W*sin).dot(s.omega)
+      grad /= np.maximum(np.linalg.norm(grad, axis=1, keepdims=True), 1e-12)
+      Z = np.clip(Z - self.step_size*grad, *self.bounds)
+    return Z.astype(np.float32)
+
+  def prior_sample(self):
+    pool = np.clip(self.rng.normal(size=(self.num_candidates, self.latent_dim)), *self.bounds)
+    if self.validity_filter is not None:
+      accepted = self.validity_filter.accept(pool)
+      if accepted.sum() >= self.batch_size:
+        pool = pool[accepted]
+    return pool[:self.batch_size].astype(np.float32)
+
+  def run(self, num_rounds=10):
+    """
+    Proposes, scores and observes <num_rounds> batches.
+    :return: (X, Y) of every observation, best first.
+    """
+    for r in range(num_rounds):
+      start = time.time()
+      Z = self.propose()
+      Y = np.asarray(self.objective(Z), dtype=np.float64).reshape(-1)
+      self.observe(Z, Y)
+      best = np.nanmin(self.sign*Y)*self.sign
+      self.history.append({'seconds': time.time() - start, 'best_score': float(best)})
+      if self.run_log is not None:
+        self.run_log.append(Z, [None]*len(Z), Y, len(self.history))
+        self.run_log.save_state(len(self.history), rng=self.rng, history=self.history,
+                                rngs={'surrogate': self.surrogate.rng})
+      if self.verbose:
+        print("Round " + str(r) + ", Best = {:.5f}".format(best) + \
+              ", Best overall = {:.5f}".format(self.best()[1]))
+    order = np.argsort(self.sign*self.Y, kind='stable')
+    return self.X[order], self.Y[order]
+
+  def resume(self):
+    """
+    Observes every proposal in the run log again and restores the history
+    and the random states. Seed observations are not logged, observe them
+    first.
+    :return: Rounds done, continue with run(num_rounds - done).
+    """
+    ## Also cuts the log back to the last saved round
+    if self.run_log.load_state() is None:
+      return 0
+    for part in self.run_log.scan(columns=('Z', 'scores')):
+      self.observe(part['Z'], part['scores'])
+    ## After the observations, whose first fit draws the random features
+    rounds, _, history, _ = self.run_log.load_state(self.rng, {'surrogate': self.surrogate.rng})
+    self.history = history
+    return rounds
+
+  def best(self):
+    i = np.argmin(self.sign*self.Y)
+    return self.X[i], self.Y[i]
+
+def latent_objective(model, gene_expressions):
+  """
+  Predicted IC50 of latents against one profile, or the mean over several,
+  with batched predictor calls (replaces obj_function).
+  :param model: A Utils.latent_model.LatentModel with a predictor.
+  """
+  def objective(Z):
+    return model.predict(Z, gene_expressions)
+  return objective
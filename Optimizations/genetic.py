@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+"""
+Genetic algorithm over the latent space of a VAE, the importable and
+batched form of the GA cells of Optimization_EvaluateSmileModel.ipynb.
+
+A population is held as arrays: latents Z [P, LATENT_DIM], the SMILES they
+decode to and their scores. Every generation
+  1. blends random pairs of parents into 2 * num_children children,
+  2. perturbs every child (with child_norm) and every member of the
+     population (with mutation_norm) decode_attempts times,
+  3. decodes all the perturbations in one batched call,
+  4. re-encodes the new valid unique SMILES in one batched call,
+  5. scores the new latents in one batched call,
+  6. selects the next population from the old one and the new molecules.
+
+SMILES are kept canonical and every molecule ever scored is remembered in
+a hash set, so a molecule is scored once and the population never holds
+duplicates. Survivor selection is then a top-k (argpartition) over the
+population and the new molecules: O(n) per generation however long the
+run has been going, where the notebook sorted and list-scanned the whole
+accumulated history.
+
+Objectives are functions (Z, smiles) -> scores; ic50_objective and
+trad_objective give the two the notebook optimizes. With selection='nsga2'
+the scores are an objective matrix [N, M] and the GA optimizes them all at
+once (see Optimizations.pareto).
+"""
+
+import time
+
+import numpy as np
+
+import Utils.proc_chem as proc_chem
+import Utils.instrumentation as instrumentation
+import Optimizations.pareto as pareto
+
+class Population(object):
+  """
+  Latents, their SMILES and their scores as parallel arrays.
+  """
+  def __init__(self, Z, smiles, scores):
+    self.Z = np.asarray(Z, dtype=np.float32)
+    self.smiles = np.asarray(smiles, dtype=object)
+    self.scores = np.asarray(scores, dtype=np.float64)
+
+  def __len__(self):
+    return len(self.smiles)
+
+  def take(self, idx):
+    return Population(self.Z[idx], self.smiles[idx], self.scores[idx])
+
+  def concat(self, other):
+    ## Empty populations have 1-D scores whatever the objective
+    if len(other) == 0:
+      return self
+    if len(self) == 0:
+      return other
+    return Population(np.concatenate([self.Z, other.Z]),
+                      np.concatenate([self.smiles, other.smiles]),
+                      np.concatenate([self.scores, other.scores]))
+
+def perturb(Z, noise_norm, num, rng=np.random, constant_norm=False):
+  """
+  perturb_z for a whole batch: <num> perturbations of every row of Z.
+  Each perturbation is a random direction scaled to noise_norm, or to a
+  uniform amount in [0, noise_norm] unless constant_norm. All the noise is
+  drawn in one call.
+  :param noise_norm: One norm, or one per row of Z.
+  :return: Array [len(Z) * num, LATENT_DIM], perturbations of row i at
+           rows i*num to (i+1)*num.
+  """
+  Z = np.repeat(np.asarray(Z, dtype=np.float32), num, axis=0)
+  norms = np.asarray(noise_norm, dtype=np.float64)
+  if np.all(norms <= 0.0):
+    return Z
+  if norms.ndim > 0:
+    norms = np.repeat(norms, num)[:, None]
+  noise = rng.normal(0, 1, size=Z.shape)
+  noise /= np.linalg.norm(noise, axis=1, keepdims=True)
+  if constant_norm:
+    amp = norms
+  else:
+    amp = rng.uniform(0, 1, size=(len(Z), 1))*norms
+  return (Z + amp*noise).astype(np.float32)
+
+def crossover(Z, num_children, rng=np.random, return_parents=False):
+  """
+  Blends <num_children> random pairs of rows of Z. Each pair gives the two
+  children diff*p1 + (1-diff)*p2 and (1-diff)*p1 + diff*p2.
+  :return: Array [2 * num_children, LATENT_DIM], and with return_parents
+           the rows of Z each child was blended from [2 * num_children, 2].
+  """
+  parents1 = rng.randint(0, len(Z), size=num_children)
+  parents2 = rng.randint(0, len(Z), size=num_children)
+  diff = rng.uniform(0, 1.0, size=(num_children, 1))
+  p1, p2 = Z[parents1], Z[parents2]
+  children = np.concatenate([diff*p1 + (1 - diff)*p2,
+                             (1 - diff)*p1 + diff*p2]).astype(np.float32)
+  if return_parents:
+    parents = np.stack([parents1, parents2], axis=1)
+    return children, np.concatenate([parents, parents])
+  return children
+
+def top_k(scores, k, minimize=True):
+  """
+  Indices of the k best scores, best first, in O(n + k log k).
+  """
+  keys = np.asarray(scores, dtype=np.float64)
+  keys = keys if minimize else -keys
+  ## NaN scores (failed predictions) rank last
+  keys = np.where(np.isnan(keys), np.inf, keys)
+  if k < len(keys):
+    idx = np.argpartition(keys, k - 1)[:k]
+  else:
+    idx = np.arange(len(keys))
+  return idx[np.argsort(keys[idx], kind='stable')]
+
+def unique(smiles, seen=None, update=True):
+  """
+  Indices of the first occurrence of every SMILES that is not None and not
+  in <seen>. <seen> is updated with the SMILES kept, unless update is False
+  (e.g. until they have been encoded).
+  """
+  seen = set() if seen is None else seen
+  kept = seen if update else set()
+  keep = []
+  for i, s in enumerate(smiles):
+    if s is not None and s not in seen and s not in kept:
+      kept.add(s)
+      keep.append(i)
+  return np.array(keep, dtype=np.int64)
+
+def select_truncation(population, num_out, minimize=True, rng=np.random, **kwargs):
+  """
+  The best num_out, as in the notebook.
+  """
+  return population.take(top_k(population.scores, num_out, minimize))
+
+def select_tournament(population, num_out, minimize=True, rng=np.random,
+                      elitism=10, tournament_size=3):
+  """
+  The best <elitism> plus winners of tournaments among the rest, without
+  picking an entry twice.
+  """
+  if len(population) <= num_out:
+    return population.take(top_k(population.scores, num_out, minimize))
+  scores = population.scores if minimize else -population.scores
+  scores = np.where(np.isnan(scores), np.inf, scores)
+  chosen = top_k(population.scores, min(elitism, num_out), minimize).tolist()
+  taken = np.zeros(len(population), dtype=bool)
+  taken[chosen] = True
+  while len(chosen) < num_out:
+    entrants = rng.randint(0, len(population), size=tournament_size)
+    entrants = entrants[~taken[entrants]]
+    if len(entrants) == 0:
+      continue
+    winner = entrants[np.argmin(scores[entrants])]
+    taken[winner] = True
+    chosen.append(winner)
+  chosen = np.array(chosen)
+  return population.take(chosen[np.argsort(scores[chosen], kind='stable')])
+
+SELECTIONS = {'truncation': select_truncation, 'tournament': select_tournament,
+              'nsga2': pareto.select_nsga2}
+
+def ic50_objective(model, gene_expressions):
+  """
+  Predicted IC50 (lower is better) against one profile or the mean over
+  several profiles.
+  :param model: A Utils.latent_model.LatentModel with a predictor.
+  """
+  def objective(Z, smiles):
+    return model.predict(Z, gene_expressions)
+  return objective
+
+def trad_score(smiles):
+  ## 5 * QED - SAS as get_trad_score
+  import rdkit.Chem.QED as QED
+  m = proc_chem.rkc.MolFromSmiles(smiles)
+  if m is None:
+    return -np.inf
+  return 5*QED.qed(m) - proc_chem.sa_score(m)
+
+def trad_objective():
+  """
+  5 * QED - SAS (higher is better), use with minimize=False.
+  """
+  def objective(Z, smiles):
+    return np.array([trad_score(s) for s in smiles])
+  return objective
+
+class GeneticOptimizer(object):
+  """
+  :param model: A Utils.latent_model.LatentModel.
+  :param objective: Function (Z, smiles) -> scores.
+  :param minimize: Lower scores are better (IC50); False for trad_objective.
+  :param num_out: Population size kept after every generation.
+  :param num_children: Crossovers per generation, each giving two children.
+  :param decode_attempts: Perturbations decoded per child and per member.
+  :param mutation_norm: Perturbation norm of the population members.
+  :param child_norm: Perturbation norm of the children.
+  :param selection: 'truncation' (the notebook's), 'tournament', 'nsga2'
+                    for objective matrices, or a function like
+                    select_truncation.
+  :param selection_kwargs: Extra arguments of the selection, e.g.
+                           elitism and tournament_size.
+  :param pipeline: An Optimizations.pipeline.Pipeline, to overlap decoding
+                   with validation and scoring.
+  :param archive: An Optimizations.pareto.ParetoArchive that every new
+                  molecule is offered to, with the same minimize.
+  :param run_log: An Optimizations.run_log.RunLog that every scored
+                  molecule and, every generation, the state to resume from
+                  is written to.
+  """
+  def __init__(self, model, objective, minimize=True, num_out=100,
+               num_children=10, decode_attempts=256, mutation_norm=10.0,
+               child_norm=1.0, selection='truncation', selection_kwargs=None,
+               seed=None, verbose=True, pipeline=None, archive=None,
+               run_log=None):
+    self.model = model
+    self.objective = objective
+    self.minimize = minimize
+    self.num_out = num_out
+    self.num_children = num_children
+    self.decode_attempts = decode_attempts
+    self.mutation_norm = mutation_norm
+    self.child_norm = child_norm
+    self.selection = SELECTIONS[selection] if isinstance(selection, str) else selection
+    self.selection_kwargs = selection_kwargs or {}
+    self.rng = np.random.RandomState(seed)
+    self.verbose = verbose
+    self.pipeline = pipeline
+    if archive is not None and archive.minimize != minimize:
+      raise ValueError('The archive and the optimizer disagree on minimize')
+    self.archive = archive
+    self.run_log = run_log
+    self.history = []
+    ## Canonical SMILES of every molecule scored so far
+    self.seen = set()
+
+  def initial_population(self, smiles, Z=None):
+    """
+    Scores the starting molecules, encoding them if Z is not given.
+    Invalid and repeated molecules are dropped.
+    """
+    canonical = [proc_chem.canonical_smiles(s) for s in smiles]
+    keep = unique(canonical, self.seen, update=False)
+    smiles = np.asarray(canonical, dtype=object)[keep]
+    if Z is None:
+      Z, ok = self.model.encode(smiles.tolist())
+      Z, smiles = Z[ok], smiles[ok]
+    else:
+      Z = np.asarray(Z, dtype=np.float32).reshape(len(canonical), -1)[keep]
+    self.seen.update(smiles)
+    population = Population(Z, smiles, self.objective(Z, smiles))
+    if self.archive is not None:
+      self.archive.add(population)
+    if self.run_log is not None:
+      self.run_log.append(population.Z, population.smiles, population.scores, 0)
+    return population
+
+  def offspring(self, population):
+    """
+    Decodes, re-encodes and scores the perturbed children and members.
+    The rows of <population> each new molecule came from are left in
+    self.parents [N, 2] (-1 for none).
+    :return: Population of the new valid molecules.
+    """
+    sources = [perturb(population.Z, self.mutation_norm, self.decode_attempts, self.rng)]
+    parents = [np.stack([np.arange(len(population)), -np.ones(len(population), np.int64)], axis=1)]
+    if self.num_children > 0 and len(population) > 0:
+      children, pairs = crossover(population.Z, self.num_children, self.rng, return_parents=True)
+      sources.insert(0, perturb(children, self.child_norm, self.decode_attempts, self.rng))
+      parents.insert(0, pairs)
+    parents = np.repeat(np.concatenate(parents), self.decode_attempts, axis=0)
+    if self.pipeline is not None:
+      new = self.pipeline.run(np.concatenate(sources), self.seen)
+      self.parents = parents[self.pipeline.rows]
+      return new
+    decoded = self.model.decode(np.concatenate(sources), canonical=True)
+
+    ## Valid molecules that have never been scored; they are seen once
+    ## encoded, so a failed encode can be decoded again later
+    rows = unique(decoded, self.seen, update=False)
+    new_smiles = np.asarray(decoded, dtype=object)[rows]
+    self.parents = parents[rows]
+    if len(new_smiles) == 0:
+      return Population(np.zeros((0, population.Z.shape[1])), [], [])
+    Z, ok = self.model.encode(new_smiles.tolist())
+    new_smiles = new_smiles[ok]
+    Z = Z[ok]
+    self.parents = self.parents[ok]
+    self.seen.update(new_smiles)
+    return Population(Z, new_smiles, self.objective(Z, new_smiles))
+
+  def step(self, population):
+    with instrumentation.span('ga.generation', generation=len(self.history) + 1):
+      survivors, new = self._step(population)
+    instrumentation.generation(len(self.history), len(new))
+    return survivors
+
+  def _step(self, population):
+    start = time.time()
+    with instrumentation.span('ga.offspring'):
+      new = self.offspring(population)
+    if self.archive is not None:
+      self.archive.add(new)
+    if self.run_log is not None:
+      parent_smiles = population.smiles[np.maximum(self.parents, 0)].reshape(-1)
+      parent_ids = self.run_log.id_of(parent_smiles).reshape(self.parents.shape)
+      parent_ids[self.parents < 0] = -1
+      self.run_log.append(new.Z, new.smiles, new.scores, len(self.history) + 1, parent_ids)
+    with instrumentation.span('ga.selection'):
+      survivors = self.selection(population.concat(new), self.num_out,
+                                 minimize=self.minimize, rng=self.rng,
+                                 **self.selection_kwargs)
+    ## No best when nothing is valid and new and there was no population
+    entry = {'seconds': time.time() - start, 'new': len(new), 'best_smiles': None}
+    if len(survivors) > 0:
+      entry['best_smiles'] = survivors.smiles[0]
+      if survivors.scores.ndim == 1:
+        entry['best_score'] = float(survivors.scores[0])
+      else:
+        ## With several objectives there is no single best, the first
+        ## survivor is on the front
+        entry['best_scores'] = survivors.scores[0].tolist()
+        entry['front_size'] = len(pareto.non_dominated_sort(survivors.scores, 1)[0])
+    self.history.append(entry)
+    if self.run_log is not None:
+      self.run_log.save_state(len(self.history), survivors, self.rng, self.history)
+    if self.verbose:
+      print("BEST GENERATION : " + str(entry['best_smiles']))
+      if 'best_score' in entry:
+        print("BEST GENERATION SCORE : {:.5f}".format(entry['best_score']) + '\n')
+      elif 'front_size' in entry:
+        print("FRONT SIZE : " + str(entry['front_size']) + '\n')
+    return survivors, new
+
+  def resume(self):
+    """
+    Restores the population, history, random state and the set of scored
+    molecules from the run log after a crash. Rows logged after the last
+    saved generation are dropped, the generation is run again.
+    :return: (population, generations done), continue with
+             run(population, num_generations - done); (None, 0) if no
+             generation was saved, start again from initial_population.
+    """
+    state = self.run_log.load_state(self.rng)
+    if state is None:
+      return None, 0
+    generation, population, history, _ = state
+    self.history = history
+    self.seen = set(s for s in self.run_log.smiles() if s)
+    return population, generation
+
+  def run(self, population, num_generations=10, callback=None):
+    """
+    :param population: Population, e.g. from initial_population.
+    :param callback: Called with (generation, population) after each one.
+    :return: The final population, best first.
+    """
+    start = time.time()
+    for generation in range(num_generations):
+      population = self.step(population)
+      if callback is not None:
+        callback(generation, population)
+    if self.verbose and num_generations > 0:
+      minutes = (time.time() - start)/60.0
+      print("Generations per minute: {:.2f}".format(num_generations/max(minutes, 1e-9)))
+    return population
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Gradient based optimization of latents through the differentiable IC50
+predictor (ic50mca.IC50_MCA). Instead of one black box predictor call per
+Bayesian optimization iteration, thousands of latents are optimized at
+once: every step is one batched forward and backward pass through the
+predictor for all trajectories.
+
+The latents are kept inside the (-4, 4) box the VAE latents occupy by
+projecting after every step, and can be held near the N(0, I) prior with a
+penalty kl_weight * ||z||^2 / 2, the part of the KL divergence to the prior
+that depends on z. The endpoints are decoded in one batch and the molecules
+re-encoded and scored, since a decoded molecule does not sit exactly at
+the latent it was decoded from.
+"""
+
+import numpy as np
+import tensorflow as tf
+
+import Optimizations.genetic as genetic
+
+NUM_GENES = 2128
+
+def multi_start(Z, num_starts, noise_norm=1.0, rng=np.random, latent_dim=64):
+  """
+  <num_starts> perturbed copies of every row of Z, e.g. of encoded seed
+  molecules. With Z None, starts are drawn from the prior instead.
+  """
+  if Z is None:
+    return rng.normal(size=(num_starts, latent_dim)).astype(np.float32)
+  return genetic.perturb(Z, noise_norm, num_starts, rng)
+
+class GradientOptimizer(object):
+  """
+  :param predictor: IC50_MCA taking (encoded_smiles, genes).
+  :param gene_expressions: One profile [NUM_GENES] or several [G, NUM_GENES]
+                           whose predictions are averaged.
+  :param method: 'adam', or 'pgd' for projected gradient descent with
+                 normalized steps of size learning_rate.
+  :param kl_weight: Weight of the prior penalty.
+  :param bounds: Box the latents are projected into.
+  :param minimize: Lower predictions are better (IC50).
+  """
+  def __init__(self, predictor, gene_expressions, method='adam', learning_rate=0.05,
+               kl_weight=0.0, bounds=(-4.0, 4.0), minimize=True):
+    self.predictor = predictor
+    self.genes = tf.constant(np.asarray(gene_expressions, dtype=np.float32).reshape(-1, NUM_GENES))
+    self.method = method
+    self.learning_rate = learning_rate
+    self.kl_weight = kl_weight
+    self.bounds = bounds
+    self.sign = 1.0 if minimize else -1.0
+
+  def predict(self, z):
+    ## Mean prediction over the profiles for every latent, [N]
+    n, g = tf.shape(z)[0], tf.shape(self.genes)[0]
+    zs = tf.repeat(z, g, axis=0)
+    genes = tf.tile(self.genes, [n, 1])
+    preds = self.predictor(encoded_smiles=zs, genes=genes, training=False)
+    return tf.reduce_mean(tf.reshape(preds, [n, g]), axis=1)
+
+  def objective(self, z):
+    ## Per latent loss, lower is better
+    loss = self.sign*self.predict(z)
+    if self.kl_weight > 0:
+      loss += self.kl_weight*0.5*tf.reduce_sum(tf.square(z), axis=1)
+    return loss
+
+  def run(self, Z0, steps=100, record_every=0, verbose=True):
+    """
+    Optimizes every row of Z0 in parallel.
+    :param record_every: Keep the latents every this many steps (0: never).
+    :return: Dict with the final latents 'Z', their predictions 'scores',
+             the best latents seen along each trajectory 'best_Z' and
+             'best_scores', 'initial_scores' and the 'trajectory'.
+    """
+    z = tf.Variable(np.clip(np.asarray(Z0, dtype=np.float32), *self.bounds))
+    optimizer = tf.keras.optimizers.Adam(learning_rate=self.learning_rate)
+    low, high = self.bounds
+
+    @tf.function
+    def step():
+      with tf.GradientTape() as tape:
+        loss = self.objective(z)
+        ## Trajectories are independent, so the gradient of the sum is the
+        ## gradient of every row's loss
+        total = tf.reduce_sum(loss)
+      grad = tape.gradient(total, z)
+      if self.method == 'adam':
+        optimizer.apply_gradients([(grad, z)])
+      else:
+        norm = tf.norm(grad, axis=1, keepdims=True)
+        z.assign_sub(self.learning_rate*grad/tf.maximum(norm, 1e-12))
+      z.assign(tf.clip_by_value(z, low, high))
+      return loss
+
+    Z0 = z.numpy()
+    best_Z = Z0.copy()
+    best_loss = np.full(len(best_Z), np.inf, dtype=np.float32)
+    trajectory = [Z0.copy()] if record_every else []
+    for i in range(steps):
+      current = z.numpy()
+      ## The loss is of the latents before the step
+      loss = step().numpy()
+      better = loss < best_loss
+      best_Z[better] = current[better]
+      best_loss[better] = loss[better]
+      if record_every and (i + 1) % record_every == 0:
+        trajectory.append(z.numpy())
+      if verbose and i % 50 == 0:
+        print("Step " + str(i) + ", Best = " + \
+              "{:.5f}".format(self.sign*best_loss.min()) + ", Mean = " + \
+              "{:.5f}".format(self.sign*loss.mean()))
+    Z = z.numpy()
+    final = self.objective(z).numpy()
+    better = final < best_loss
+    best_Z[better] = Z[better]
+    ## Scores are the predictions, without the prior penalty
+    return {'Z': Z, 'scores': self.predict(Z).numpy(),
+            'best_Z': best_Z, 'best_scores': self.predict(best_Z).numpy(),
+            'initial_scores': self.predict(Z0).numpy(),
+            'trajectory': trajectory}
+
+def decode_endpoints(model, Z, objective, minimize=True):
+  """
+  Decodes optimized latents in one batch and scores the unique valid
+  molecules at their own (re-encoded) latents.
+  :param model: A Utils.latent_model.LatentModel.
+  :param objective: Function (Z, smiles) -> scores, e.g.
+                    genetic.ic50_objective(model, gene_expression).
+  :return: Population of the decoded molecules, best first.
+  """
+  smiles = model.decode(Z, canonical=True)
+  smiles = np.asarray(smiles, dtype=object)[genetic.unique(smiles)]
+  if len(smiles) == 0:
+    return genetic.Population(np.zeros((0, np.shape(Z)[1])), [], [])
+  Z_new, ok = model.encode(smiles.tolist())
+  Z_new, smiles = Z_new[ok], smiles[ok]
+  population = genetic.Population(Z_new, smiles, objective(Z_new, smiles))
+  return population.take(genetic.top_k(population.scores, len(population), minimize))
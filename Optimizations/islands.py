@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Island model for the latent space GA: K GeneticOptimizer islands, each in
+its own process with its own seed and mutation norm. Every <migration>
+generations each island publishes its best molecules in shared memory and
+takes in those of its neighbour (ring topology). At the end the islands'
+populations are merged into one archive.
+
+Workers are started with 'spawn' since TensorFlow does not survive fork.
+They cannot be handed models, so they are given a setup function, defined
+at module level so that it can be imported by the workers, which builds
+the LatentModel and objective inside each worker, e.g.
+
+  def setup(island):
+    vae = registry.load('selfies', 'ic50vae', VOCAB_SIZE)
+    predictor = registry.load('selfies', 'ic50mca', VOCAB_SIZE)
+    model = latent_model.LatentModel(vae, vocab, vocab_index, 'selfies', 250,
+                                     predictor=predictor)
+    return model, genetic.ic50_objective(model, GENE_EXPRESSION)
+
+The TF intra op threads of every worker are limited to its share of the
+cores, so that the islands' decode, scoring and RDKit work use the whole
+machine without oversubscribing it.
+"""
+
+import os
+import queue
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import Optimizations.genetic as genetic
+import Optimizations.pareto as pareto
+
+SMILES_WIDTH = 256
+
+class MigrationBuffer(object):
+  """
+  One slot per island in a shared memory block, holding up to
+  <num_migrants> latents, scores and SMILES (as fixed width bytes).
+  :param num_objectives: Scores per molecule, above 1 for objective
+                         matrices (selection='nsga2').
+  """
+  def __init__(self, num_islands, num_migrants, latent_dim, name=None, num_objectives=1):
+    self.num_islands = num_islands
+    self.num_migrants = num_migrants
+    self.latent_dim = latent_dim
+    self.num_objectives = num_objectives
+    shapes = self._shapes()
+    size = sum(int(np.prod(shape))*np.dtype(dtype).itemsize for shape, dtype in shapes)
+    if name is None:
+      self.shm = shared_memory.SharedMemory(create=True, size=size)
+    else:
+      self.shm = shared_memory.SharedMemory(name=name)
+    self.name = self.shm.name
+    offset = 0
+    arrays = []
+    for shape, dtype in shapes:
+      arrays.append(np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset))
+      offset += int(np.prod(shape))*np.dtype(dtype).itemsize
+    self.Z, self.scores, self.smiles, self.counts = arrays
+
+  def _shapes(self):
+    k, m = self.num_islands, self.num_migrants
+    scores = (k, m) if self.num_objectives == 1 else (k, m, self.num_objectives)
+    return [((k, m, self.latent_dim), np.float32),
+            (scores, np.float64),
+            ((k, m), 'S{}'.format(SMILES_WIDTH)),
+            ((k,), np.int64)]
+
+  def write(self, island, population):
+    ## Molecules whose SMILES do not fit a slot are not sent
+    encoded = [s.encode() for s in population.smiles]
+    fits = np.flatnonzero([len(e) <= SMILES_WIDTH for e in encoded])[:self.num_migrants]
+    n = len(fits)
+    self.Z[island, :n] = population.Z[fits]
+    self.scores[island, :n] = population.scores[fits]
+    self.smiles[island, :n] = [encoded[i] for i in fits]
+    self.counts[island] = n
+
+  def read(self, island):
+    n = int(self.counts[island])
+    smiles = [s.decode() for s in self.smiles[island, :n]]
+    return genetic.Population(self.Z[island, :n].copy(), smiles, self.scores[island, :n].copy())
+
+  def close(self, unlink=False):
+    ## Drop the views before closing the mapping
+    self.Z = self.scores = self.smiles = self.counts = None
+    self.shm.close()
+    if unlink:
+      self.shm.unlink()
+
+def _run_island(island, setup, smiles, config, buffer_args, barrier, results):
+  threads = config['threads']
+  if threads:
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+  buffer = MigrationBuffer(*buffer_args)
+  try:
+    model, objective = setup(island)
+    ga = genetic.GeneticOptimizer(model, objective, seed=config['seeds'][island],
+                                  mutation_norm=config['mutation_norms'][island],
+                                  verbose=False, **config['ga_kwargs'])
+    population = ga.initial_population(smiles)
+    done = 0
+    while done < config['num_generations']:
+      generations = min(config['migration'], config['num_generations'] - done)
+      population = ga.run(population, generations)
+      done += generations
+      if done >= config['num_generations'] or config['num_islands'] == 1:
+        continue
+      buffer.write(island, population)
+      barrier.wait()
+      incoming = buffer.read((island - 1) % config['num_islands'])
+      ## Nothing may overwrite a slot before its neighbour has read it
+      barrier.wait()
+      keep = genetic.unique(incoming.smiles.tolist(), ga.seen)
+      population = ga.selection(population.concat(incoming.take(keep)), ga.num_out,
+                                minimize=ga.minimize, rng=ga.rng, **ga.selection_kwargs)
+    results.put((island, population.Z, population.smiles.tolist(),
+                 population.scores, ga.history))
+  except Exception as e:
+    ## Release the other islands waiting at the barrier
+    barrier.abort()
+    results.put((island, e))
+  finally:
+    buffer.close()
+
+def merge(populations, num_out=None, minimize=True):
+  """
+  Merges populations into one archive of unique molecules, best first, or
+  in NSGA-II order (fronts first) for objective matrices.
+  """
+  merged = populations[0]
+  for population in populations[1:]:
+    merged = merged.concat(population)
+  num_out = len(merged) if num_out is None else num_out
+  if merged.scores.ndim > 1:
+    merged = merged.take(genetic.unique(merged.smiles.tolist()))
+    F = merged.scores if minimize else -merged.scores
+    return merged.take(pareto.nsga2_order(F, num_out))
+  merged = merged.take(genetic.top_k(merged.scores, len(merged), minimize))
+  merged = merged.take(genetic.unique(merged.smiles.tolist()))
+  return merged.take(np.arange(min(num_out, len(merged))))
+
+def _collect(workers, results, barrier, poll=1.0):
+  ## One result per island. Exceptions come through the queue, but an
+  ## island killed by a signal (OOM killer, segfault) never reports, and the
+  ## others would wait for it at the barrier
+  outputs, reported = [], set()
+  while len(outputs) < len(workers):
+    try:
+      output = results.get(timeout=poll)
+    except queue.Empty:
+      for island, w in enumerate(workers):
+        if island not in reported and w.exitcode not in (None, 0):
+          barrier.abort()
+          raise RuntimeError('Island {} died with exit code {}'.format(island, w.exitcode))
+      continue
+    outputs.append(output)
+    reported.add(output[0])
+  return outputs
+
+def run_islands(setup, smiles, latent_dim, num_generations=10, num_islands=None,
+                migration=2, num_migrants=10, mutation_norms=None, seed=0,
+                minimize=True, archive_size=None, num_objectives=1, **ga_kwargs):
+  """
+  Runs the island GA.
+  :param setup: Module level function island -> (LatentModel, objective).
+  :param smiles: Starting molecules, given to every island.
+  :param num_islands: Number of worker processes, defaults to the cores.
+  :param migration: Generations between migrations.
+  :param num_migrants: Molecules each island sends per migration.
+  :param mutation_norms: Mutation norm per island, spread over [5, 15] by
+                         default so the islands explore at different scales.
+  :param num_objectives: Columns of the objective matrix with
+                         selection='nsga2'.
+  :param ga_kwargs: Further GeneticOptimizer arguments (num_out,
+                    num_children, decode_attempts, selection, ...).
+  :return: (archive, island_populations, histories)
+  """
+  num_islands = num_islands or os.cpu_count()
+  if mutation_norms is None:
+    mutation_norms = np.linspace(5.0, 15.0, num_islands).tolist()
+  ga_kwargs['minimize'] = minimize
+  config = {'num_islands': num_islands,
+            'num_generations': num_generations,
+            'migration': migration,
+            'seeds': [seed + i for i in range(num_islands)],
+            'mutation_norms': mutation_norms,
+            'threads': max(1, (os.cpu_count() or 1)//num_islands),
+            'ga_kwargs': ga_kwargs}
+
+  ctx = multiprocessing.get_context('spawn')
+  buffer = MigrationBuffer(num_islands, num_migrants, latent_dim, num_objectives=num_objectives)
+  barrier = ctx.Barrier(num_islands)
+  results = ctx.Queue()
+  buffer_args = (num_islands, num_migrants, latent_dim, buffer.name, num_objectives)
+  workers = [ctx.Process(target=_run_island,
+                         args=(i, setup, list(smiles), config, buffer_args, barrier, results))
+             for i in range(num_islands)]
+  try:
+    for w in workers:
+      w.start()
+    outputs = _collect(workers, results, barrier)
+    for w in workers:
+      w.join()
+  finally:
+    ## After a failure the islands still running are stopped
+    for w in workers:
+      if w.is_alive():
+        w.terminate()
+        w.join()
+    buffer.close(unlink=True)
+
+  populations, histories = [None]*num_islands, [None]*num_islands
+  for output in outputs:
+    if isinstance(output[1], Exception):
+      raise RuntimeError('Island {} failed: {!r}'.format(output[0], output[1]))
+    island, Z, island_smiles, scores, history = output
+    populations[island] = genetic.Population(Z, island_smiles, scores)
+    histories[island] = history
+  archive = merge(populations, archive_size, minimize)
+  return archive, populations, histories
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-objective optimization of molecules: predicted IC50 (one cell line or
+a panel), QED, SA and logP at once, instead of the notebook's scalarized
+5 * QED - SAS and separate IC50 and QED/SA GA runs.
+
+Scores are an objective matrix F [N, M] in which every column is minimized
+(objectives to maximize are negated by stack_objectives). Selection is
+NSGA-II: fast non-dominated sorting into fronts, then crowding distance
+within the last front that fits, both vectorized over the matrix. A
+ParetoArchive keeps every non-dominated molecule seen during a run, so one
+run gives the whole trade-off front.
+
+Use with the GA as
+  objective, names = stack_objectives([('ic50', genetic.ic50_objective(model, genes), True),
+                                       ('qed', property_objective('qed'), False),
+                                       ('sa', property_objective('sa'), True)])
+  archive = ParetoArchive()
+  ga = genetic.GeneticOptimizer(model, objective, selection='nsga2', archive=archive)
+"""
+
+import numpy as np
+
+import Utils.proc_chem as proc_chem
+
+def _properties(smiles, names):
+  import rdkit.Chem.QED as QED
+  import rdkit.Chem.Crippen as Crippen
+  functions = {'qed': QED.qed, 'sa': proc_chem.sa_score, 'logp': Crippen.MolLogP}
+  out = np.full((len(smiles), len(names)), np.nan)
+  for i, s in enumerate(smiles):
+    ## One parse per molecule for all properties
+    m = proc_chem.rkc.MolFromSmiles(s) if s else None
+    if m is None:
+      continue
+    out[i] = [functions[name](m) for name in names]
+  return out
+
+def property_objective(*names):
+  """
+  RDKit properties 'qed', 'sa' and / or 'logp' of the SMILES, [N, len(names)].
+  """
+  def objective(Z, smiles):
+    return _properties(smiles, names)
+  return objective
+
+def ic50_panel_objective(model, gene_expressions):
+  """
+  Predicted IC50 against every profile of a panel as its own objective,
+  [N, G], from one batched predictor call per batch of pairs.
+  :param model: A Utils.latent_model.LatentModel with a predictor.
+  """
+  def objective(Z, smiles):
+    return model.predict(Z, gene_expressions, average=False)
+  return objective
+
+def stack_objectives(objectives):
+  """
+  Stacks objectives into one that returns the matrix F [N, M] to minimize.
+  :param objectives: List of (name, function (Z, smiles) -> [N] or [N, k],
+                     minimize). Columns of maximized objectives are negated.
+  :return: (objective, column names)
+  """
+  names = [name for name, _, _ in objectives]
+  def objective(Z, smiles):
+    columns = []
+    for name, function, minimize in objectives:
+      values = np.asarray(function(Z, smiles), dtype=np.float64).reshape(len(smiles), -1)
+      columns.append(values if minimize else -values)
+    return np.concatenate(columns, axis=1)
+  return objective, names
+
+def _clean(F):
+  ## Failed scores (NaN) are worse than anything
+  F = np.asarray(F, dtype=np.float64)
+  return np.where(np.isnan(F), np.inf, F)
+
+def dominates(A, B, chunk_size=1024):
+  """
+  Boolean matrix [len(A), len(B)], True where row i of A Pareto dominates
+  row j of B: no worse in every objective and better in one. Built in chunks
+  of rows of A to bound the [chunk, len(B), M] intermediates.
+  """
+  A, B = _clean(A), _clean(B)
+  out = np.empty((len(A), len(B)), dtype=bool)
+  for i in range(0, len(A), chunk_size):
+    a = A[i:i + chunk_size, None, :]
+    out[i:i + chunk_size] = np.all(a <= B[None], axis=2) & np.any(a < B[None], axis=2)
+  return out
+
+def non_dominated_sort(F, max_count=None):
+  """
+  Fast non-dominated sort.
+  :param max_count: Stop once the fronts found hold this many rows.
+  :return: List of index arrays, the Pareto front first.
+  """
+  dom = dominates(F, F)
+  counts = dom.sum(axis=0)
+  remaining = np.ones(len(counts), dtype=bool)
+  fronts, found = [], 0
+  while remaining.any():
+    front = np.flatnonzero(remaining & (counts == 0))
+    fronts.append(front)
+    found += len(front)
+    if max_count is not None and found >= max_count:
+      break
+    remaining[front] = False
+    counts = counts - dom[front].sum(axis=0)
+  return fronts
+
+def crowding_distance(F):
+  """
+  NSGA-II crowding distance of every row of F; the extremes of every
+  objective get inf.
+  """
+  F = _clean(F)
+  n, m = F.shape
+  if n <= 2:
+    return np.full(n, np.inf)
+  order = np.argsort(F, axis=0, kind='stable')
+  ordered = np.take_along_axis(F, order, axis=0)
+  span = ordered[-1] - ordered[0]
+  span = np.where(np.isfinite(span) & (span > 0), span, np.inf)
+  gaps = np.zeros((n, m))
+  np.put_along_axis(gaps, order[1:-1], (ordered[2:] - ordered[:-2])/span, axis=0)
+  np.put_along_axis(gaps, order[[0, -1]], np.inf, axis=0)
+  return np.where(np.isnan(gaps), 0.0, gaps).sum(axis=1)
+
+def nsga2_order(F, num_out):
+  """
+  Indices of the num_out rows NSGA-II keeps: whole fronts while they fit,
+  then the most spread out rows of the next front.
+  """
+  chosen = []
+  for front in non_dominated_sort(F, num_out):
+    if len(chosen) + len(front) <= num_out:
+      chosen.extend(front.tolist())
+      continue
+    distance = crowding_distance(F[front])
+    keep = np.argsort(-distance, kind='stable')[:num_out - len(chosen)]
+    chosen.extend(front[keep].tolist())
+    break
+  return np.array(chosen, dtype=np.int64)
+
+def select_nsga2(population, num_out, minimize=True, rng=np.random, **kwargs):
+  """
+  GA selection on objective matrices, population.scores [N, M].
+  """
+  F = population.scores if minimize else -population.scores
+  return population.take(nsga2_order(F.reshape(len(population), -1), num_out))
+
+class ParetoArchive(object):
+  """
+  Every non-dominated molecule seen so far, updated incrementally: new
+  molecules dominated by the archive are dropped and archive members they
+  dominate are removed, without re-sorting the whole history.
+  :param max_size: Keep at most this many, dropping the most crowded.
+  :param minimize: Lower scores are better; False to keep the front of
+                   maximized scores (e.g. trad_objective).
+  """
+  def __init__(self, max_size=None, minimize=True):
+    self.max_size = max_size
+    self.minimize = minimize
+    self.population = None
+
+  def _objectives(self, population):
+    F = population.scores.reshape(len(population), -1)
+    return F if self.minimize else -F
+
+  def __len__(self):
+    return 0 if self.population is None else len(self.population)
+
+  def add(self, population):
+    if len(population) == 0:
+      return self
+    F = self._objectives(population)
+    ## The front of the new molecules alone
+    new = population.take(non_dominated_sort(F, 1)[0])
+    if self.population is not None and len(self.population) > 0:
+      old = self.population
+      F_old = self._objectives(old)
+      F_new = self._objectives(new)
+      new = new.take(np.flatnonzero(~dominates(F_old, F_new).any(axis=0)))
+      old = old.take(np.flatnonzero(~dominates(F_new, F_old).any(axis=0)))
+      new = old.concat(new)
+    if self.max_size is not None and len(new) > self.max_size:
+      distance = crowding_distance(self._objectives(new))
+      new = new.take(np.argsort(-distance, kind='stable')[:self.max_size])
+    self.population = new
+    return self
+
+  def front(self):
+    """
+    The archive as a Population (scores [N, M], as given to add).
+    """
+    return self.population
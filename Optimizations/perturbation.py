@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Sampling the molecules around latents, as smile_to_smiles_percentage does,
+without decoding more than the neighbourhood is worth.
+
+smile_to_smiles_percentage builds decode_attempts perturbations one
+perturb_z call at a time and decodes all of them, even when the first few
+dozen already gave every molecule the neighbourhood holds. Here the
+perturbations of all latents are drawn in one call (genetic.perturb) and,
+in adaptive mode, decoded in chunks of <chunk_size> per latent, batched
+over all latents still sampling:
+  - a latent stops once a chunk yields fewer than min_yield new unique
+    valid molecules per attempt, or after decode_attempts,
+  - with target_validity, its noise norm is scaled after every chunk by
+    exp(adapt_rate * (validity - target_validity)), growing while most
+    perturbations decode to valid molecules and shrinking when few do.
+"""
+
+import numpy as np
+
+import Optimizations.genetic as genetic
+
+def smile_to_smiles_percentage(model, z, noise_norm, decode_attempts=256, rng=np.random):
+  """
+  The notebook helper without the loop: the valid SMILES decoded from
+  decode_attempts perturbations of z, in one batch.
+  :param model: A Utils.latent_model.LatentModel.
+  """
+  Z = genetic.perturb(np.reshape(z, (1, -1)), noise_norm, decode_attempts, rng)
+  return [s for s in model.decode(Z) if s is not None]
+
+def neighbourhood(model, Z, noise_norm, decode_attempts=256, chunk_size=32,
+                  min_yield=0.05, target_validity=None, adapt_rate=1.0,
+                  norm_bounds=(0.01, 50.0), rng=np.random):
+  """
+  Adaptive sampling of the unique valid molecules around every row of Z.
+  :param noise_norm: Starting norm, one or one per row.
+  :param decode_attempts: Most perturbations decoded per latent.
+  :param chunk_size: Perturbations per latent decoded per round.
+  :param min_yield: Stop a latent when a chunk gives fewer new molecules
+                    per attempt (0: always use decode_attempts).
+  :param target_validity: Adapt the norm toward this fraction of valid
+                          decodes (None: keep the norm).
+  :return: (smiles, stats). smiles[i] lists the unique canonical SMILES
+           found around Z[i]; stats holds per latent 'attempts', 'valid',
+           and the final 'norms'.
+  """
+  Z = np.asarray(Z, dtype=np.float32).reshape(len(Z), -1)
+  norms = np.broadcast_to(np.asarray(noise_norm, dtype=np.float64), (len(Z),)).copy()
+  found = [[] for _ in range(len(Z))]
+  seen = [set() for _ in range(len(Z))]
+  attempts = np.zeros(len(Z), dtype=np.int64)
+  valid = np.zeros(len(Z), dtype=np.int64)
+  active = np.ones(len(Z), dtype=bool)
+  while active.any():
+    rows = np.flatnonzero(active)
+    num = int(min(chunk_size, decode_attempts - attempts[rows].min()))
+    decoded = model.decode(genetic.perturb(Z[rows], norms[rows], num, rng), canonical=True)
+    chunk_valid = np.zeros(len(rows), dtype=np.int64)
+    chunk_new = np.zeros(len(rows), dtype=np.int64)
+    for k, row in enumerate(rows):
+      for s in decoded[k*num:(k + 1)*num]:
+        if s is None:
+          continue
+        chunk_valid[k] += 1
+        if s not in seen[row]:
+          seen[row].add(s)
+          found[row].append(s)
+          chunk_new[k] += 1
+    attempts[rows] += num
+    valid[rows] += chunk_valid
+    if target_validity is not None:
+      validity = chunk_valid/float(num)
+      norms[rows] = np.clip(norms[rows]*np.exp(adapt_rate*(validity - target_validity)),
+                            *norm_bounds)
+    done = (chunk_new < min_yield*num) | (attempts[rows] >= decode_attempts)
+    active[rows[done]] = False
+  return found, {'attempts': attempts, 'valid': valid, 'norms': norms}
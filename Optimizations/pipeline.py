@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Pipelined evaluation of latents: decode -> validate -> encode and score.
+Run in sequence, as in smile_to_smiles_percentage, the model waits while
+RDKit parses and the other way round. Here
+  - a thread decodes chunks of latents with the TF decoder,
+  - a process pool turns the decoded strings into canonical SMILES
+    (SELFIES / DeepSMILES decoding and RDKit sanitization),
+  - the calling thread re-encodes and scores the new molecules of every
+    chunk as soon as it has been validated,
+with bounded queues between the stages so that a slow stage holds the
+others back instead of piling up work in memory.
+
+Use with the GA as GeneticOptimizer(..., pipeline=Pipeline(model, objective)).
+"""
+
+import time
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import Utils.tokenization as tokenization
+import Utils.proc_chem as proc_chem
+import Optimizations.genetic as genetic
+
+def _validate(strings, representation):
+  ## Runs in the worker processes
+  start = time.perf_counter()
+  smiles = tokenization.strings_to_smiles(strings, representation)
+  smiles = [proc_chem.canonical_smiles(s) if s else None for s in smiles]
+  return smiles, time.perf_counter() - start
+
+class Pipeline(object):
+  """
+  :param model: A Utils.latent_model.LatentModel.
+  :param objective: Function (Z, smiles) -> scores.
+  :param num_workers: Validation processes, defaults to the cores.
+  :param chunk_size: Latents decoded per chunk.
+  :param queue_size: Chunks that may wait between stages.
+  """
+  def __init__(self, model, objective, num_workers=None, chunk_size=1024,
+               queue_size=4):
+    self.model = model
+    self.objective = objective
+    self.chunk_size = chunk_size
+    self.queue_size = queue_size
+    self.pool = ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context('spawn'))
+    self.num_workers = self.pool._max_workers
+    self.stats = None
+    self.rows = None
+
+  def close(self):
+    self.pool.shutdown()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def _produce(self, Z, pending, busy, stop, errors):
+    try:
+      for i in range(0, len(Z), self.chunk_size):
+        start = time.perf_counter()
+        strings = self.model.decode_strings(Z[i:i + self.chunk_size])
+        busy['decode'] += time.perf_counter() - start
+        future = self.pool.submit(_validate, strings, self.model.representation)
+        while not stop.is_set():
+          try:
+            pending.put(future, timeout=0.1)
+            break
+          except queue.Full:
+            continue
+        if stop.is_set():
+          return
+    except Exception as e:
+      errors.append(e)
+    finally:
+      while not stop.is_set():
+        try:
+          pending.put(None, timeout=0.1)
+          break
+        except queue.Full:
+          continue
+
+  def run(self, Z, seen=None):
+    """
+    Decodes, validates, encodes and scores latents Z.
+    :param seen: Set of canonical SMILES that are not scored again; updated.
+    :return: Population of the new valid molecules; the rows of Z they were
+             decoded from are left in self.rows.
+    """
+    seen = set() if seen is None else seen
+    busy = {'decode': 0.0, 'validate': 0.0, 'score': 0.0}
+    pending = queue.Queue(maxsize=self.queue_size)
+    stop = threading.Event()
+    errors = []
+    wall = time.perf_counter()
+    producer = threading.Thread(target=self._produce, args=(Z, pending, busy, stop, errors),
+                                daemon=True)
+    producer.start()
+
+    parts, rows = [], []
+    decoded = 0
+    try:
+      while True:
+        future = pending.get()
+        if future is None:
+          break
+        smiles, seconds = future.result()
+        busy['validate'] += seconds
+        ## Chunks arrive in order, so the chunk starts at row <decoded>
+        keep = genetic.unique(smiles, seen, update=False)
+        new = np.asarray(smiles, dtype=object)[keep]
+        keep += decoded
+        decoded += len(smiles)
+        if len(new) == 0:
+          continue
+        start = time.perf_counter()
+        Z_new, ok = self.model.encode(new.tolist())
+        Z_new, new = Z_new[ok], new[ok]
+        ## Seen once encoded, a failed encode can be decoded again later
+        seen.update(new)
+        rows.append(keep[ok])
+        parts.append(genetic.Population(Z_new, new, self.objective(Z_new, new)))
+        busy['score'] += time.perf_counter() - start
+    finally:
+      stop.set()
+      producer.join()
+    if errors:
+      raise errors[0]
+
+    wall = time.perf_counter() - wall
+    self.stats = {'wall': wall, 'decoded': decoded,
+                  'new': sum(len(p) for p in parts),
+                  'decode_utilization': busy['decode']/wall,
+                  'validate_utilization': busy['validate']/(wall*self.num_workers),
+                  'score_utilization': busy['score']/wall}
+    self.rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+    if len(parts) == 0:
+      return genetic.Population(np.zeros((0, Z.shape[1])), [], [])
+    population = parts[0]
+    for part in parts[1:]:
+      population = population.concat(part)
+    return population
+
+  def report(self):
+    s = self.stats
+    return ("Utilization: decode {:.2f}, validate {:.2f} ({} workers), score {:.2f} "
+            "over {:.1f}s".format(s['decode_utilization'], s['validate_utilization'],
+                                  self.num_workers, s['score_utilization'], s['wall']))
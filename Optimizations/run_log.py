@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""
+Append-only log of every candidate an optimizer evaluates, and the state
+needed to resume the run, so a kernel crash no longer loses the decoding
+and scoring done so far.
+
+The log is columnar. Rows are buffered and written <batch_size> at a time
+as a part directory of .npy files:
+  id.npy          int64 [n]       row id, counting from 0 over the run
+  generation.npy  int32 [n]       generation (GA) or round (BO)
+  parent.npy      int64 [n, 2]    ids of the parents, -1 for none
+  Z.npy           float32 [n, D]  latents
+  scores.npy      float64 [n] or [n, M]
+  smiles.npy      uint8           UTF-8 SMILES back to back
+  offsets.npy     int64 [n + 1]   where each SMILES starts in smiles.npy
+A part is written under a temporary name and renamed when complete, so a
+crash leaves no half written part. Readers memory map the columns part by
+part (scan, top_k) and never need the whole log in memory.
+
+save_state() writes the resume state (population, random state, history)
+atomically next to the log; GeneticOptimizer and BayesianOptimizer take a
+RunLog and call it every generation. Parts can be flushed between two
+saves, so load_state() cuts the log back to the rows it held at the last
+save: the generation that was running is redone from the restored random
+state and logged again, not twice.
+"""
+
+import os
+import glob
+import json
+import shutil
+
+import numpy as np
+
+import Optimizations.genetic as genetic
+
+COLUMNS = ('id', 'generation', 'parent', 'Z', 'scores')
+STATE_FILE = 'state'
+
+def _encode_smiles(smiles):
+  encoded = [(s or '').encode() for s in smiles]
+  offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+  offsets[1:] = np.cumsum([len(e) for e in encoded])
+  data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+  return data, offsets
+
+def _decode_smiles(data, offsets, idx=None):
+  idx = range(len(offsets) - 1) if idx is None else idx
+  return [bytes(data[offsets[i]:offsets[i + 1]]).decode() or None for i in idx]
+
+def _rng_array(name):
+  ## The optimizer's own random state is saved under the unnamed key
+  return 'rng_keys_' + name if name else 'rng_keys'
+
+class RunLog(object):
+  """
+  :param directory: Directory of the log, created if needed; an existing
+                    log is appended to.
+  :param batch_size: Rows buffered before a part is written.
+  """
+  def __init__(self, directory, batch_size=10000):
+    self.directory = directory
+    self.batch_size = batch_size
+    os.makedirs(directory, exist_ok=True)
+    parts = self.parts()
+    self.num_parts = len(parts)
+    self.num_rows = 0
+    for part in parts:
+      self.num_rows += len(np.load(os.path.join(part, 'id.npy'), mmap_mode='r'))
+    self._buffer = []
+    self._buffered = 0
+    self._ids = None
+
+  def __len__(self):
+    return self.num_rows + self._buffered
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.flush()
+
+  def parts(self):
+    return sorted(glob.glob(os.path.join(self.directory, 'part-[0-9]*[0-9]')))
+
+  def append(self, Z, smiles, scores, generation, parents=None):
+    """
+    Logs evaluated candidates.
+    :param parents: Parent ids [n] or [n, 2], -1 for none.
+    :return: The ids of the new rows.
+    """
+    n = len(smiles)
+    ids = np.arange(len(self), len(self) + n, dtype=np.int64)
+    if n == 0:
+      return ids
+    if parents is None:
+      parents = np.full((n, 2), -1, dtype=np.int64)
+    parents = np.asarray(parents, dtype=np.int64).reshape(n, -1)
+    if parents.shape[1] == 1:
+      parents = np.concatenate([parents, np.full((n, 1), -1, dtype=np.int64)], axis=1)
+    self._buffer.append({'id': ids,
+                         'generation': np.full(n, generation, dtype=np.int32),
+                         'parent': parents,
+                         'Z': np.asarray(Z, dtype=np.float32).reshape(n, -1),
+                         'scores': np.asarray(scores, dtype=np.float64),
+                         'smiles': list(smiles)})
+    self._buffered += n
+    if self._ids is not None:
+      for i, s in zip(ids, smiles):
+        if s:
+          self._ids[s] = int(i)
+    if self._buffered >= self.batch_size:
+      self.flush()
+    return ids
+
+  def flush(self):
+    """
+    Writes the buffered rows as one part.
+    """
+    if self._buffered == 0:
+      return
+    columns = {c: np.concatenate([b[c] for b in self._buffer]) for c in COLUMNS}
+    data, offsets = _encode_smiles([s for b in self._buffer for s in b['smiles']])
+    columns['smiles'], columns['offsets'] = data, offsets
+    part = os.path.join(self.directory, 'part-{:06d}'.format(self.num_parts))
+    tmp = part + '.tmp'
+    os.makedirs(tmp, exist_ok=True)
+    for name, values in columns.items():
+      np.save(os.path.join(tmp, name + '.npy'), values)
+    os.rename(tmp, part)
+    self.num_parts += 1
+    self.num_rows += self._buffered
+    self._buffer = []
+    self._buffered = 0
+
+  def truncate(self, num_rows):
+    """
+    Drops the buffered rows and every logged row from id <num_rows> on.
+    """
+    self._buffer = []
+    self._buffered = 0
+    self._ids = None
+    start = 0
+    for index, part in enumerate(self.parts()):
+      n = len(np.load(os.path.join(part, 'id.npy'), mmap_mode='r'))
+      if start + n > num_rows:
+        if start >= num_rows:
+          shutil.rmtree(part)
+        else:
+          self._cut_part(part, num_rows - start)
+      start += n
+    self.num_parts = len(self.parts())
+    self.num_rows = min(self.num_rows, num_rows)
+
+  def _cut_part(self, part, n):
+    ## Rewritten under a temporary name and swapped in, as flush
+    columns = {c: np.load(os.path.join(part, c + '.npy'))[:n] for c in COLUMNS}
+    offsets = np.load(os.path.join(part, 'offsets.npy'))[:n + 1]
+    columns['smiles'] = np.load(os.path.join(part, 'smiles.npy'))[:offsets[-1]]
+    columns['offsets'] = offsets
+    tmp, old = part + '.tmp', part + '.old'
+    os.makedirs(tmp, exist_ok=True)
+    for name, values in columns.items():
+      np.save(os.path.join(tmp, name + '.npy'), values)
+    os.rename(part, old)
+    os.rename(tmp, part)
+    shutil.rmtree(old)
+
+  def scan(self, columns=COLUMNS, smiles=False):
+    """
+    Yields one dict of memory mapped columns per part (flushed rows only),
+    with a list under 'smiles' if asked for.
+    """
+    for part in self.parts():
+      out = {c: np.load(os.path.join(part, c + '.npy'), mmap_mode='r') for c in columns}
+      if smiles:
+        out['smiles'] = _decode_smiles(np.load(os.path.join(part, 'smiles.npy'), mmap_mode='r'),
+                                       np.load(os.path.join(part, 'offsets.npy')))
+      yield out
+
+  def smiles(self):
+    """
+    Every logged SMILES, None for candidates without one.
+    """
+    self.flush()
+    return [s for part in self.scan(columns=(), smiles=True) for s in part['smiles']]
+
+  def id_of(self, smiles):
+    """
+    Log ids of SMILES, -1 for unknown ones.
+    """
+    if self._ids is None:
+      self.flush()
+      self._ids = {s: i for i, s in enumerate(self.smiles()) if s}
+    return np.array([self._ids.get(s, -1) if s else -1 for s in smiles], dtype=np.int64)
+
+  def top_k(self, k, minimize=True, column=0):
+    """
+    The k best logged candidates, streamed part by part.
+    :param column: Objective to rank on when the scores are a matrix.
+    :return: Dict with 'id', 'generation', 'Z', 'scores' and 'smiles', best
+             first.
+    """
+    self.flush()
+    best = None
+    for part in self.parts():
+      scores = np.load(os.path.join(part, 'scores.npy'), mmap_mode='r')
+      keys = scores if scores.ndim == 1 else scores[:, column]
+      idx = np.sort(genetic.top_k(keys, k, minimize))
+      offsets = np.load(os.path.join(part, 'offsets.npy'))
+      rows = {c: np.asarray(np.load(os.path.join(part, c + '.npy'), mmap_mode='r')[idx])
+              for c in ('id', 'generation', 'Z', 'scores')}
+      rows['smiles'] = np.asarray(_decode_smiles(np.load(os.path.join(part, 'smiles.npy'),
+                                                         mmap_mode='r'), offsets, idx),
+                                  dtype=object)
+      rows['keys'] = np.asarray(keys[idx])
+      if best is not None:
+        rows = {c: np.concatenate([best[c], rows[c]]) for c in rows}
+      keep = genetic.top_k(rows['keys'], k, minimize)
+      best = {c: v[keep] for c, v in rows.items()}
+    if best is not None:
+      best.pop('keys')
+    return best
+
+  def save_state(self, generation, population=None, rng=None, history=None, extra=None,
+                 rngs=None):
+    """
+    Flushes the log and atomically writes the state to resume from.
+    :param rngs: Further named RandomStates, e.g. the surrogate's.
+    """
+    self.flush()
+    arrays = {}
+    if population is not None:
+      data, offsets = _encode_smiles(population.smiles)
+      arrays.update({'Z': population.Z, 'scores': population.scores,
+                     'smiles': data, 'offsets': offsets})
+    meta = {'generation': generation, 'num_rows': self.num_rows,
+            'history': history or [], 'extra': extra or {}}
+    named = dict(rngs or {})
+    if rng is not None:
+      named[''] = rng
+    meta['rngs'] = {}
+    for key, generator in named.items():
+      _, keys, pos, has_gauss, cached_gaussian = generator.get_state()
+      arrays[_rng_array(key)] = keys
+      meta['rngs'][key] = [int(pos), int(has_gauss), float(cached_gaussian)]
+    path = os.path.join(self.directory, STATE_FILE)
+    np.savez(path + '.tmp.npz', **arrays)
+    with open(path + '.tmp.json', 'w') as f:
+      json.dump(meta, f)
+    os.replace(path + '.tmp.npz', path + '.npz')
+    os.replace(path + '.tmp.json', path + '.json')
+
+  def load_state(self, rng=None, rngs=None, truncate=True):
+    """
+    :param truncate: Cut the log back to the rows of the saved state (all of
+                     them if no state was saved), for resuming.
+    :return: (generation, population or None, history, extra), or None if
+             no state was saved. <rng> and <rngs> are restored in place.
+    """
+    path = os.path.join(self.directory, STATE_FILE)
+    if not os.path.exists(path + '.json'):
+      if truncate:
+        self.truncate(0)
+      return None
+    with open(path + '.json') as f:
+      meta = json.load(f)
+    if truncate:
+      self.truncate(meta['num_rows'])
+    arrays = np.load(path + '.npz')
+    population = None
+    if 'Z' in arrays:
+      population = genetic.Population(arrays['Z'], _decode_smiles(arrays['smiles'], arrays['offsets']),
+                                      arrays['scores'])
+    named = dict(rngs or {})
+    if rng is not None:
+      named[''] = rng
+    for key, generator in named.items():
+      if key in meta['rngs']:
+        pos, has_gauss, cached_gaussian = meta['rngs'][key]
+        generator.set_state(('MT19937', arrays[_rng_array(key)], pos, has_gauss, cached_gaussian))
+    return meta['generation'], population, meta['history'], meta['extra']
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Length bucketed batching for the models that do not need a fixed sequence
+length. Every tokenized molecule is padded to PAD_SIZE (250 for SELFIES and
+DeepSMILES, 160 for SMILES) but most ChEMBL molecules are far shorter. The
+batcher groups molecules of similar length and trims each batch to the
+upper boundary of its bucket.
+
+Only causal models can be trained this way: CHAR_TCN / stcn.TCN (causal
+convolutions) and the LSTM decoders of the VAEs, whose outputs for the
+first L positions do not depend on later positions. The conv encoders
+flatten a fixed length input and the Transformer decoder attends over all
+positions, so they still see the full padded width. The padded positions
+that are trimmed away carry label 0 and are masked out by
+softmax_logits_loss_with_pad, so the loss of a trimmed batch is the same as
+the loss of the full width batch.
+
+Usage in a VAE training loop (encoder on the full width, decoder trimmed):
+
+  batcher = bucketing.BucketBatcher(train_X, BATCH_SIZE)
+  print(batcher.padding_report())
+  indxs = np.arange(len(batcher))
+  np.random.shuffle(indxs)
+  for batch in range(len(batcher)):
+    X_batch, length = batcher.batch(indxs[batch], trim=False)
+    z_mean, z_log_var, x_decoded = vae(X_batch[:,:-1], length=length-1)
+    loss_op = vae.vae_loss(labels=X_batch[:,1:length], ...)
+"""
+
+import numpy as np
+
+def sequence_lengths(X, pad_index=0):
+  """
+  Returns the number of tokens up to and including the last non padding
+  token of every row.
+  :param X: Integer array of shape [N, PAD_SIZE].
+  :param pad_index: Index of the <PAD> token.
+  :return: Integer array of shape [N].
+  """
+  X = np.asarray(X)
+  nonpad = X != pad_index
+  last = X.shape[1] - np.argmax(nonpad[:, ::-1], axis=1)
+  return np.where(nonpad.any(axis=1), last, 0)
+
+def bucket_boundaries(lengths, num_buckets=8, multiple=8, max_len=None):
+  """
+  Chooses bucket upper boundaries at quantiles of the length distribution
+  so that buckets hold roughly the same number of molecules.
+  :param lengths: Sequence lengths as returned by sequence_lengths.
+  :param num_buckets: Maximum number of buckets.
+  :param multiple: Boundaries are rounded up to a multiple of this, which
+                   keeps the number of distinct shapes (and retraces) small.
+  :param max_len: Boundaries never exceed this (the padded width).
+  :return: Sorted integer array of boundaries.
+  """
+  lengths = np.asarray(lengths)
+  quantiles = np.quantile(lengths, np.linspace(0, 1, num_buckets + 1)[1:])
+  boundaries = np.ceil(quantiles / multiple).astype(np.int64) * multiple
+  if max_len is not None:
+    boundaries = np.minimum(boundaries, max_len)
+  return np.unique(np.maximum(boundaries, 1))
+
+def wasted_token_fraction(lengths, padded_lengths):
+  """
+  Fraction of the processed tokens that are padding.
+  :param lengths: True length of each sequence.
+  :param padded_lengths: Length each sequence was padded to.
+  """
+  padded = float(np.sum(padded_lengths))
+  if padded == 0:
+    return 0.0
+  return 1.0 - float(np.sum(lengths)) / padded
+
+class BucketBatcher(object):
+  """
+  Splits a padded token matrix into batches of molecules of similar length.
+  Like the training loops, batch membership is fixed and only the order of
+  the batches is shuffled each epoch, so a shuffled np.arange(len(batcher))
+  is all the state a checkpoint has to hold.
+  :param X: Integer array of shape [N, PAD_SIZE].
+  :param batch_size: Molecules per batch.
+  :param boundaries: Bucket upper boundaries, chosen from the length
+                     distribution when not given.
+  :param num_buckets: Number of buckets when boundaries are not given.
+  :param drop_remainder: Drop the last partial batch of every bucket. The
+                         dropped molecules would be the same every epoch,
+                         so partial batches are kept by default.
+  :param seed: Seed for the one-off shuffle within buckets.
+  """
+  def __init__(self, X, batch_size, boundaries=None, num_buckets=8,
+               pad_index=0, drop_remainder=False, seed=0):
+    self.X = X
+    self.batch_size = batch_size
+    self.lengths = sequence_lengths(X, pad_index)
+    if boundaries is None:
+      boundaries = bucket_boundaries(self.lengths, num_buckets, max_len=X.shape[1])
+    self.boundaries = np.asarray(boundaries)
+    if self.boundaries[-1] < self.lengths.max():
+      raise ValueError('Largest bucket boundary {} is shorter than the longest sequence {}'
+                       .format(self.boundaries[-1], self.lengths.max()))
+
+    rng = np.random.RandomState(seed)
+    bucket_ids = np.searchsorted(self.boundaries, self.lengths)
+    self.indices = []
+    self.batch_lengths = []
+    for b, boundary in enumerate(self.boundaries):
+      members = np.flatnonzero(bucket_ids == b)
+      rng.shuffle(members)
+      stop = len(members) - len(members) % batch_size if drop_remainder else len(members)
+      for start in range(0, stop, batch_size):
+        self.indices.append(np.sort(members[start:start + batch_size]))
+        self.batch_lengths.append(int(boundary))
+
+  def __len__(self):
+    return len(self.indices)
+
+  def batch(self, i, trim=True):
+    """
+    Returns batch <i> and the width it is padded to.
+    :param trim: If False the rows keep their full padded width, for
+                 models whose encoder needs it.
+    """
+    length = self.batch_lengths[i]
+    X_batch = self.X[self.indices[i]]
+    if trim:
+      X_batch = X_batch[:, :length]
+    return X_batch, length
+
+  def __getitem__(self, i):
+    return self.batch(i)
+
+  def padding_report(self):
+    """
+    Compares the fraction of padding tokens processed per epoch when padding
+    to the full width and when padding to the bucket boundaries.
+    """
+    if len(self.indices) == 0:
+      return {'batches': 0, 'wasted_before': 0.0, 'wasted_after': 0.0,
+              'token_reduction': 0.0}
+    used = np.concatenate(self.indices)
+    sizes = np.array([len(idx) for idx in self.indices])
+    padded_before = len(used) * self.X.shape[1]
+    padded_after = int(np.sum(sizes * np.array(self.batch_lengths)))
+    lengths = self.lengths[used]
+    return {'batches': len(self.indices),
+            'boundaries': self.boundaries.tolist(),
+            'wasted_before': wasted_token_fraction(lengths, [padded_before]),
+            'wasted_after': wasted_token_fraction(lengths, [padded_after]),
+            'token_reduction': 1.0 - padded_after / float(padded_before)}
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Resumable training checkpoints for the VAE, implicit VAE and IC50 training
+loops. A checkpoint holds the model weights, the optimizer slots, the numpy
+random state, the epoch and batch position, the shuffle permutation of the
+current epoch and the index into the cyclical annealing (beta) schedule, so
+that an interrupted run continues from exactly the batch it stopped at.
+
+Variable values are copied to host memory on the training thread and then
+written to disk by a background thread, so saving only costs the copy.
+"""
+
+import os
+import json
+import glob
+import queue
+import threading
+
+import numpy as np
+import tensorflow as tf
+
+CHECKPOINT_FILE = 'checkpoint'
+
+def _optimizer_variables(optimizer):
+  ## Keras optimizers expose their variables either as a method
+  ## (OptimizerV2) or as a property (newer optimizers)
+  variables = optimizer.variables
+  if callable(variables):
+    variables = variables()
+  return list(variables)
+
+def build_optimizer(optimizer, var_list):
+  """
+  Creates the slot variables of an optimizer without changing the model.
+  :param optimizer: A Keras optimizer.
+  :param var_list: The variables that the optimizer updates during training.
+  """
+  ## Keras 3 optimizers hold iterations and learning_rate before they are
+  ## built, so only the tf.keras 2 ones are checked by variable count
+  built = getattr(optimizer, 'built', None)
+  if built is None:
+    built = len(_optimizer_variables(optimizer)) > 1
+  if built:
+    return
+  ## A zero gradient step creates every slot in the same order that the
+  ## training loop would; the restored values overwrite the iteration count
+  zeros = [tf.zeros_like(v) for v in var_list]
+  optimizer.apply_gradients(zip(zeros, var_list))
+
+def _numpy_rng_state():
+  name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+  return {'rng/keys': keys,
+          'rng/meta': np.array([pos, has_gauss, cached_gaussian], dtype=np.float64)}
+
+def _set_numpy_rng_state(arrays):
+  pos, has_gauss, cached_gaussian = arrays['rng/meta']
+  np.random.set_state(('MT19937', arrays['rng/keys'], int(pos),
+                       int(has_gauss), float(cached_gaussian)))
+
+class CheckpointManager(object):
+  """
+  Saves and restores training checkpoints in <directory>, keeping the last
+  <max_to_keep> of them.
+  :param directory: Directory that holds the checkpoints.
+  :param model: The Keras model being trained.
+  :param optimizers: Dict of name -> Keras optimizer (the implicit VAE
+                     trains with three optimizers).
+  :param max_to_keep: Number of checkpoints kept on disk.
+  :param seed: If given, TF op level randomness is reseeded with seed + step
+               on every save and restore so that sampling noise also lines up
+               after resuming.
+  """
+  def __init__(self, directory, model, optimizers=None,
+               max_to_keep=3, prefix='ckpt', seed=None):
+    self.directory = directory
+    self.model = model
+    self.optimizers = optimizers or {}
+    self.max_to_keep = max_to_keep
+    self.prefix = prefix
+    self.seed = seed
+    os.makedirs(directory, exist_ok=True)
+
+    ## One pending write at most: a slow disk makes save() wait instead of
+    ## holding several copies of the weights in memory
+    self._jobs = queue.Queue(maxsize=1)
+    self._error = None
+    self._writer = threading.Thread(target=self._write_loop, daemon=True)
+    self._writer.start()
+
+  ## Paths of the checkpoints currently kept, oldest first
+  def checkpoints(self):
+    path = os.path.join(self.directory, CHECKPOINT_FILE)
+    if not os.path.isfile(path):
+      return []
+    with open(path) as f:
+      names = json.load(f)['checkpoints']
+    return [os.path.join(self.directory, n) for n in names]
+
+  def latest(self):
+    paths = self.checkpoints()
+    return paths[-1] if len(paths) > 0 else None
+
+  def save(self, step, **state):
+    """
+    Snapshots the model, the optimizers and the numpy random state together
+    with <state> and writes them in the background.
+    :param step: Global step, used to name the checkpoint.
+    :param state: Training position, e.g. epoch, batch, beta_ind and the
+                  shuffle permutation indxs. Values are scalars or arrays.
+    :return: The path the checkpoint will be written to.
+    """
+    self._raise_writer_error()
+    arrays = {}
+    for i, v in enumerate(self.model.variables):
+      arrays['model/{:04d}'.format(i)] = v.numpy()
+    for name, optimizer in self.optimizers.items():
+      for i, v in enumerate(_optimizer_variables(optimizer)):
+        arrays['opt/{}/{:04d}'.format(name, i)] = v.numpy()
+    arrays.update(_numpy_rng_state())
+
+    scalars = {'step': int(step)}
+    for key, value in state.items():
+      if np.ndim(value) == 0:
+        scalars[key] = value.item() if isinstance(value, np.generic) else value
+      else:
+        arrays['state/' + key] = np.asarray(value)
+
+    path = os.path.join(self.directory, '{}-{}.npz'.format(self.prefix, step))
+    self._jobs.put((path, arrays, scalars))
+    if self.seed is not None:
+      tf.random.set_seed(self.seed + int(step))
+    return path
+
+  def restore(self, path=None, var_lists=None):
+    """
+    Restores a checkpoint into the model and optimizers. The model must
+    already be built (call it on one batch first).
+    :param path: Checkpoint to restore, defaults to the latest one.
+    :param var_lists: Dict of optimizer name -> the variables it updates,
+                      needed to create the optimizer slots before assigning.
+    :return: The saved training state as a dict, or None if there is no
+             checkpoint.
+    """
+    self.wait()
+    path = path or self.latest()
+    if path is None:
+      return None
+    with np.load(path) as data:
+      arrays = {k: data[k] for k in data.files}
+
+    model_vars = self.model.variables
+    model_keys = sorted(k for k in arrays if k.startswith('model/'))
+    if len(model_keys) != len(model_vars):
+      raise ValueError('Checkpoint {} has {} model variables but the model has {}'
+                       .format(path, len(model_keys), len(model_vars)))
+    for v, k in zip(model_vars, model_keys):
+      v.assign(arrays[k])
+
+    var_lists = var_lists or {}
+    for name, optimizer in self.optimizers.items():
+      if name in var_lists:
+        build_optimizer(optimizer, var_lists[name])
+      opt_vars = _optimizer_variables(optimizer)
+      opt_keys = sorted(k for k in arrays if k.startswith('opt/{}/'.format(name)))
+      if len(opt_keys) != len(opt_vars):
+        raise ValueError('Checkpoint {} has {} variables for optimizer {} but it has {}'
+                         .format(path, len(opt_keys), name, len(opt_vars)))
+      for v, k in zip(opt_vars, opt_keys):
+        v.assign(arrays[k])
+
+    _set_numpy_rng_state(arrays)
+    with open(path[:-len('.npz')] + '.json') as f:
+      state = json.load(f)
+    for k in arrays:
+      if k.startswith('state/'):
+        state[k[len('state/'):]] = arrays[k]
+    if self.seed is not None:
+      tf.random.set_seed(self.seed + int(state['step']))
+    return state
+
+  ## Blocks until every pending checkpoint is on disk
+  def wait(self):
+    self._jobs.join()
+    self._raise_writer_error()
+
+  def _raise_writer_error(self):
+    if self._error is not None:
+      error, self._error = self._error, None
+      raise error
+
+  def _write_loop(self):
+    while True:
+      path, arrays, scalars = self._jobs.get()
+      try:
+        self._write(path, arrays, scalars)
+      except Exception as e:
+        self._error = e
+      finally:
+        self._jobs.task_done()
+
+  def _write(self, path, arrays, scalars):
+    ## Write to temporary files and rename so that a crash mid-write never
+    ## leaves a truncated checkpoint behind
+    base = path[:-len('.npz')]
+    with open(base + '.tmp.npz', 'wb') as f:
+      np.savez(f, **arrays)
+    with open(base + '.tmp.json', 'w') as f:
+      json.dump(scalars, f)
+    os.replace(base + '.tmp.json', base + '.json')
+    os.replace(base + '.tmp.npz', path)
+
+    names = [os.path.basename(p) for p in self.checkpoints()]
+    name = os.path.basename(path)
+    if name in names:
+      names.remove(name)
+    names.append(name)
+    stale, names = names[:-self.max_to_keep], names[-self.max_to_keep:]
+    index = os.path.join(self.directory, CHECKPOINT_FILE)
+    with open(index + '.tmp', 'w') as f:
+      json.dump({'checkpoints': names}, f)
+    os.replace(index + '.tmp', index)
+    for n in stale:
+      for stale_path in glob.glob(os.path.join(self.directory, n[:-len('.npz')] + '.*')):
+        os.remove(stale_path)
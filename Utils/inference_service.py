@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+"""
+One process that holds the VAE, latent decoder and IC50 predictor (a
+Utils.latent_model.LatentModel) and serves encode, decode and IC50
+prediction to the notebook kernels and scripts, so they no longer load
+their own copy of SMILE_VAE, Transformer and IC50_MCA.
+
+InferenceService coalesces concurrent requests into micro-batches: each
+endpoint has a queue, and its batcher takes the first waiting request, then
+keeps adding requests until max_batch rows are gathered or max_latency has
+passed since the first one arrived. The batch is run on a single model
+thread (the event loop keeps accepting requests meanwhile) and the rows are
+split back to the callers. Requests are checked before they are queued, and
+a batch that still fails is run again one request at a time, so a bad
+request only fails its own caller. IC50 requests are batched as (latent,
+profile) pairs, so requests against different gene profiles share a batch.
+The service counts queue depth, batch sizes (power of two histogram) and
+p50 / p99 request latency.
+
+serve() exposes the service on a localhost TCP port. A message is a 4 byte
+header length, a JSON header and the arrays it lists as .npy bytes (loaded
+without pickle). InferenceClient is the blocking client with the
+LatentModel methods encode, decode and predict; LocalClient is the same
+interface calling a LatentModel in process, for tests and for running
+without the service.
+"""
+
+import io
+import json
+import time
+import socket
+import struct
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+ENDPOINTS = ('encode', 'decode', 'decode_canonical', 'predict')
+## Latencies kept for the percentiles
+LATENCY_WINDOW = 10000
+
+class _Request(object):
+  def __init__(self, payload, rows, future):
+    self.payload = payload
+    self.rows = rows
+    self.future = future
+    self.start = time.time()
+
+class InferenceService(object):
+  """
+  :param model: A Utils.latent_model.LatentModel; its batch_size is the
+                largest batch sent to a model at once.
+  :param max_batch: Rows gathered per micro-batch.
+  :param max_latency: Seconds a request waits for others to join its batch.
+  """
+  def __init__(self, model, max_batch=1024, max_latency=0.005):
+    self.model = model
+    self.max_batch = max_batch
+    self.max_latency = max_latency
+    self.queues = None
+    self.tasks = []
+    ## One thread, the models are not called concurrently
+    self.executor = ThreadPoolExecutor(1)
+    self.batch_sizes = {name: {} for name in ENDPOINTS}
+    self.latencies = {name: [] for name in ENDPOINTS}
+    self.requests = {name: 0 for name in ENDPOINTS}
+
+  def start(self):
+    """
+    Starts the batchers on the running event loop.
+    """
+    self.queues = {name: asyncio.Queue() for name in ENDPOINTS}
+    self.tasks = [asyncio.ensure_future(self._batcher(name)) for name in ENDPOINTS]
+
+  async def stop(self):
+    for task in self.tasks:
+      task.cancel()
+    await asyncio.gather(*self.tasks, return_exceptions=True)
+    self.tasks = []
+
+  async def _submit(self, name, payload, rows):
+    if self.queues is None:
+      self.start()
+    future = asyncio.get_event_loop().create_future()
+    await self.queues[name].put(_Request(payload, rows, future))
+    return await future
+
+  async def encode(self, smiles):
+    """
+    :return: (Z, ok) as LatentModel.encode.
+    """
+    smiles = list(smiles)
+    return await self._submit('encode', smiles, len(smiles))
+
+  def _latents(self, Z):
+    ## Raised in the caller, before the request can join a batch
+    Z = np.asarray(Z, dtype=np.float32)
+    Z = Z.reshape(len(Z), -1)
+    if Z.shape[1] != self.model.vae.latent_dim:
+      raise ValueError('Latents have {} columns, the model takes {}'
+                       .format(Z.shape[1], self.model.vae.latent_dim))
+    return Z
+
+  async def decode(self, Z, canonical=False):
+    Z = self._latents(Z)
+    return await self._submit('decode_canonical' if canonical else 'decode', Z, len(Z))
+
+  async def predict(self, Z, gene_expressions):
+    Z = self._latents(Z)
+    genes = np.asarray(gene_expressions, dtype=np.float32)
+    if genes.ndim not in (1, 2) or genes.size == 0:
+      raise ValueError('Gene expressions must be one profile or a [G, genes] panel')
+    genes = genes.reshape(-1, genes.shape[-1])
+    return await self._submit('predict', (Z, genes), len(Z)*len(genes))
+
+  async def _gather(self, queue):
+    ## The first request, then whatever joins within max_latency
+    batch = [await queue.get()]
+    rows = batch[0].rows
+    deadline = batch[0].start + self.max_latency
+    while rows < self.max_batch:
+      timeout = deadline - time.time()
+      if timeout <= 0:
+        break
+      try:
+        request = await asyncio.wait_for(queue.get(), timeout)
+      except asyncio.TimeoutError:
+        break
+      batch.append(request)
+      rows += request.rows
+    return batch, rows
+
+  async def _batcher(self, name):
+    queue = self.queues[name]
+    loop = asyncio.get_event_loop()
+    run = getattr(self, '_run_' + name)
+    while True:
+      batch, rows = await self._gather(queue)
+      bucket = 1 << max(rows - 1, 0).bit_length()
+      self.batch_sizes[name][bucket] = self.batch_sizes[name].get(bucket, 0) + 1
+      payloads = [r.payload for r in batch]
+      try:
+        results = await loop.run_in_executor(self.executor, run, payloads)
+      except Exception as e:
+        results = [e] if len(batch) == 1 else \
+          await loop.run_in_executor(self.executor, self._run_each, run, payloads)
+      now = time.time()
+      for request, result in zip(batch, results):
+        self._record(name, now - request.start)
+        if request.future.done():
+          continue
+        if isinstance(result, Exception):
+          request.future.set_exception(result)
+        else:
+          request.future.set_result(result)
+
+  def _record(self, name, latency):
+    self.requests[name] += 1
+    latencies = self.latencies[name]
+    latencies.append(latency)
+    if len(latencies) > LATENCY_WINDOW:
+      del latencies[:len(latencies) - LATENCY_WINDOW]
+
+  ## Batch functions, run on the model thread: list of payloads -> list of
+  ## results
+
+  def _run_each(self, run, payloads):
+    ## After a failed batch: every request alone, its error as its result
+    results = []
+    for payload in payloads:
+      try:
+        results.append(run([payload])[0])
+      except Exception as e:
+        results.append(e)
+    return results
+
+  def _run_encode(self, payloads):
+    Z, ok = self.model.encode([s for p in payloads for s in p])
+    bounds = np.cumsum([0] + [len(p) for p in payloads])
+    return [(Z[a:b], ok[a:b]) for a, b in zip(bounds[:-1], bounds[1:])]
+
+  def _split_decode(self, payloads, canonical):
+    smiles = self.model.decode(np.concatenate(payloads), canonical=canonical)
+    bounds = np.cumsum([0] + [len(p) for p in payloads])
+    return [smiles[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+
+  def _run_decode(self, payloads):
+    return self._split_decode(payloads, False)
+
+  def _run_decode_canonical(self, payloads):
+    return self._split_decode(payloads, True)
+
+  def _run_predict(self, payloads):
+    ## Every request as its (latent, profile) pairs, as LatentModel.predict
+    Zs, Gs = [], []
+    for Z, genes in payloads:
+      Zs.append(np.repeat(Z, len(genes), axis=0))
+      Gs.append(np.tile(genes, (len(Z), 1)))
+    Zp, Gp = np.concatenate(Zs), np.concatenate(Gs)
+    preds = np.empty(len(Zp), dtype=np.float32)
+    for i in range(0, len(Zp), self.model.batch_size):
+      preds[i:i + self.model.batch_size] = self.model._predict(Zp[i:i + self.model.batch_size],
+                                                               Gp[i:i + self.model.batch_size])
+    out, start = [], 0
+    for Z, genes in payloads:
+      n = len(Z)*len(genes)
+      out.append(preds[start:start + n].reshape(len(Z), len(genes)).mean(axis=1))
+      start += n
+    return out
+
+  def stats(self):
+    """
+    Per endpoint: queue depth, requests served, batch size histogram and
+    p50 / p99 latency in seconds.
+    """
+    out = {}
+    for name in ENDPOINTS:
+      latencies = np.asarray(self.latencies[name])
+      out[name] = {'queue_depth': self.queues[name].qsize() if self.queues else 0,
+                   'requests': self.requests[name],
+                   'batch_sizes': dict(sorted(self.batch_sizes[name].items())),
+                   'p50': float(np.percentile(latencies, 50)) if len(latencies) else None,
+                   'p99': float(np.percentile(latencies, 99)) if len(latencies) else None}
+    return out
+
+## Wire format
+
+def _pack(header, arrays):
+  blobs = []
+  for name, values in arrays.items():
+    buf = io.BytesIO()
+    np.save(buf, values, allow_pickle=False)
+    blobs.append(buf.getvalue())
+  header = dict(header, arrays=[[name, len(b)] for name, b in zip(arrays, blobs)])
+  data = json.dumps(header).encode()
+  return struct.pack('!I', len(data)) + data + b''.join(blobs)
+
+def _load_arrays(header, blob):
+  arrays, offset = {}, 0
+  for name, size in header.pop('arrays', []):
+    arrays[name] = np.load(io.BytesIO(blob[offset:offset + size]), allow_pickle=False)
+    offset += size
+  return arrays
+
+async def _read_message(reader):
+  size = struct.unpack('!I', await reader.readexactly(4))[0]
+  header = json.loads((await reader.readexactly(size)).decode())
+  blob = await reader.readexactly(sum(s for _, s in header.get('arrays', [])))
+  return header, _load_arrays(header, blob)
+
+def _smiles_array(smiles):
+  return np.array([s or '' for s in smiles], dtype=np.str_)
+
+async def _handle(service, header, arrays):
+  endpoint = header['endpoint']
+  if endpoint == 'encode':
+    Z, ok = await service.encode(arrays['smiles'].tolist())
+    return {}, {'Z': Z, 'ok': ok}
+  if endpoint == 'decode':
+    smiles = await service.decode(arrays['Z'], header.get('canonical', False))
+    return {'none': [i for i, s in enumerate(smiles) if s is None]}, {'smiles': _smiles_array(smiles)}
+  if endpoint == 'predict':
+    return {}, {'ic50': await service.predict(arrays['Z'], arrays['genes'])}
+  if endpoint == 'stats':
+    return {'stats': service.stats()}, {}
+  raise ValueError('Unknown endpoint ' + str(endpoint))
+
+async def serve(service, host='127.0.0.1', port=8765):
+  """
+  Serves <service> until cancelled, e.g. asyncio.run(serve(service)) in the
+  process that loaded the models.
+  """
+  service.start()
+  async def client(reader, writer):
+    lock = asyncio.Lock()
+    async def respond(header, arrays):
+      try:
+        out, out_arrays = await _handle(service, header, arrays)
+        out['ok'] = True
+      except Exception as e:
+        out, out_arrays = {'ok': False, 'error': repr(e)}, {}
+      out['id'] = header.get('id')
+      async with lock:
+        writer.write(_pack(out, out_arrays))
+        await writer.drain()
+    try:
+      while True:
+        header, arrays = await _read_message(reader)
+        asyncio.ensure_future(respond(header, arrays))
+    except (asyncio.IncompleteReadError, ConnectionResetError):
+      pass
+    finally:
+      writer.close()
+  server = await asyncio.start_server(client, host, port)
+  print("Inference service listening on " + host + ":" + str(port))
+  try:
+    async with server:
+      await server.serve_forever()
+  finally:
+    await service.stop()
+
+class InferenceClient(object):
+  """
+  Blocking client of a served InferenceService, with the LatentModel
+  methods encode, decode and predict. Requests are sent one at a time per
+  client; concurrency comes from the other kernels and clients.
+  """
+  def __init__(self, host='127.0.0.1', port=8765, timeout=None):
+    self.sock = socket.create_connection((host, port), timeout=timeout)
+    self.count = 0
+
+  def close(self):
+    self.sock.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def _recv(self, size):
+    data = b''
+    while len(data) < size:
+      chunk = self.sock.recv(size - len(data))
+      if not chunk:
+        raise ConnectionError('Inference service closed the connection')
+      data += chunk
+    return data
+
+  def _call(self, endpoint, arrays=None, **header):
+    self.count += 1
+    self.sock.sendall(_pack(dict(header, endpoint=endpoint, id=self.count), arrays or {}))
+    size = struct.unpack('!I', self._recv(4))[0]
+    out = json.loads(self._recv(size).decode())
+    arrays = _load_arrays(out, self._recv(sum(s for _, s in out.get('arrays', []))))
+    if not out['ok']:
+      raise RuntimeError(out['error'])
+    return out, arrays
+
+  def encode(self, smiles):
+    _, arrays = self._call('encode', {'smiles': _smiles_array(smiles)})
+    return arrays['Z'], arrays['ok']
+
+  def decode(self, Z, canonical=False):
+    out, arrays = self._call('decode', {'Z': np.asarray(Z, dtype=np.float32)}, canonical=canonical)
+    smiles = arrays['smiles'].tolist()
+    for i in out['none']:
+      smiles[i] = None
+    return smiles
+
+  def predict(self, Z, gene_expressions):
+    _, arrays = self._call('predict', {'Z': np.asarray(Z, dtype=np.float32),
+                                       'genes': np.asarray(gene_expressions, dtype=np.float32)})
+    return arrays['ic50']
+
+  def stats(self):
+    return self._call('stats')[0]['stats']
+
+class LocalClient(object):
+  """
+  InferenceClient stand-in that calls a LatentModel in this process.
+  """
+  def __init__(self, model):
+    self.model = model
+
+  def close(self):
+    pass
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    pass
+
+  def encode(self, smiles):
+    return self.model.encode(smiles)
+
+  def decode(self, Z, canonical=False):
+    return self.model.decode(Z, canonical=canonical)
+
+  def predict(self, Z, gene_expressions):
+    return self.model.predict(Z, gene_expressions)
+
+  def stats(self):
+    return {}
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Timers and counters around the stages of an optimization run (TF decode,
+SELFIES / DeepSMILES conversion, smiles_check, re-encoding, IC50
+prediction and its retries), to see where the time of a GA generation
+goes.
+
+Instrumentation is off by default, and then costs one global check per
+call: span() returns a shared do nothing context manager and count()
+returns at once. After enable():
+  span(name)        times the block as a named stage (nested spans and
+                    several threads are fine)
+  count(name, n)    adds to a named counter, e.g. 'decode.invalid',
+                    'predict.retries'
+  generation(g, n)  closes a generation: the time per stage and the counters
+                    since the previous one, with n items evaluated
+summary() gives the totals per stage, report() prints them, generations
+holds the per generation summaries, and export_chrome_trace() writes every
+span and counter as Chrome trace JSON for chrome://tracing or Perfetto.
+
+Stage names used by the repo:
+  decode.tf, decode.convert, decode.check      LatentModel.decode
+  encode.tokenize, encode.tf                   LatentModel.encode
+  predict.ic50                                 LatentModel.predict
+  ga.offspring, ga.selection, ga.generation    GeneticOptimizer.step
+and counters decode.latents, decode.invalid, encode.molecules,
+encode.untokenizable, predict.pairs, predict.retries, predict.failures.
+"""
+
+import os
+import json
+import time
+import threading
+import contextlib
+
+ENABLED = False
+## Spans kept for the trace; totals and counters are always complete
+MAX_EVENTS = 1000000
+
+class _Null(object):
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    return False
+
+_NULL = _Null()
+
+class _Span(object):
+  def __init__(self, recorder, name, args):
+    self.recorder = recorder
+    self.name = name
+    self.args = args
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *args):
+    self.recorder.add_span(self.name, self.start, time.perf_counter(), self.args)
+    return False
+
+class Recorder(object):
+  """
+  Spans, per stage totals and counters of one run.
+  """
+  def __init__(self, max_events=MAX_EVENTS):
+    self.max_events = max_events
+    self.lock = threading.Lock()
+    self.origin = time.perf_counter()
+    self.events = []
+    self.dropped = 0
+    ## name -> [calls, seconds, longest]
+    self.totals = {}
+    self.counters = {}
+    self.generations = []
+    self._mark = ({}, {}, self.origin)
+
+  def add_span(self, name, start, end, args=None):
+    seconds = end - start
+    with self.lock:
+      total = self.totals.setdefault(name, [0, 0.0, 0.0])
+      total[0] += 1
+      total[1] += seconds
+      total[2] = max(total[2], seconds)
+      if len(self.events) < self.max_events:
+        self.events.append(('X', name, start, seconds, threading.get_ident(), args))
+      else:
+        self.dropped += 1
+
+  def add_count(self, name, n):
+    with self.lock:
+      value = self.counters.get(name, 0) + n
+      self.counters[name] = value
+      if len(self.events) < self.max_events:
+        self.events.append(('C', name, time.perf_counter(), value, threading.get_ident(), None))
+
+  def generation(self, index, items=None):
+    """
+    Summary of the stages and counters since the previous generation.
+    """
+    now = time.perf_counter()
+    with self.lock:
+      totals, counters, start = self._mark
+      stages = {}
+      for name, (calls, seconds, _) in self.totals.items():
+        old = totals.get(name, (0, 0.0))
+        if calls > old[0]:
+          stages[name] = {'calls': calls - old[0], 'seconds': seconds - old[1]}
+      entry = {'generation': index, 'seconds': now - start, 'stages': stages,
+               'counters': {name: value - counters.get(name, 0)
+                            for name, value in self.counters.items()
+                            if value != counters.get(name, 0)}}
+      if items is not None:
+        entry['items'] = items
+        entry['items_per_sec'] = items/max(now - start, 1e-9)
+      self.generations.append(entry)
+      self._mark = ({name: tuple(t[:2]) for name, t in self.totals.items()},
+                    dict(self.counters), now)
+    return entry
+
+  def summary(self):
+    """
+    Per stage calls, total, mean and longest seconds, and the counters.
+    """
+    with self.lock:
+      stages = {name: {'calls': calls, 'seconds': seconds, 'mean': seconds/calls,
+                       'max': longest}
+                for name, (calls, seconds, longest) in self.totals.items()}
+      return {'stages': stages, 'counters': dict(self.counters),
+              'wall': time.perf_counter() - self.origin}
+
+  def report(self):
+    s = self.summary()
+    lines = ["{:<20} {:>8} {:>10} {:>10}".format('stage', 'calls', 'seconds', 'mean ms')]
+    for name, stage in sorted(s['stages'].items(), key=lambda x: -x[1]['seconds']):
+      lines.append("{:<20} {:>8} {:>10.3f} {:>10.3f}".format(name, stage['calls'],
+                                                            stage['seconds'], 1000*stage['mean']))
+    for name, value in sorted(s['counters'].items()):
+      lines.append("{:<20} {:>8}".format(name, value))
+    return '\n'.join(lines)
+
+  def export_chrome_trace(self, path):
+    """
+    Writes the spans ('X' events) and counters ('C' events) in the Chrome
+    trace event format, times in microseconds from the recorder's start.
+    """
+    pid = os.getpid()
+    with self.lock:
+      events = list(self.events)
+    trace = []
+    for phase, name, start, value, tid, args in events:
+      event = {'name': name, 'ph': phase, 'pid': pid, 'tid': tid,
+               'ts': (start - self.origin)*1e6}
+      if phase == 'X':
+        event['dur'] = value*1e6
+        event['cat'] = name.split('.')[0]
+        if args:
+          event['args'] = args
+      else:
+        event['args'] = {name: value}
+      trace.append(event)
+    with open(path, 'w') as f:
+      json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+_recorder = Recorder()
+
+def recorder():
+  return _recorder
+
+def enable(reset=True):
+  """
+  Turns instrumentation on, with a fresh recorder unless reset is False.
+  :return: The recorder.
+  """
+  global ENABLED, _recorder
+  if reset:
+    _recorder = Recorder()
+  ENABLED = True
+  return _recorder
+
+def disable():
+  global ENABLED
+  ENABLED = False
+
+@contextlib.contextmanager
+def enabled():
+  """
+  with instrumentation.enabled() as rec: ... for a block.
+  """
+  rec = enable()
+  try:
+    yield rec
+  finally:
+    disable()
+
+def span(name, **args):
+  if not ENABLED:
+    return _NULL
+  return _Span(_recorder, name, args or None)
+
+def count(name, n=1):
+  if ENABLED:
+    _recorder.add_count(name, n)
+
+def generation(index, items=None):
+  if ENABLED:
+    return _recorder.generation(index, items)
+
+def summary():
+  return _recorder.summary()
+
+def report():
+  return _recorder.report()
+
+def export_chrome_trace(path):
+  _recorder.export_chrome_trace(path)
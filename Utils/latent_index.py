@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+Approximate nearest neighbour search over encoded latents (ChEMBL, ZINC,
+sarcoma_smiles_z), an IVF-PQ index in NumPy:
+  - a coarse k-means quantizer splits the latent space into nlist cells
+    (inverted lists),
+  - the residual of every latent to its cell centroid is product quantized:
+    split into m sub-vectors, each stored as the uint8 index of its nearest
+    of 256 sub-centroids, so a 64-dim float32 latent takes m bytes.
+A query only visits the nprobe cells nearest to it and ranks their
+entries by asymmetric distance: per (query, cell) a [m, 256] table of
+sub-distances, then one gather and sum per entry. Queries probing the same
+cell are handled together, so a batch of queries costs one table and one
+gather per probed cell.
+
+The index lives in a directory: the quantizers, and one segment per add()
+with its codes sorted by cell so that a cell is a contiguous slice. Segments
+are memory mapped, added without touching the older ones, and can be
+merged with compact(). Pass the original latents (e.g. a
+Utils.latent_store.LatentStore or a memmap) to search() to re-rank the
+candidates by exact distance.
+"""
+
+import os
+import glob
+import json
+
+import numpy as np
+
+def _sq_distances(X, C):
+  ## Squared euclidean distances [len(X), len(C)]
+  d = np.sum(X**2, axis=1)[:, None] - 2*X.dot(C.T) + np.sum(C**2, axis=1)[None, :]
+  return np.maximum(d, 0.0)
+
+def assign(X, C, chunk_size=65536):
+  """
+  Index of the nearest row of C for every row of X.
+  """
+  out = np.empty(len(X), dtype=np.int64)
+  for i in range(0, len(X), chunk_size):
+    out[i:i + chunk_size] = np.argmin(_sq_distances(np.asarray(X[i:i + chunk_size], dtype=np.float32), C),
+                                      axis=1)
+  return out
+
+def kmeans(X, k, iters=20, rng=np.random, verbose=False):
+  """
+  Lloyd's k-means, started from k random rows. Empty clusters are restarted
+  at random rows.
+  """
+  X = np.asarray(X, dtype=np.float32)
+  C = X[rng.choice(len(X), size=k, replace=len(X) < k)].copy()
+  for it in range(iters):
+    labels = assign(X, C)
+    counts = np.bincount(labels, minlength=k)
+    sums = np.zeros_like(C)
+    np.add.at(sums, labels, X)
+    empty = counts == 0
+    C[~empty] = sums[~empty]/counts[~empty, None]
+    C[empty] = X[rng.choice(len(X), size=int(empty.sum()))]
+    if verbose:
+      print("K-means iteration " + str(it) + ", Empty = " + str(int(empty.sum())))
+  return C
+
+class LatentIndex(object):
+  """
+  :param directory: Directory of the index.
+  :param nlist: Number of coarse cells, around sqrt(N) to 4 sqrt(N).
+  :param m: Sub-vectors per latent, must divide the latent dimension.
+  :param nprobe: Cells visited per query by default.
+  """
+  def __init__(self, directory, nlist=1024, m=8, nprobe=16):
+    self.directory = directory
+    self.nlist = nlist
+    self.m = m
+    self.nprobe = nprobe
+    self.centroids = None
+    self.codebooks = None
+    self.segments = []
+    meta = os.path.join(directory, 'meta.json')
+    if os.path.exists(meta):
+      self._load()
+
+  def __len__(self):
+    return sum(len(s['ids']) for s in self.segments)
+
+  def _load(self):
+    with open(os.path.join(self.directory, 'meta.json')) as f:
+      meta = json.load(f)
+    self.nlist, self.m = meta['nlist'], meta['m']
+    self.nprobe = meta.get('nprobe', self.nprobe)
+    self.centroids = np.load(os.path.join(self.directory, 'centroids.npy'))
+    self.codebooks = np.load(os.path.join(self.directory, 'codebooks.npy'))
+    paths = self._segment_paths()
+    ## A compact() interrupted after its merged segment was renamed into
+    ## place leaves the segments it replaces behind, finish removing them
+    replaced = set()
+    for path in paths:
+      if os.path.exists(os.path.join(path, 'replaces.json')):
+        with open(os.path.join(path, 'replaces.json')) as f:
+          replaced.update(json.load(f))
+    for path in paths:
+      if os.path.basename(path) in replaced:
+        self._remove_segment(path)
+    self.segments = [self._open_segment(path) for path in paths
+                     if os.path.basename(path) not in replaced]
+
+  def _segment_paths(self):
+    return sorted(glob.glob(os.path.join(self.directory, 'segment-[0-9]*[0-9]')))
+
+  def _remove_segment(self, path):
+    for f in glob.glob(os.path.join(path, '*')):
+      os.remove(f)
+    os.rmdir(path)
+
+  def _open_segment(self, path):
+    return {'path': path,
+            'codes': np.load(os.path.join(path, 'codes.npy'), mmap_mode='r'),
+            'ids': np.load(os.path.join(path, 'ids.npy'), mmap_mode='r'),
+            'offsets': np.load(os.path.join(path, 'offsets.npy'))}
+
+  def train(self, X, max_samples=200000, iters=20, seed=None, verbose=False):
+    """
+    Fits the coarse quantizer and the PQ codebooks on (a sample of) X.
+    """
+    rng = np.random.RandomState(seed)
+    X = np.asarray(X, dtype=np.float32)
+    if len(X) > max_samples:
+      X = X[np.sort(rng.choice(len(X), size=max_samples, replace=False))]
+    dim = X.shape[1]
+    if dim % self.m:
+      raise ValueError('m must divide the latent dimension')
+    self.centroids = kmeans(X, self.nlist, iters, rng, verbose)
+    residuals = X - self.centroids[assign(X, self.centroids)]
+    dsub = dim//self.m
+    self.codebooks = np.stack([kmeans(residuals[:, j*dsub:(j + 1)*dsub], 256, iters, rng)
+                               for j in range(self.m)])
+    os.makedirs(self.directory, exist_ok=True)
+    np.save(os.path.join(self.directory, 'centroids.npy'), self.centroids)
+    np.save(os.path.join(self.directory, 'codebooks.npy'), self.codebooks)
+    with open(os.path.join(self.directory, 'meta.json'), 'w') as f:
+      json.dump({'nlist': self.nlist, 'm': self.m, 'nprobe': self.nprobe, 'dim': dim}, f)
+    return self
+
+  def encode(self, X):
+    """
+    (cells [N], PQ codes uint8 [N, m]) of latents.
+    """
+    X = np.asarray(X, dtype=np.float32)
+    cells = assign(X, self.centroids)
+    residuals = X - self.centroids[cells]
+    dsub = X.shape[1]//self.m
+    codes = np.stack([assign(residuals[:, j*dsub:(j + 1)*dsub], self.codebooks[j])
+                      for j in range(self.m)], axis=1).astype(np.uint8)
+    return cells, codes
+
+  def add(self, X, ids=None, chunk_size=100000):
+    """
+    Adds latents as a new segment.
+    :param ids: Int ids returned by search, by default the running count.
+    """
+    X = np.asarray(X, dtype=np.float32) if not isinstance(X, np.memmap) else X
+    ids = np.arange(len(self), len(self) + len(X)) if ids is None else np.asarray(ids)
+    cells, codes = [], []
+    for i in range(0, len(X), chunk_size):
+      c, q = self.encode(X[i:i + chunk_size])
+      cells.append(c)
+      codes.append(q)
+    cells = np.concatenate(cells)
+    self._write_segment(cells, np.concatenate(codes), ids.astype(np.int64))
+    return self
+
+  def _write_segment(self, cells, codes, ids, replaces=()):
+    order = np.argsort(cells, kind='stable')
+    offsets = np.zeros(self.nlist + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(cells, minlength=self.nlist))
+    ## Numbered after the newest segment, so a merged segment sorts last
+    paths = self._segment_paths()
+    number = int(os.path.basename(paths[-1]).split('-')[1]) + 1 if paths else 0
+    path = os.path.join(self.directory, 'segment-{:06d}'.format(number))
+    tmp = path + '.tmp'
+    os.makedirs(tmp, exist_ok=True)
+    np.save(os.path.join(tmp, 'codes.npy'), codes[order])
+    np.save(os.path.join(tmp, 'ids.npy'), ids[order])
+    np.save(os.path.join(tmp, 'offsets.npy'), offsets)
+    if replaces:
+      with open(os.path.join(tmp, 'replaces.json'), 'w') as f:
+        json.dump([os.path.basename(r) for r in replaces], f)
+    os.rename(tmp, path)
+    self.segments.append(self._open_segment(path))
+
+  def compact(self):
+    """
+    Merges all segments into one. The merged segment is written and renamed
+    into place before the old ones are deleted, so the index stays complete
+    if the process dies part way.
+    """
+    if len(self.segments) <= 1:
+      return self
+    cells, codes, ids = [], [], []
+    for s in self.segments:
+      cells.append(np.repeat(np.arange(self.nlist), np.diff(s['offsets'])))
+      codes.append(np.asarray(s['codes']))
+      ids.append(np.asarray(s['ids']))
+    old = [s['path'] for s in self.segments]
+    self._write_segment(np.concatenate(cells), np.concatenate(codes), np.concatenate(ids),
+                        replaces=old)
+    self.segments = self.segments[-1:]
+    for path in old:
+      self._remove_segment(path)
+    return self
+
+  def search(self, Q, k=10, nprobe=None, vectors=None, rerank=4):
+    """
+    Batched approximate k-NN.
+    :param vectors: The indexed latents by id (array or memmap); if given,
+                    the k*rerank best PQ candidates are re-ranked exactly.
+    :return: (ids [Q, k], squared distances [Q, k]), nearest first; -1 and
+             inf pad queries with fewer than k candidates.
+    """
+    Q = np.asarray(Q, dtype=np.float32).reshape(-1, self.centroids.shape[1])
+    nprobe = min(nprobe or self.nprobe, self.nlist)
+    kk = k*rerank if vectors is not None else k
+    probes = np.argpartition(_sq_distances(Q, self.centroids), nprobe - 1, axis=1)[:, :nprobe]
+    best_d = np.full((len(Q), kk), np.inf, dtype=np.float32)
+    best_i = np.full((len(Q), kk), -1, dtype=np.int64)
+    dsub = Q.shape[1]//self.m
+    for cell in np.unique(probes):
+      queries = np.flatnonzero((probes == cell).any(axis=1))
+      ## Distance tables [q, m, 256] of the query residuals to this cell
+      residual = (Q[queries] - self.centroids[cell]).reshape(len(queries), self.m, 1, dsub)
+      tables = np.sum((residual - self.codebooks[None])**2, axis=-1)
+      for s in self.segments:
+        start, end = s['offsets'][cell], s['offsets'][cell + 1]
+        if start == end:
+          continue
+        codes = np.asarray(s['codes'][start:end])
+        d = np.zeros((len(queries), end - start), dtype=np.float32)
+        for j in range(self.m):
+          d += tables[:, j, codes[:, j]]
+        ids = np.asarray(s['ids'][start:end])
+        self._merge(best_d, best_i, queries, d, ids, kk)
+    if vectors is not None:
+      best_d, best_i = self._rerank(Q, best_i, vectors, k)
+    return best_i, best_d
+
+  def _merge(self, best_d, best_i, queries, d, ids, k):
+    ## Folds candidate distances d [q, n] into the running top-k of <queries>
+    all_d = np.concatenate([best_d[queries], d], axis=1)
+    all_i = np.concatenate([best_i[queries], np.broadcast_to(ids, d.shape)], axis=1)
+    keep = np.argpartition(all_d, k - 1, axis=1)[:, :k] if all_d.shape[1] > k else \
+      np.broadcast_to(np.arange(all_d.shape[1]), all_d.shape)
+    keep_d = np.take_along_axis(all_d, keep, axis=1)
+    order = np.argsort(keep_d, axis=1, kind='stable')
+    best_d[queries] = np.take_along_axis(keep_d, order, axis=1)
+    best_i[queries] = np.take_along_axis(np.take_along_axis(all_i, keep, axis=1), order, axis=1)
+
+  def _rerank(self, Q, candidates, vectors, k):
+    d = np.full(candidates.shape, np.inf, dtype=np.float32)
+    found = candidates >= 0
+    rows = np.unique(candidates[found])
+    if len(rows):
+      lookup = dict(zip(rows.tolist(), range(len(rows))))
+      V = np.asarray(vectors[rows], dtype=np.float32)
+      q_idx, c_idx = np.nonzero(found)
+      v = V[[lookup[c] for c in candidates[found].tolist()]]
+      d[q_idx, c_idx] = np.sum((Q[q_idx] - v)**2, axis=1)
+    order = np.argsort(d, axis=1, kind='stable')[:, :k]
+    return np.take_along_axis(d, order, axis=1), np.take_along_axis(candidates, order, axis=1)
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Batched access to a trained VAE, latent decoder and IC50 predictor: encode
+lists of SMILES to latents, decode latents to valid SMILES and score
+latents against gene expression profiles, each in a few large model calls.
+These replace the notebook helpers encode, smile_to_smiles_percentage,
+get_ic50s and get_ic50s_mult, which call the models once per molecule.
+"""
+
+import numpy as np
+import tensorflow as tf
+
+import Utils.tokenization as tokenization
+import Utils.proc_chem as proc_chem
+import Utils.instrumentation as instrumentation
+
+NUM_GENES = 2128
+
+class LatentModel(object):
+  """
+  :param vae: VAE whose encoder returns (h, z_mean, z_log_var).
+  :param vocab: Dict of token -> index.
+  :param vocab_index: Dict of index -> token.
+  :param representation: 'smiles', 'deep' or 'selfies'.
+  :param pad_size: PAD_SIZE of the representation.
+  :param max_len: Width the encoder was built with, PAD_SIZE - 1 when it
+                  was trained on X[:,:-1].
+  :param decoder: Latents -> logits, defaults to vae.decoder. May also be a
+                  decoderTransformerLatent.Transformer, or anything that
+                  returns greedy tokens [N, L] such as a
+                  length_predictor.TruncatedDecoder.
+  :param predictor: IC50_MCA model taking (encoded_smiles, genes).
+  :param batch_size: Largest batch sent to a model at once.
+  :param retries: Attempts per predictor batch before giving up.
+  :param implicit: <vae> is a SMILE_IMPLICIT_VAE, whose encoder takes
+                   (x, eps) and returns (enc, z).
+  """
+  def __init__(self, vae, vocab, vocab_index, representation, pad_size,
+               max_len=None, decoder=None, predictor=None, batch_size=1024,
+               retries=3, implicit=False):
+    self.vae = vae
+    self.vocab = vocab
+    self.vocab_index = vocab_index
+    self.representation = representation
+    self.pad_size = pad_size
+    self.max_len = max_len or pad_size - 1
+    self.decoder = decoder or vae.decoder
+    self.predictor = predictor
+    self.batch_size = batch_size
+    self.retries = retries
+    self.implicit = implicit
+
+  def encode(self, smiles, return_log_var=False):
+    """
+    :return: (Z, ok) where Z [N, LATENT_DIM] holds the latent means and ok
+             marks the molecules that could be tokenized; other rows are 0.
+             With return_log_var, (Z, Z_log_var, ok).
+    """
+    with instrumentation.span('encode.tokenize'):
+      X, ok = tokenization.encode_batch(smiles, self.vocab, self.pad_size,
+                                        self.representation)
+    if instrumentation.ENABLED:
+      instrumentation.count('encode.molecules', len(smiles))
+      instrumentation.count('encode.untokenizable', int(len(ok) - ok.sum()))
+    Z = np.zeros((len(smiles), self.vae.latent_dim), dtype=np.float32)
+    Z_log_var = np.zeros_like(Z)
+    rows = np.flatnonzero(ok)
+    Z[rows], Z_log_var[rows] = self.encode_tokens(X[rows])
+    if return_log_var:
+      return Z, Z_log_var, ok
+    return Z, ok
+
+  def encode_tokens(self, X):
+    """
+    Latent means and log variances of token rows [N, >= max_len]. The
+    implicit VAE has no variance; its log variances are 0.
+    """
+    X = np.asarray(X)[:, :self.max_len]
+    Z = np.zeros((len(X), self.vae.latent_dim), dtype=np.float32)
+    Z_log_var = np.zeros_like(Z)
+    for i in range(0, len(X), self.batch_size):
+      with instrumentation.span('encode.tf'):
+        if self.implicit:
+          Z[i:i + self.batch_size] = self.vae.encoder(X[i:i + self.batch_size], None)[1]
+        else:
+          _, z_mean, z_log_var = self.vae.encoder(X[i:i + self.batch_size])
+          Z[i:i + self.batch_size] = z_mean
+          Z_log_var[i:i + self.batch_size] = z_log_var
+    return Z, Z_log_var
+
+  def decode_strings(self, Z):
+    """
+    Greedy decodes latents to strings in the model's representation.
+    """
+    strings = []
+    for i in range(0, len(Z), self.batch_size):
+      z = np.asarray(Z[i:i + self.batch_size], dtype=np.float32)
+      ## Keras decoders run without dropout, the Transformer defaults to
+      ## training=True
+      with instrumentation.span('decode.tf'):
+        if isinstance(self.decoder, tf.keras.layers.Layer):
+          out = np.asarray(self.decoder(z, training=False))
+        else:
+          out = np.asarray(self.decoder(z))
+      if out.ndim == 2:
+        strings.extend(tokenization.tokens_to_strings(out, self.vocab_index))
+      else:
+        strings.extend(tokenization.logits_to_strings(out, self.vocab_index))
+    return strings
+
+  def decode(self, Z, canonical=False):
+    """
+    :param canonical: Return canonical SMILES, so that equal molecules
+                      compare equal (the same single RDKit parse).
+    :return: List with the valid SMILES decoded from every latent, or None.
+    """
+    strings = self.decode_strings(Z)
+    with instrumentation.span('decode.convert'):
+      smiles = tokenization.strings_to_smiles(strings, self.representation)
+    check = proc_chem.canonical_smiles if canonical else proc_chem.smiles_check
+    with instrumentation.span('decode.check'):
+      smiles = [check(s) if s else None for s in smiles]
+    if instrumentation.ENABLED:
+      instrumentation.count('decode.latents', len(smiles))
+      instrumentation.count('decode.invalid', sum(s is None for s in smiles))
+    return smiles
+
+  def _predict(self, Z, genes):
+    for attempt in range(self.retries):
+      try:
+        return np.asarray(self.predictor(encoded_smiles=Z, genes=genes)).reshape(-1)
+      except Exception as e:
+        print('IC50 PREDICTION EXCEPTION')
+        error = e
+        ## A retry only if another attempt follows
+        if attempt + 1 < self.retries:
+          instrumentation.count('predict.retries')
+    instrumentation.count('predict.failures')
+    raise error
+
+  def predict(self, Z, gene_expressions, average=True):
+    """
+    Predicted IC50 of every latent.
+    :param gene_expressions: One profile [NUM_GENES], or several
+                             [G, NUM_GENES] in which case the predictions are
+                             averaged over the profiles as in get_ic50s_mult.
+    :param average: If False, return every profile's prediction, [N, G].
+    :return: Array [N].
+    """
+    Z = np.asarray(Z, dtype=np.float32)
+    genes = np.asarray(gene_expressions, dtype=np.float32).reshape(-1, NUM_GENES)
+    num_genes = len(genes)
+    ## Every (latent, profile) pair as one row, cut into batches
+    pairs = len(Z)*num_genes
+    preds = np.empty(pairs, dtype=np.float32)
+    instrumentation.count('predict.pairs', pairs)
+    for i in range(0, pairs, self.batch_size):
+      j = np.arange(i, min(i + self.batch_size, pairs))
+      with instrumentation.span('predict.ic50'):
+        preds[j] = self._predict(Z[j // num_genes], genes[j % num_genes])
+    preds = preds.reshape(len(Z), num_genes)
+    return preds.mean(axis=1) if average else preds
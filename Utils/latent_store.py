@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent store of encoded latents for a whole corpus (ChEMBL, ZINC), in
+place of the notebook loops that encode 4000 molecules one at a time.
+
+encode_corpus streams the corpus through the encoder in large batches:
+worker processes tokenize the next chunks of SMILES while the encoder runs
+(or the corpus is given already tokenized, e.g. as a memmap), and every
+chunk of latents is written as its own directory of float16 .npy files:
+  ids.npy        int64 [n]          molecule ids (row in the corpus by default)
+  z_mean.npy     float16 [n, D]
+  z_log_var.npy  float16 [n, D]
+  chunk.json     the checkpoint that produced the chunk
+Chunks are renamed into place once complete. A run that is interrupted, or
+started again after molecules were added to the corpus, skips every id the
+store already holds for the same checkpoint; encoding with a new checkpoint
+adds chunks whose latents take precedence for their ids.
+
+A LatentStore is indexed by id: store[ids] gives the z_mean rows as
+float32, so it can be handed to latent_index.LatentIndex.search to re-rank.
+"""
+
+import os
+import glob
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import Utils.tokenization as tokenization
+
+class LatentStore(object):
+  """
+  :param directory: Directory of the store, created if needed.
+  """
+  def __init__(self, directory):
+    self.directory = directory
+    os.makedirs(directory, exist_ok=True)
+    self.chunks = [self._open_chunk(path) for path in self._chunk_paths()]
+    self._index = None
+
+  def _chunk_paths(self):
+    return sorted(glob.glob(os.path.join(self.directory, 'chunk-[0-9]*[0-9]')))
+
+  def _open_chunk(self, path):
+    with open(os.path.join(path, 'chunk.json')) as f:
+      meta = json.load(f)
+    return {'path': path, 'checkpoint': meta['checkpoint'],
+            'ids': np.load(os.path.join(path, 'ids.npy')),
+            'z_mean': np.load(os.path.join(path, 'z_mean.npy'), mmap_mode='r'),
+            'z_log_var': np.load(os.path.join(path, 'z_log_var.npy'), mmap_mode='r')}
+
+  def write_chunk(self, ids, z_mean, z_log_var, checkpoint):
+    number = len(self._chunk_paths())
+    path = os.path.join(self.directory, 'chunk-{:06d}'.format(number))
+    tmp = path + '.tmp'
+    os.makedirs(tmp, exist_ok=True)
+    np.save(os.path.join(tmp, 'ids.npy'), np.asarray(ids, dtype=np.int64))
+    np.save(os.path.join(tmp, 'z_mean.npy'), np.asarray(z_mean, dtype=np.float16))
+    np.save(os.path.join(tmp, 'z_log_var.npy'), np.asarray(z_log_var, dtype=np.float16))
+    with open(os.path.join(tmp, 'chunk.json'), 'w') as f:
+      json.dump({'checkpoint': checkpoint}, f)
+    os.rename(tmp, path)
+    self.chunks.append(self._open_chunk(path))
+    self._index = None
+
+  def encoded(self, checkpoint=None):
+    """
+    Ids held in the store, only those encoded by <checkpoint> if given.
+    """
+    ids = [c['ids'] for c in self.chunks if checkpoint is None or c['checkpoint'] == checkpoint]
+    return np.unique(np.concatenate(ids)) if ids else np.zeros(0, dtype=np.int64)
+
+  def _build_index(self):
+    ## Sorted ids -> (chunk, row); later chunks override earlier ones
+    ids = [c['ids'] for c in self.chunks]
+    if not ids:
+      self._index = (np.zeros(0, np.int64),)*3
+      return
+    all_ids = np.concatenate(ids)
+    chunk = np.concatenate([np.full(len(c), i, dtype=np.int64) for i, c in enumerate(ids)])
+    row = np.concatenate([np.arange(len(c)) for c in ids])
+    ## Stable sort on the reversed arrays keeps the latest entry first
+    order = np.argsort(all_ids[::-1], kind='stable')
+    rev = len(all_ids) - 1 - order
+    keys, first = np.unique(all_ids[rev], return_index=True)
+    self._index = (keys, chunk[rev[first]], row[rev[first]])
+
+  def __len__(self):
+    if self._index is None:
+      self._build_index()
+    return len(self._index[0])
+
+  def lookup(self, ids, field='z_mean'):
+    """
+    Rows of <field> ('z_mean' or 'z_log_var') for ids, as float32.
+    :return: (values [N, D], found) where rows of unknown ids are 0.
+    """
+    if self._index is None:
+      self._build_index()
+    keys, chunks, rows = self._index
+    ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+    pos = np.minimum(np.searchsorted(keys, ids), max(len(keys) - 1, 0))
+    found = (keys[pos] == ids) if len(keys) else np.zeros(len(ids), dtype=bool)
+    dim = self.chunks[0][field].shape[1] if self.chunks else 0
+    out = np.zeros((len(ids), dim), dtype=np.float32)
+    for c in np.unique(chunks[pos[found]]):
+      sel = np.flatnonzero(found & (chunks[pos] == c))
+      r = rows[pos[sel]]
+      order = np.argsort(r)
+      out[sel[order]] = self.chunks[c][field][r[order]]
+    return out, found
+
+  def __getitem__(self, ids):
+    return self.lookup(ids)[0]
+
+  def scan(self, field='z_mean'):
+    """
+    Yields (ids, values) chunk by chunk, every id once with its latest
+    values: rows superseded by a later chunk are skipped. Values are float16,
+    memory mapped for chunks with nothing superseded.
+    """
+    if self._index is None:
+      self._build_index()
+    _, chunks, rows = self._index
+    for i, c in enumerate(self.chunks):
+      keep = np.sort(rows[chunks == i])
+      if len(keep) == len(c['ids']):
+        yield c['ids'], c[field]
+      elif len(keep):
+        yield c['ids'][keep], c[field][keep]
+
+  def scan_chunks(self, field='z_mean'):
+    """
+    Yields (ids, values) of every chunk as written, superseded rows included.
+    """
+    for c in self.chunks:
+      yield c['ids'], c[field]
+
+def _tokenize(smiles, vocab, pad_size, representation):
+  ## Runs in the worker processes
+  return tokenization.encode_batch(smiles, vocab, pad_size, representation)
+
+def encode_corpus(store, model, checkpoint, smiles=None, tokens=None, ids=None,
+                  chunk_size=65536, num_workers=None, verbose=True):
+  """
+  Encodes a corpus into <store>, skipping ids it already holds for
+  <checkpoint>.
+  :param model: A Utils.latent_model.LatentModel; its batch_size is the
+                encoder batch.
+  :param checkpoint: Name of the weights the encoder was loaded from, e.g.
+                     registry.weights_name(...).
+  :param smiles: List of SMILES, tokenized by <num_workers> processes.
+  :param tokens: Or the corpus already tokenized, [N, >= max_len].
+  :param ids: Molecule ids, the corpus rows by default.
+  :return: Number of molecules encoded; untokenizable ones are skipped
+           (and tried again by the next run).
+  """
+  size = len(smiles) if smiles is not None else len(tokens)
+  ids = np.arange(size, dtype=np.int64) if ids is None else np.asarray(ids, dtype=np.int64)
+  todo = np.flatnonzero(~np.isin(ids, store.encoded(checkpoint)))
+  chunks = [todo[i:i + chunk_size] for i in range(0, len(todo), chunk_size)]
+  if verbose:
+    print("Encoding " + str(len(todo)) + " of " + str(size) + " molecules in " + \
+          str(len(chunks)) + " chunks")
+
+  pool, pending = None, []
+  if smiles is not None:
+    pool = ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context('spawn'))
+    window = pool._max_workers + 1
+  def submit(i):
+    pending.append(pool.submit(_tokenize, [smiles[j] for j in chunks[i]], model.vocab,
+                               model.pad_size, model.representation))
+  done = 0
+  try:
+    if pool is not None:
+      for i in range(min(window, len(chunks))):
+        submit(i)
+    for i, rows in enumerate(chunks):
+      if pool is not None:
+        ## Keep <window> chunks tokenizing while this one is encoded
+        X, ok = pending.pop(0).result()
+        if i + window < len(chunks):
+          submit(i + window)
+      else:
+        X, ok = np.asarray(tokens[rows]), np.ones(len(rows), dtype=bool)
+      z_mean, z_log_var = model.encode_tokens(X[ok])
+      store.write_chunk(ids[rows[ok]], z_mean, z_log_var, checkpoint)
+      done += int(ok.sum())
+      if verbose:
+        print("Chunk " + str(i + 1) + "/" + str(len(chunks)) + ", Encoded = " + str(done))
+  finally:
+    if pool is not None:
+      pool.shutdown(cancel_futures=True)
+  return done
@@ -1,52 +1,112 @@
-# -*- coding: utf-8 -*-
-"""
-Created on  June 10th
-@author: hanshanley
-
-This file handles the processing of chemcial features of MOLs and SMILES. Specifically,
-it holds the RDKit functions that determine the features of SMILES and functions that 
-randomize SMILES.
-"""
-
-import  random
-import 	gzip
-import  re
-import  functools
-
-def to_mol(smi):
-    """
-    Creates a Mol object from a SMILES string.
-    :param smi: SMILES string.
-    :return: A Mol object or None if it's not valid.
-    """
-    if smi:
-        return rkc.MolFromSmiles(smi)
-
-def to_smiles(mol):
-    """
-    Converts a Mol object into a canonical SMILES string.
-    :param mol: Mol object.
-    :return: A SMILES string.
-    """
-    return rkc.MolToSmiles(mol, isomericSmiles=False)
-
-def randomize_smiles_string(smile, random_type= 'restricted'):
-	"""
-	Returns a random SMILES given a SMILES of a molecule.
-	:param smile: A string object
-	:param random_type: The type (unrestricted, restricted) of randomization performed.
-	:return : A random SMILES string of the same molecule or None if the molecule is invalid.
-	"""
-	if not smile:
-		return None
-
-	mol = to_smiles(smile)
-
-	if random_type == "unrestricted":
-		return rkc.MolToSmiles(mol, canonical=False, doRandom=True, isomericSmiles=False)
-	if random_type == "restricted":
-		new_atom_order = list(range(mol.GetNumAtoms()))
-		random.shuffle(new_atom_order)
-		random_mol = rkc.RenumberAtoms(mol, newOrder=new_atom_order)
-		return rkc.MolToSmiles(random_mol, canonical=False, isomericSmiles=False)
+# -*- coding: utf-8 -*-
+"""
+Created on  June 10th
+@author: hanshanley
+
+This file handles the processing of chemcial features of MOLs and SMILES. Specifically,
+it holds the RDKit functions that determine the features of SMILES and functions that 
+randomize SMILES.
+"""
+
+import  random
+import 	gzip
+import  re
+import  functools
+
+import rdkit.Chem as rkc
+
+def to_mol(smi):
+    """
+    Creates a Mol object from a SMILES string.
+    :param smi: SMILES string.
+    :return: A Mol object or None if it's not valid.
+    """
+    if smi:
+        return rkc.MolFromSmiles(smi)
+
+def to_smiles(mol):
+    """
+    Converts a Mol object into a canonical SMILES string.
+    :param mol: Mol object.
+    :return: A SMILES string.
+    """
+    return rkc.MolToSmiles(mol, isomericSmiles=False)
+
+def smiles_check(smiles):
+    """
+    Checks that a SMILES string parses and sanitizes in RDKit.
+    :param smiles: SMILES string.
+    :return: The SMILES string or None if it's not valid.
+    """
+    try:
+        if smiles and rkc.MolFromSmiles(smiles) is not None:
+            return smiles
+    except Exception:
+        pass
+    return None
+
+def canonical_smiles(smiles):
+    """
+    Converts a SMILES string into its canonical form so that different
+    writings of the same molecule compare equal.
+    :param smiles: SMILES string.
+    :return: The canonical SMILES string or None if it's not valid.
+    """
+    try:
+        mol = to_mol(smiles)
+    except Exception:
+        return None
+    if mol is None:
+        return None
+    return rkc.MolToSmiles(mol)
+
+@functools.lru_cache(maxsize=None)
+def sascorer():
+    """
+    The synthetic accessibility scorer of Ertl and Schuffenhauer, from
+    Utils/sascorer.py if present (as in the notebooks), else the copy in
+    RDKit's Contrib/SA_Score.
+    :return: The sascorer module.
+    """
+    try:
+        import Utils.sascorer as module
+        return module
+    except ImportError:
+        pass
+    import os
+    import importlib.util
+    from rdkit.Chem import RDConfig
+    path = os.path.join(RDConfig.RDContribDir, 'SA_Score', 'sascorer.py')
+    if not os.path.exists(path):
+        raise ImportError('No sascorer: add Utils/sascorer.py or install RDKit with Contrib')
+    spec = importlib.util.spec_from_file_location('sascorer', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def sa_score(mol):
+    """
+    Synthetic accessibility score of a Mol object, 1 (easy) to 10 (hard).
+    """
+    return sascorer().calculateScore(mol)
+
+def randomize_smiles_string(smile, random_type= 'restricted'):
+	"""
+	Returns a random SMILES given a SMILES of a molecule.
+	:param smile: A string object
+	:param random_type: The type (unrestricted, restricted) of randomization performed.
+	:return : A random SMILES string of the same molecule or None if the molecule is invalid.
+	"""
+	if not smile:
+		return None
+
+	mol = to_smiles(smile)
+
+	if random_type == "unrestricted":
+		return rkc.MolToSmiles(mol, canonical=False, doRandom=True, isomericSmiles=False)
+	if random_type == "restricted":
+		new_atom_order = list(range(mol.GetNumAtoms()))
+		random.shuffle(new_atom_order)
+		random_mol = rkc.RenumberAtoms(mol, newOrder=new_atom_order)
+		return rkc.MolToSmiles(random_mol, canonical=False, isomericSmiles=False)
 	raise ValueError("Type '{}' is not valid".format(random_type))
\ No newline at end of file
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Tokenization of SMILES, DeepSMILES and SELFIES for the models, and the
+inverse: turning decoder logits back into SMILES. These are the batched
+versions of the helpers used throughout the notebooks (tokenize_smiles,
+integer_encode, get_smiles_from_logits, get_smiles_from_deep, ...), so
+whole populations can be converted with one call.
+
+The representation is one of 'smiles', 'deep' (DeepSMILES) or 'selfies',
+matching the DEEP / SELFIES flags of the notebooks. Br and Cl are written
+as R and L in the SMILES and DeepSMILES vocabularies.
+"""
+
+import re
+
+import numpy as np
+import deepsmiles
+import selfies
+
+REPRESENTATIONS = ('smiles', 'deep', 'selfies')
+PAD, BOS, EOS = '<PAD>', '<BOS>', '<EOS>'
+
+_converter = deepsmiles.Converter(rings = True, branches = True)
+_br, _cl = re.compile('Br'), re.compile('Cl')
+_r, _l = re.compile('R'), re.compile('L')
+
+## replace Br and Cl with single letters
+def replace_halogens(string):
+  return _cl.sub('L', _br.sub('R', string))
+
+## replace R and L with Br and Cl
+def replace_halogens_inv(string):
+  return _l.sub('Cl', _r.sub('Br', string))
+
+## Splits the selfies <molecule> into a list of character strings.
+def split_selfie(molecule):
+  return re.findall(r'\[.*?\]|\.', molecule)
+
+def tokenize_smiles(smiles):
+  return [BOS] + list(smiles) + [EOS]
+
+def tokenize_selfies(selfie):
+  return [BOS] + split_selfie(selfie) + [EOS]
+
+## Integer encode a token list, None if a token is not in the vocabulary
+def integer_encode(tokens, vocab):
+  try:
+    return [vocab[t] for t in tokens if t != '\n']
+  except KeyError:
+    return None
+
+def from_smiles(smiles, representation):
+  """
+  Converts a SMILES string to the string the models were trained on.
+  :return: The converted string or None if the conversion fails.
+  """
+  try:
+    if representation == 'selfies':
+      return selfies.encoder(smiles)
+    if representation == 'deep':
+      return replace_halogens(_converter.encode(smiles))
+    return replace_halogens(smiles)
+  except Exception:
+    return None
+
+def to_smiles(string, representation):
+  """
+  Converts a decoded string back to SMILES.
+  :return: The SMILES string or None if it is empty or cannot be decoded.
+  """
+  if not string:
+    return None
+  try:
+    if representation == 'selfies':
+      smiles = selfies.decoder(string)
+    elif representation == 'deep':
+      smiles = _converter.decode(replace_halogens_inv(string))
+    else:
+      smiles = replace_halogens_inv(string)
+  except Exception:
+    return None
+  return smiles if smiles else None
+
+def encode_batch(molecules, vocab, pad_size, representation='smiles',
+                 is_smiles=True):
+  """
+  Tokenizes, integer encodes and pads a list of molecules.
+  :param molecules: List of strings.
+  :param vocab: Dict of token -> index.
+  :param pad_size: Width of the padded matrix (PAD_SIZE).
+  :param is_smiles: If False the molecules are already in <representation>.
+  :return: (X, ok) where X is an int32 matrix [N, pad_size] and ok marks the
+           molecules that could be encoded; rows that could not are all pad.
+  """
+  X = np.zeros((len(molecules), pad_size), dtype=np.int32)
+  ok = np.zeros(len(molecules), dtype=bool)
+  for i, molecule in enumerate(molecules):
+    string = from_smiles(molecule, representation) if is_smiles else molecule
+    if string is None:
+      continue
+    if representation == 'selfies':
+      tokens = tokenize_selfies(string)
+    else:
+      tokens = tokenize_smiles(string)
+    encoded = integer_encode(tokens, vocab)
+    if encoded is None or len(encoded) > pad_size:
+      continue
+    X[i, :len(encoded)] = encoded
+    ok[i] = True
+  return X, ok
+
+def _index_array(vocab_index):
+  ## Dense lookup table so tokens of a whole batch are mapped at once
+  table = np.empty(max(vocab_index) + 1, dtype=object)
+  table[:] = ''
+  for i, token in vocab_index.items():
+    table[i] = token
+  return table
+
+def tokens_to_strings(token_ids, vocab_index, strip_bos=True):
+  """
+  Joins rows of token indices into strings, cut at the first <EOS>. Rows
+  without an <EOS> give '' as in get_smiles_from_logits.
+  :param token_ids: Integer array [N, L].
+  :param vocab_index: Dict of index -> token.
+  :param strip_bos: Drop the first position, which holds <BOS>.
+  """
+  token_ids = np.asarray(token_ids)
+  eos_index = {t: i for i, t in vocab_index.items()}[EOS]
+  is_eos = token_ids == eos_index
+  has_eos = is_eos.any(axis=1)
+  first_eos = np.argmax(is_eos, axis=1)
+  table = _index_array(vocab_index)
+  start = 1 if strip_bos else 0
+  strings = []
+  for row, found, stop in zip(token_ids, has_eos, first_eos):
+    strings.append(''.join(table[row[start:stop]]) if found else '')
+  return strings
+
+def logits_to_strings(logits, vocab_index, strip_bos=True):
+  """
+  Greedy decoding of a batch of decoder logits [N, L, VOCAB_SIZE].
+  """
+  return tokens_to_strings(np.argmax(np.asarray(logits), axis=-1),
+                           vocab_index, strip_bos)
+
+def strings_to_smiles(strings, representation):
+  return [to_smiles(s, representation) for s in strings]
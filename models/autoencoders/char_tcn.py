@@ -14,7 +14,7 @@ import numpy as np
 import tensorflow as tf
 import tensorflow.keras as keras
 import sys 
-import GANS.stcn as stcn
+import models.autoencoders.stcn as stcn
 
 class EmbeddingSharedWeights(keras.layers.Layer):
   def __init__(self, vocab_size, embedding_dim,max_length):
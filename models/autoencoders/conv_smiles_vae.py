@@ -57,19 +57,24 @@ class Encoder(tf.keras.layers.Layer):
     self.conv_layers =  [layers.Conv1D(int(CONV_DIM_DEPTH *CONV_D_GF**j),int(CONV_DIM_WIDTH*CONV_W_GF**j),
                          activation ='tanh') for j in  range(1,CONV_DEPTH-1) ]
     self.dense1 = layers.Dense(latent_dim*4)                                                    
+    ## Created once (untrained, as when they were created in call) so that
+    ## the encoder can be traced by tf.function
+    self.batch1 = layers.BatchNormalization(axis = -1, trainable = False)
+    self.batch2 = layers.BatchNormalization(axis = -1, trainable = False)
+    self.batch3 = layers.BatchNormalization(axis = -1, trainable = False)
     
   def call(self, x):
     x = self.embed(x)
     x = self.conv1(x)
-    x =  layers.BatchNormalization(axis = -1)(x)
+    x =  self.batch1(x)
     for i in range(len(self.conv_layers)):
       x = self.conv_layers[i](x)
-    x =  layers.BatchNormalization(axis = -1)(x)
+    x =  self.batch2(x)
     x = layers.Flatten()(x)
 
     x = self.dense1(x)
     x = self.drop1(x)
-    x =  layers.BatchNormalization(axis = -1)(x)
+    x =  self.batch3(x)
     z_mean = self.mean(x)
     z_log_var = self.log_var(x)
     return x, z_mean, z_log_var
@@ -91,10 +96,15 @@ class Decoder(tf.keras.layers.Layer):
     self.lstm1 = tf.keras.layers.LSTM(embedding_dim,return_sequences = True,activation ='tanh')
     self.timeD = tf.keras.layers.TimeDistributed(tf.keras.layers.Dense(vocab_size))
 
-  def call(self, x):
+  ## <length> decodes only the first positions; the LSTM is causal so they
+  ## match the first positions of a full length decode
+  def call(self, x, length=None):
     x = self.dense1(x)
     x = self.drop1(x)
-    x = self.rv(x)
+    if length is None:
+      x = self.rv(x)
+    else:
+      x = tf.repeat(tf.expand_dims(x, 1), length, axis=1)
     x = self.lstm1(x)
     x = self.timeD(x)
     return x
@@ -118,10 +128,10 @@ class SMILE_VAE(tf.keras.Model):
                            latent_dim = latent_dim)
     self.latent_dim = latent_dim
 
-  def call(self, x):
+  def call(self, x, length=None):
     h, z_mean,z_log_var = self.encoder(x)
     z = tf.keras.layers.Lambda(self.encoder.sample, output_shape =(self.latent_dim,))([z_mean,z_log_var])
-    x_decoded = self.decoder(z)
+    x_decoded = self.decoder(z, length=length)
 
     ## Returns latent space encoding, its variance, and the decoded
     ## version of the space encoding.
@@ -66,19 +66,24 @@ class Encoder(tf.keras.layers.Layer):
     self.conv_layers =  [layers.Conv1D(int(CONV_DIM_DEPTH *CONV_D_GF**j),int(CONV_DIM_WIDTH*CONV_W_GF**j),
                          activation ='tanh') for j in  range(1,CONV_DEPTH-1) ]
     self.dense1 = layers.Dense(latent_dim*4)
+    ## Created once (untrained, as when they were created in call) so that
+    ## the encoder can be traced by tf.function
+    self.batch1 = layers.BatchNormalization(axis = -1, trainable = False)
+    self.batch2 = layers.BatchNormalization(axis = -1, trainable = False)
+    self.batch3 = layers.BatchNormalization(axis = -1, trainable = False)
     
   def call(self, x, eps):
     x = self.embed(x)
     x = self.conv1(x)
-    x =  layers.BatchNormalization(axis = -1)(x)
+    x =  self.batch1(x)
     for i in range(len(self.conv_layers)):
       x = self.conv_layers[i](x)
-    x =  layers.BatchNormalization(axis = -1)(x)
+    x =  self.batch2(x)
     x = layers.Flatten()(x)
 
     x = self.dense1(x)
     x = self.drop1(x)
-    enc =  layers.BatchNormalization(axis = -1)(x)
+    enc =  self.batch3(x)
     z_mean = self.mean(tf.concat([enc],axis = 1))
     return  enc, z_mean
 
@@ -153,7 +158,9 @@ class Decoder(tf.keras.layers.Layer):
     self.drop1 = layers.Dropout(dropout_rate)
     self.drop2 = layers.Dropout(dropout_rate)
 
-  def call(self,labels, z_x):
+  ## <labels> is unused, z_x comes first so that decoder(z) works like
+  ## the decoders of the other VAEs
+  def call(self, z_x, labels=None):
     x = self.rv(z_x)
     x = self.dense1(x)
     x = self.drop1(x)
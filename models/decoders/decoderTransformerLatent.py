@@ -239,17 +239,22 @@ class Transformer(tf.keras.Model):
 
     self.decoder_layers = [EncoderLayer(embedding_dim, num_heads, d_hid, residual_dropout,
                          attention_dropout, use_attn_mask, i, neg_inf, layer_norm_epsilon, accurate_gelu) for i in range(self.num_layers)]
-    pos_embed = np.arange(0,max_len)
-    batch_pos_embed = []
-    for i in range(batch_size):
-      batch_pos_embed.append(pos_embed)
-    self.batch_pos_embed = np.array(batch_pos_embed)
+    ## Position embeddings are broadcast over the batch, so any number of
+    ## latents can be decoded at once (<batch_size> is kept for old callers)
+    self.pos_embed = np.arange(0,max_len)
       
-  def call(self, x, training=True):
-    pos_embeddings = self.pos_emb(self.batch_pos_embed)
-    x = self.rv(x)
+  ## <length> decodes only the first positions. Attention is over all the
+  ## positions that are decoded, so unlike the LSTM decoders of the VAEs
+  ## this only approximates the first positions of a full length decode
+  def call(self, x, training=True, length=None):
+    if length is None:
+      pos_embeddings = self.pos_emb(self.pos_embed)
+      x = self.rv(x)
+    else:
+      pos_embeddings = self.pos_emb(self.pos_embed[:length])
+      x = tf.repeat(tf.expand_dims(x, 1), length, axis=1)
     out = self.dense0(x)
-    out = keras.layers.Add()([out,pos_embeddings])
+    out = out + pos_embeddings[tf.newaxis]
     for decoder_layer in self.decoder_layers:
        out = decoder_layer(out)
     out = self.lstm1(out)
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Knowledge distillation of the latent Transformer decoder into a smaller
+student decoder. The teacher (6 layers, 384 dim, 6 heads) decodes latents
+better than the VAE decoders but is too slow for the GA loops, which decode
+hundreds of perturbations per candidate. The student is the same
+decoderTransformerLatent.Transformer with fewer and narrower layers, trained
+on the teacher's softened output distributions over sampled latents, so no
+labelled molecules are needed.
+
+Decoders are compared on validity, uniqueness and reconstruction, either on
+a fixed set of latents or on as many latents as each decodes within the
+same time budget.
+"""
+
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import models.decoders.decoderTransformerLatent as decoderTransformerLatent
+import Utils.tokenization as tokenization
+import Utils.proc_chem as proc_chem
+
+def build_student(teacher, num_layers=2, embedding_dim=192, num_heads=4, d_hid=None):
+  """
+  Creates a student decoder with the teacher's vocabulary and length.
+  :param teacher: The trained Transformer decoder.
+  :param num_layers: Number of attention layers of the student.
+  :param embedding_dim: Width of the student, must be divisible by num_heads.
+  :param d_hid: Width of the position-wise feed forward layers.
+  """
+  return decoderTransformerLatent.Transformer(
+      batch_size=None, embedding_dim=embedding_dim,
+      embedding_dropout=teacher.embedding_dropout,
+      vocab_size=teacher.vocab_size, max_len=teacher.max_len,
+      num_heads=num_heads, num_layers=num_layers,
+      attention_dropout=teacher.attention_dropout,
+      d_hid=d_hid or embedding_dim*4,
+      residual_dropout=teacher.residual_dropout,
+      use_one_embedding_dropout=False)
+
+def sample_latents(num, latent_dim, corpus_latents=None,
+                   prior_fraction=0.5, noise_norm=1.0, rng=np.random):
+  """
+  Samples latents to distill on: a mix of prior samples and perturbed
+  latents of encoded molecules, so the student sees both the regions the
+  optimizers explore and the regions real molecules occupy.
+  :param corpus_latents: Array [N, latent_dim] of encoded molecules.
+  :param prior_fraction: Fraction drawn from N(0, I).
+  :param noise_norm: Scale of the gaussian noise added to corpus latents.
+  """
+  if corpus_latents is None:
+    return rng.normal(size=(num, latent_dim)).astype(np.float32)
+  num_prior = int(round(num*prior_fraction))
+  prior = rng.normal(size=(num_prior, latent_dim))
+  idx = rng.randint(0, len(corpus_latents), size=num - num_prior)
+  noise = rng.normal(size=(len(idx), latent_dim))*noise_norm/np.sqrt(latent_dim)
+  z = np.concatenate([prior, np.asarray(corpus_latents)[idx] + noise])
+  return z.astype(np.float32)
+
+def distillation_loss(student_logits, teacher_logits, temperature=2.0,
+                      alpha=0.5, eos_index=2):
+  """
+  Mixes the KL divergence between the temperature softened teacher and
+  student distributions with cross entropy on the teacher's greedy tokens.
+  Positions after the teacher's first <EOS> are ignored.
+  """
+  hard = tf.argmax(teacher_logits, axis=-1)
+  is_eos = tf.cast(tf.equal(hard, eos_index), tf.float32)
+  weights = tf.cast(tf.equal(tf.cumsum(is_eos, axis=1, exclusive=True), 0), tf.float32)
+
+  teacher_probs = tf.nn.softmax(teacher_logits/temperature, axis=-1)
+  student_log_probs = tf.nn.log_softmax(student_logits/temperature, axis=-1)
+  kl = tf.reduce_sum(teacher_probs*(tf.math.log(teacher_probs + 1e-9) - student_log_probs), axis=-1)
+  ce = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=hard, logits=student_logits)
+
+  ## T^2 keeps the soft gradient on the same scale as the hard one
+  loss = alpha*temperature**2*kl + (1 - alpha)*ce
+  return tf.reduce_sum(loss*weights)/tf.maximum(tf.reduce_sum(weights), 1.0)
+
+def distill(teacher, student, latent_sampler, steps, batch_size=256,
+            learning_rate=1e-4, temperature=2.0, alpha=0.5, eos_index=2,
+            display_step=100):
+  """
+  Trains <student> to reproduce <teacher>'s outputs.
+  :param latent_sampler: Function num -> latents [num, LATENT_DIM], e.g.
+                         functools.partial(sample_latents, latent_dim=64, ...).
+  :return: List of the training losses.
+  """
+  optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate)
+  losses = []
+  for step in range(steps):
+    z = latent_sampler(batch_size)
+    teacher_logits = teacher(z, training=False)
+    with tf.GradientTape() as tape:
+      student_logits = student(z, training=True)
+      loss_op = distillation_loss(student_logits, teacher_logits,
+                                  temperature, alpha, eos_index)
+    gradients = tape.gradient(loss_op, student.trainable_variables)
+    optimizer.apply_gradients(zip(gradients, student.trainable_variables))
+    losses.append(float(loss_op))
+
+    if step % display_step == 0:
+      agreement = tf.reduce_mean(tf.cast(tf.equal(tf.argmax(student_logits, -1),
+                                                  tf.argmax(teacher_logits, -1)), tf.float32))
+      print("Step " + str(step) + ", Distillation Loss = " + \
+            "{:.3f}".format(loss_op) + ", Token Agreement = " + \
+            "{:.3f}".format(agreement))
+  return losses
+
+def decode_latents(decoder, latents, vocab_index, representation,
+                   batch_size=256, time_budget=None):
+  """
+  Decodes latents to SMILES in batches.
+  :param time_budget: If given, stop after the batch that exceeds this many
+                      seconds.
+  :return: (smiles, seconds) where smiles has one entry (or None) for every
+           latent that was decoded.
+  """
+  smiles = []
+  start = time.time()
+  for i in range(0, len(latents), batch_size):
+    logits = decoder(np.asarray(latents[i:i + batch_size], dtype=np.float32), training=False)
+    strings = tokenization.logits_to_strings(logits, vocab_index)
+    smiles.extend(tokenization.strings_to_smiles(strings, representation))
+    if time_budget is not None and time.time() - start > time_budget:
+      break
+  return smiles, time.time() - start
+
+def decode_metrics(smiles, reference_smiles=None):
+  """
+  Validity, uniqueness and (given the molecules the latents were encoded
+  from) reconstruction of a list of decoded SMILES.
+  """
+  canonical = [proc_chem.canonical_smiles(s) if s else None for s in smiles]
+  valid = [c for c in canonical if c is not None]
+  metrics = {'decoded': len(smiles),
+             'valid': len(valid),
+             'unique': len(set(valid)),
+             'validity': len(valid)/float(max(len(smiles), 1)),
+             'uniqueness': len(set(valid))/float(max(len(valid), 1))}
+  if reference_smiles is not None:
+    matches = 0
+    for c, ref in zip(canonical, reference_smiles):
+      if c is not None and c == proc_chem.canonical_smiles(ref):
+        matches += 1
+    metrics['reconstruction'] = matches/float(max(len(canonical), 1))
+  return metrics
+
+def compare_decoders(decoders, latents, vocab_index, representation,
+                     reference_smiles=None, batch_size=256, time_budget=None):
+  """
+  Compares decoders, e.g. {'teacher': transformer, 'student': student}.
+  With a time budget every decoder gets the same wall-clock time, so a
+  faster decoder is credited with the extra valid unique molecules it
+  produces. Latents must be plentiful enough not to run out in the budget.
+  :return: Dict of name -> metrics including molecules_per_second.
+  """
+  results = {}
+  for name, decoder in decoders.items():
+    ## Warm up so that graph building is not counted against the budget
+    decoder(np.asarray(latents[:batch_size], dtype=np.float32), training=False)
+    smiles, seconds = decode_latents(decoder, latents, vocab_index, representation,
+                                     batch_size, time_budget)
+    refs = None if reference_smiles is None else reference_smiles[:len(smiles)]
+    metrics = decode_metrics(smiles, refs)
+    metrics['seconds'] = seconds
+    metrics['molecules_per_second'] = len(smiles)/max(seconds, 1e-9)
+    results[name] = metrics
+    print(name + ": " + \
+          "{:.1f}".format(metrics['molecules_per_second']) + " mol/s, Validity = " + \
+          "{:.3f}".format(metrics['validity']) + ", Uniqueness = " + \
+          "{:.3f}".format(metrics['uniqueness']) + \
+          ("" if refs is None else ", Reconstruction = " + \
+           "{:.3f}".format(metrics['reconstruction'])))
+  return results
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Predicts from a latent point where its decoded molecule ends, so decoders
+only produce the positions that are needed instead of all PAD_SIZE of them.
+Most ChEMBL molecules end well before position 250 while attention costs
+grow with the square of the decoded length.
+
+The LengthPredictor is a small MLP on the latent, trained with a quantile
+(pinball) loss so that it tends to overestimate. Latents are grouped into
+buckets of predicted length and each bucket is decoded at its boundary;
+rows without an <EOS> inside the truncated decode are decoded again at full
+length. For the LSTM decoders of the VAEs (conv_smiles_vae, ic50vae) the
+truncated decode is exactly the start of the full one, so the decoded
+molecules do not change. The Transformer decoder attends over every decoded
+position, so for it the result is an approximation and evaluate_truncation
+reports how many molecules change.
+"""
+
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import layers
+
+import Utils.tokenization as tokenization
+import Utils.proc_chem as proc_chem
+
+def eos_lengths(X, eos_index=2, strip_bos=False):
+  """
+  Number of positions a decoder has to produce to reach the <EOS> of every
+  row, or the full width for rows without one.
+  :param X: Integer array [N, L] of tokens or of greedy decoded tokens.
+  :param strip_bos: The rows were cut after <BOS> (decoder targets X[:,1:]).
+  """
+  X = np.asarray(X)
+  is_eos = X == eos_index
+  lengths = np.where(is_eos.any(axis=1), np.argmax(is_eos, axis=1) + 1, X.shape[1])
+  return lengths + (1 if strip_bos else 0)
+
+class LengthPredictor(tf.keras.Model):
+  def __init__(self, max_len, hidden_dim=128, quantile=0.95):
+    super(LengthPredictor, self).__init__()
+    self.max_len = max_len
+    self.quantile = quantile
+    self.dense1 = layers.Dense(hidden_dim, activation='relu')
+    self.dense2 = layers.Dense(hidden_dim, activation='relu')
+    self.out = layers.Dense(1)
+
+  ## Predicted number of positions to decode, as a float of shape [N]
+  def call(self, z):
+    x = self.dense1(z)
+    x = self.dense2(x)
+    return tf.squeeze(self.out(x), axis=-1)*self.max_len
+
+  ## Pinball loss: underestimates cost <quantile>, overestimates 1 - <quantile>
+  def loss(self, lengths, predicted):
+    diff = (tf.cast(lengths, tf.float32) - predicted)/self.max_len
+    return tf.reduce_mean(tf.maximum(self.quantile*diff, (self.quantile - 1)*diff))
+
+def train_length_predictor(predictor, Z, lengths, epochs=10, batch_size=256,
+                           learning_rate=1e-3, display_step=100):
+  """
+  Fits <predictor> on latents <Z> [N, LATENT_DIM] and the decode lengths of
+  the molecules they came from (eos_lengths of the decoder's targets, or of
+  the decoder's own greedy output to predict what it will produce).
+  """
+  optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate)
+  Z = np.asarray(Z, dtype=np.float32)
+  lengths = np.asarray(lengths, dtype=np.float32)
+  step = 0
+  for epoch in range(epochs):
+    indxs = np.random.permutation(len(Z))
+    for start in range(0, len(Z), batch_size):
+      idx = indxs[start:start + batch_size]
+      with tf.GradientTape() as tape:
+        loss_op = predictor.loss(lengths[idx], predictor(Z[idx]))
+      gradients = tape.gradient(loss_op, predictor.trainable_variables)
+      optimizer.apply_gradients(zip(gradients, predictor.trainable_variables))
+      if step % display_step == 0:
+        print("Epoch " + str(epoch) + ", Step " + str(step) + ", Length Loss = " + \
+              "{:.4f}".format(loss_op))
+      step += 1
+  return predictor
+
+class TruncatedDecoder(object):
+  """
+  Decodes latents at their predicted lengths.
+  :param decoder: A decoder taking (z, length=...), e.g. a
+                  decoderTransformerLatent.Transformer or vae.decoder.
+  :param predictor: A trained LengthPredictor.
+  :param max_len: Full decode length of <decoder>.
+  :param multiple: Decode lengths are rounded up to a multiple of this, which
+                   bounds the number of distinct shapes.
+  :param margin: Positions added to every prediction.
+  """
+  def __init__(self, decoder, predictor, max_len, multiple=16, margin=8,
+               eos_index=2, pad_index=0):
+    self.decoder = decoder
+    self.predictor = predictor
+    self.max_len = max_len
+    self.multiple = multiple
+    self.margin = margin
+    self.eos_index = eos_index
+    self.pad_index = pad_index
+    self.stats = {'decoded': 0, 'fallbacks': 0, 'positions': 0}
+
+  def bucket_lengths(self, z):
+    predicted = self.predictor(z).numpy() + self.margin
+    lengths = np.ceil(predicted/self.multiple).astype(np.int64)*self.multiple
+    return np.clip(lengths, self.multiple, self.max_len)
+
+  def _decode(self, z, length):
+    logits = self.decoder(z, length=int(length), training=False)
+    return np.argmax(np.asarray(logits), axis=-1)
+
+  def __call__(self, z):
+    """
+    :return: Greedy decoded tokens [N, max_len], padded with <PAD>.
+    """
+    z = np.asarray(z, dtype=np.float32)
+    tokens = np.full((len(z), self.max_len), self.pad_index, dtype=np.int64)
+    lengths = self.bucket_lengths(z)
+    fallback = []
+    for length in np.unique(lengths):
+      idx = np.flatnonzero(lengths == length)
+      decoded = self._decode(z[idx], length)
+      self.stats['positions'] += len(idx)*int(length)
+      if length < self.max_len:
+        found = (decoded == self.eos_index).any(axis=1)
+        fallback.append(idx[~found])
+        idx, decoded = idx[found], decoded[found]
+      tokens[idx, :decoded.shape[1]] = decoded
+    fallback = np.concatenate(fallback) if len(fallback) > 0 else np.zeros(0, np.int64)
+    ## The prediction was too short: no <EOS> appeared, so decode in full
+    if len(fallback) > 0:
+      tokens[fallback] = self._decode(z[fallback], self.max_len)
+      self.stats['positions'] += len(fallback)*self.max_len
+    self.stats['decoded'] += len(z)
+    self.stats['fallbacks'] += len(fallback)
+    return tokens
+
+def evaluate_truncation(decoder, truncated, latents, vocab_index, representation,
+                        batch_size=256):
+  """
+  Decodes held out latents in full and truncated, and compares speed,
+  validity and how many decoded molecules differ.
+  :param truncated: A TruncatedDecoder wrapping <decoder>.
+  """
+  ## Warm up both paths so graph building is not timed
+  truncated(latents[:batch_size])
+  decoder(np.asarray(latents[:batch_size], dtype=np.float32), training=False)
+  truncated.stats = {'decoded': 0, 'fallbacks': 0, 'positions': 0}
+
+  full_strings, trunc_strings = [], []
+  start = time.time()
+  for i in range(0, len(latents), batch_size):
+    z = np.asarray(latents[i:i + batch_size], dtype=np.float32)
+    full_strings.extend(tokenization.logits_to_strings(decoder(z, training=False), vocab_index))
+  full_seconds = time.time() - start
+  start = time.time()
+  for i in range(0, len(latents), batch_size):
+    trunc_strings.extend(tokenization.tokens_to_strings(truncated(latents[i:i + batch_size]), vocab_index))
+  trunc_seconds = time.time() - start
+
+  def validity(strings):
+    smiles = tokenization.strings_to_smiles(strings, representation)
+    return np.mean([s is not None and proc_chem.smiles_check(s) is not None for s in smiles])
+
+  report = {'full_seconds': full_seconds,
+            'truncated_seconds': trunc_seconds,
+            'speedup': full_seconds/max(trunc_seconds, 1e-9),
+            'full_validity': validity(full_strings),
+            'truncated_validity': validity(trunc_strings),
+            'changed': np.mean([a != b for a, b in zip(full_strings, trunc_strings)]),
+            'fallback_rate': truncated.stats['fallbacks']/float(max(truncated.stats['decoded'], 1)),
+            'position_reduction': 1 - truncated.stats['positions']/float(max(len(latents)*truncated.max_len, 1))}
+  print("Speedup = " + "{:.2f}".format(report['speedup']) + ", Validity = " + \
+        "{:.3f}".format(report['full_validity']) + " -> " + \
+        "{:.3f}".format(report['truncated_validity']) + ", Changed = " + \
+        "{:.3f}".format(report['changed']) + ", Fallbacks = " + \
+        "{:.3f}".format(report['fallback_rate']))
+  return report
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Predicts from a latent point whether it will decode to a valid molecule,
+and to one that has not been decoded before, so that optimizers can skip
+hopeless points instead of finding out after a full decoder pass,
+SELFIES / DeepSMILES conversion and RDKit sanitization.
+
+The ValidityClassifier is a small MLP on the latent with two sigmoid
+heads, trained on logged decode outcomes of a SMILE_VAE or Transformer
+decoder (decode_outcomes). FilteredModel wraps a LatentModel so that the
+GA and the pipeline decode only the latents the classifier accepts; a
+random share of the rejected ones is decoded anyway (and kept) to estimate
+how many valid molecules the filter throws away. BayesianOptimizer takes
+the same wrapper, or anything with accept(Z), to drop candidates before
+proposing them.
+"""
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import layers
+
+HEADS = {'valid': 0, 'unique': 1}
+
+def decode_outcomes(model, Z):
+  """
+  Decodes latents and labels them for training.
+  :param model: A Utils.latent_model.LatentModel.
+  :return: (valid, unique) boolean arrays [N]; unique marks the first
+           latent of the log that decoded to each molecule.
+  """
+  smiles = model.decode(Z, canonical=True)
+  valid = np.array([s is not None for s in smiles])
+  unique = np.zeros(len(smiles), dtype=bool)
+  seen = set()
+  for i, s in enumerate(smiles):
+    if s is not None and s not in seen:
+      seen.add(s)
+      unique[i] = True
+  return valid, unique
+
+class ValidityClassifier(tf.keras.Model):
+  def __init__(self, hidden_dim=128, dropout_rate=0.1):
+    super(ValidityClassifier, self).__init__()
+    self.dense1 = layers.Dense(hidden_dim, activation='relu')
+    self.drop1 = layers.Dropout(dropout_rate)
+    self.dense2 = layers.Dense(hidden_dim, activation='relu')
+    self.out = layers.Dense(2)
+
+  ## Logits of (valid, unique), [N, 2]
+  def call(self, z, training=False):
+    x = self.drop1(self.dense1(z), training=training)
+    x = self.dense2(x)
+    return self.out(x)
+
+  def loss(self, labels, logits):
+    return tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(
+        labels=tf.cast(labels, tf.float32), logits=logits))
+
+  def probabilities(self, Z, batch_size=8192):
+    Z = np.asarray(Z, dtype=np.float32)
+    out = np.zeros((len(Z), 2), dtype=np.float32)
+    for i in range(0, len(Z), batch_size):
+      out[i:i + batch_size] = tf.sigmoid(self(Z[i:i + batch_size])).numpy()
+    return out
+
+def train_validity_classifier(classifier, Z, valid, unique, epochs=10, batch_size=256,
+                              learning_rate=1e-3, display_step=100):
+  """
+  Fits <classifier> on latents <Z> [N, LATENT_DIM] and their decode
+  outcomes from decode_outcomes.
+  """
+  optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate)
+  Z = np.asarray(Z, dtype=np.float32)
+  labels = np.stack([valid, unique], axis=1).astype(np.float32)
+  step = 0
+  for epoch in range(epochs):
+    indxs = np.random.permutation(len(Z))
+    for start in range(0, len(Z), batch_size):
+      idx = indxs[start:start + batch_size]
+      with tf.GradientTape() as tape:
+        loss_op = classifier.loss(labels[idx], classifier(Z[idx], training=True))
+      gradients = tape.gradient(loss_op, classifier.trainable_variables)
+      optimizer.apply_gradients(zip(gradients, classifier.trainable_variables))
+      if step % display_step == 0:
+        print("Epoch " + str(epoch) + ", Step " + str(step) + ", Validity Loss = " + \
+              "{:.4f}".format(loss_op))
+      step += 1
+  return classifier
+
+class FilteredModel(object):
+  """
+  A LatentModel that only decodes the latents the classifier accepts.
+  Rejected latents decode to None (decode) or '' (decode_strings), so the
+  GA and the pipeline drop them as invalid. Everything else is passed to
+  the wrapped model.
+  :param model: A Utils.latent_model.LatentModel.
+  :param classifier: A trained ValidityClassifier.
+  :param threshold: Smallest probability of the head that is decoded.
+  :param head: 'valid', or 'unique' to also skip latents that would most
+               likely decode to a molecule found before.
+  :param audit_fraction: Share of the rejected latents decoded anyway to
+                         measure the filter.
+  """
+  def __init__(self, model, classifier, threshold=0.1, head='valid',
+               audit_fraction=0.05, seed=None):
+    self.model = model
+    self.classifier = classifier
+    self.threshold = threshold
+    self.head = HEADS[head]
+    self.audit_fraction = audit_fraction
+    self.rng = np.random.RandomState(seed)
+    ## audited counts the rejected latents decoded anyway, audit_checked
+    ## those whose validity was seen (decode, not decode_strings)
+    self.stats = {'latents': 0, 'rejected': 0, 'audited': 0, 'audit_checked': 0,
+                  'audited_valid': 0}
+
+  def __getattr__(self, name):
+    if name == 'model':
+      raise AttributeError(name)
+    return getattr(self.model, name)
+
+  def accept(self, Z):
+    """
+    Boolean mask of the latents worth decoding.
+    """
+    return self.classifier.probabilities(Z)[:, self.head] >= self.threshold
+
+  def _split(self, Z):
+    accepted = self.accept(Z)
+    audit = ~accepted & (self.rng.uniform(size=len(Z)) < self.audit_fraction)
+    self.stats['latents'] += len(Z)
+    self.stats['rejected'] += int((~accepted).sum())
+    self.stats['audited'] += int(audit.sum())
+    return accepted, audit
+
+  def decode_strings(self, Z):
+    Z = np.asarray(Z, dtype=np.float32)
+    accepted, audit = self._split(Z)
+    ## Audited latents are passed on, but without validation here they do
+    ## not count towards the rejected valid rate
+    rows = np.flatnonzero(accepted | audit)
+    strings = [''] * len(Z)
+    for i, s in zip(rows, self.model.decode_strings(Z[rows])):
+      strings[i] = s
+    return strings
+
+  def decode(self, Z, canonical=False):
+    Z = np.asarray(Z, dtype=np.float32)
+    accepted, audit = self._split(Z)
+    rows = np.flatnonzero(accepted | audit)
+    smiles = [None] * len(Z)
+    for i, s in zip(rows, self.model.decode(Z[rows], canonical=canonical)):
+      smiles[i] = s
+    self.stats['audit_checked'] += int(audit.sum())
+    self.stats['audited_valid'] += sum(1 for i in np.flatnonzero(audit) if smiles[i] is not None)
+    return smiles
+
+  def report(self):
+    """
+    Decode work saved and the estimated number of valid molecules rejected.
+    The rate is NaN when the audits were only decoded through
+    decode_strings (the pipeline), which does not see their validity.
+    """
+    s = self.stats
+    saved = (s['rejected'] - s['audited'])/float(max(s['latents'], 1))
+    checked = s['audit_checked']
+    rate = s['audited_valid']/float(checked) if checked else float('nan')
+    return {'saved_fraction': saved,
+            'rejected_valid_rate': rate,
+            'rejected_valid_estimate': rate*s['rejected']}
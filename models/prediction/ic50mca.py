@@ -534,6 +534,7 @@ class IC50_MCA(tf.keras.Model):
     self.hidden_dim = hidden_dim
     self.latent_dim = latent_dim
     self.rv = tf.keras.layers.RepeatVector(max_len-1)
+    self.lstm1 = tf.keras.layers.LSTM(hidden_dim, return_sequences = True)
 
     self.cal =  ContextualAttentionLayer(hidden_dim= hidden_dim+latent_dim*4)
     self.drop2 = layers.Dropout(dropout_rate)
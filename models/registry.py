@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+Registry of the trained models, so notebooks and workers ask for a model by
+(representation, family, latent_dim) instead of repeating the
+IMPLICIT / IC50 / DEEP / SELFIES chains that choose constructor arguments
+and weight files.
+
+Families:
+  'vae'                   conv_smiles_vae.SMILE_VAE
+  'ic50vae'               ic50vae.SMILE_VAE, trained jointly with IC50
+  'implicit'              implicitvae.SMILE_IMPLICIT_VAE
+  'transformer'           decoderTransformerLatent.Transformer on 'vae' latents
+  'ic50_transformer'      the Transformer on 'ic50vae' latents
+  'implicit_transformer'  the Transformer on 'implicit' latents
+  'ic50mca'               ic50mca.IC50_MCA predictor on 'ic50vae' latents
+
+load() builds a model, restores its weights and caches it for the life of
+the process, so a checkpoint is read at most once per process however many
+times it is asked for. export() saves traced encode / decode / predict
+functions as a SavedModel; load_exported() serves them without rebuilding
+the Python model, which is the fast way to start worker processes.
+
+The models are tf.keras 2 models. From TensorFlow 2.16 on, tf.keras is
+Keras 3 unless TF_USE_LEGACY_KERAS=1 is set (with the tf_keras package
+installed) before TensorFlow is first imported; the registry refuses to
+import under Keras 3, where the Transformers do not build and the IC50_MCA
+export fails.
+"""
+
+import os
+import json
+import threading
+
+import numpy as np
+import tensorflow as tf
+
+## tf_keras (TF_USE_LEGACY_KERAS=1) has no version on the tf.keras module
+if int((getattr(tf.keras, '__version__', None) or '2').split('.')[0]) >= 3:
+  raise ImportError('models.registry needs tf.keras 2, but tf.keras is Keras ' +
+                    tf.keras.__version__ + '; install tf_keras and set '
+                    'TF_USE_LEGACY_KERAS=1 before importing TensorFlow')
+
+import models.autoencoders.conv_smiles_vae as conv_smiles_vae
+import models.autoencoders.ic50vae as ic50vae
+import models.autoencoders.implicitvae as implicitvae
+import models.decoders.decoderTransformerLatent as decoderTransformerLatent
+import models.prediction.ic50mca as ic50mca
+
+## Constants shared by the training and optimization notebooks
+EMBEDDING_DIM = 192
+HIDDEN_DIM = 256
+DROP_OUT = 0.2
+NUM_GENES = 2128
+PAD_SIZES = {'smiles': 160, 'deep': 250, 'selfies': 250}
+
+TRANSFORMERS = ('transformer', 'ic50_transformer', 'implicit_transformer')
+
+## (representation, family, latent_dim) -> weights as named in the notebooks
+WEIGHTS = {
+  ('smiles', 'vae', 64): 'smiles_conv_vae_weights2',
+  ('deep', 'vae', 64): 'deep_conv_vae_weights2',
+  ('selfies', 'vae', 64): 'selfies_conv_vae_weights2',
+  ('smiles', 'vae', 32): 'smiles32_conv_vae_weights2',
+  ('deep', 'vae', 32): 'deep32_conv_vae_weights2',
+  ('selfies', 'vae', 32): 'selfies32_conv_vae_weights2',
+  ('smiles', 'ic50vae', 64): 'amazing_ic50g_smiles_conv_vae_weights',
+  ('deep', 'ic50vae', 64): 'ic50g_deep_conv_vae_weights',
+  ('selfies', 'ic50vae', 64): 'ic50g_selfies_conv_vae_weights',
+  ('smiles', 'implicit', 64): 'smiles_ivae_weights',
+  ('deep', 'implicit', 64): 'deep_smiles_ivae_weights',
+  ('selfies', 'implicit', 64): 'selfies_ivae_weights',
+  ('smiles', 'transformer', 64): 'decoding_smiles_latent3',
+  ('deep', 'transformer', 64): 'decoding_deep_smiles_latent3',
+  ('selfies', 'transformer', 64): 'decoding_selfies_latent3',
+  ('smiles', 'ic50_transformer', 64): 'amazing_ic50g_decoding_smiles_latent3',
+  ('deep', 'ic50_transformer', 64): 'ic50g_decoding_deep_latent3',
+  ('selfies', 'ic50_transformer', 64): 'ic50g_decoding_selfies_latent3',
+  ('smiles', 'implicit_transformer', 64): 'ivae_decoding_smiles_latent',
+  ('deep', 'implicit_transformer', 64): 'ivae_decoding_deep_latent',
+  ('selfies', 'implicit_transformer', 64): 'ivae_decoding_selfies_latent',
+  ('smiles', 'ic50mca', 64): 'new_updated_ic50g_ic50network_smiles_basic',
+  ('selfies', 'ic50mca', 64): 'new_ic50network_selfies',
+}
+
+_cache = {}
+_lock = threading.Lock()
+
+def max_len(representation, family):
+  """
+  Sequence length a model was built with. The VAEs and the predictor were
+  trained on X[:,:-1] (PAD_SIZE - 1 positions); the Transformer decoders
+  produce all PAD_SIZE positions.
+  """
+  pad_size = PAD_SIZES[representation]
+  return pad_size if family in TRANSFORMERS else pad_size - 1
+
+def weights_name(representation, family, latent_dim=64):
+  key = (representation, family, latent_dim)
+  if key not in WEIGHTS:
+    raise KeyError('No trained weights registered for {}'.format(key))
+  return WEIGHTS[key]
+
+def build(representation, family, vocab_size, latent_dim=64):
+  """
+  Creates an untrained model and its variables.
+  """
+  length = max_len(representation, family)
+  if family == 'vae':
+    model = conv_smiles_vae.SMILE_VAE(vocab_size=vocab_size, embedding_dim=EMBEDDING_DIM,
+                                      max_len=length, latent_dim=latent_dim,
+                                      recurrent_dropout=DROP_OUT, dropout_rate=DROP_OUT)
+    model(np.ones((1, length), dtype=np.int32))
+  elif family == 'ic50vae':
+    model = ic50vae.SMILE_VAE(vocab_size=vocab_size, embedding_dim=EMBEDDING_DIM,
+                              max_len=length, latent_dim=latent_dim,
+                              recurrent_dropout=DROP_OUT, dropout_rate=DROP_OUT)
+    model(np.ones((1, length), dtype=np.int32))
+  elif family == 'implicit':
+    model = implicitvae.SMILE_IMPLICIT_VAE(vocab_size=vocab_size, embedding_dim=EMBEDDING_DIM,
+                                           max_len=length, latent_dim=latent_dim,
+                                           hidden_dim=HIDDEN_DIM, recurrent_dropout=0.2,
+                                           dropout_rate=0.2, epsilon_std=1.0)
+    model(np.ones((1, length), dtype=np.int32))
+  elif family in TRANSFORMERS:
+    model = decoderTransformerLatent.Transformer(batch_size=None, embedding_dim=384,
+                                                 embedding_dropout=DROP_OUT, max_len=length,
+                                                 num_heads=6, num_layers=6,
+                                                 vocab_size=vocab_size, attention_dropout=DROP_OUT,
+                                                 d_hid=EMBEDDING_DIM*4,
+                                                 use_one_embedding_dropout=False)
+    model(np.zeros((1, latent_dim), dtype=np.float32), training=False)
+  elif family == 'ic50mca':
+    model = ic50mca.IC50_MCA(vocab_size=vocab_size, embedding_dim=EMBEDDING_DIM,
+                             num_genes=NUM_GENES, hidden_dim=HIDDEN_DIM,
+                             max_len=length, latent_dim=latent_dim)
+    model(encoded_smiles=np.zeros((1, latent_dim), dtype=np.float32),
+          genes=np.zeros((1, NUM_GENES), dtype=np.float32))
+  else:
+    raise ValueError('Unknown model family {}'.format(family))
+  return model
+
+def load(representation, family, vocab_size, latent_dim=64,
+         weights_dir='.', weights=None):
+  """
+  Returns the trained model, building it and restoring its weights only the
+  first time it is asked for in this process.
+  :param weights_dir: Directory holding the weight files.
+  :param weights: Weight file name, defaults to the registered one.
+  """
+  path = os.path.join(weights_dir, weights or weights_name(representation, family, latent_dim))
+  key = (representation, family, latent_dim, vocab_size, os.path.abspath(path))
+  with _lock:
+    if key not in _cache:
+      model = build(representation, family, vocab_size, latent_dim)
+      model.load_weights(path)
+      _cache[key] = model
+    return _cache[key]
+
+def clear_cache():
+  with _lock:
+    _cache.clear()
+
+## Traced entry points of a model, saved by export(). Only the parts that
+## are served are tracked, the VAEs' own calls sample noise in numpy
+class _Serving(tf.Module):
+  def __init__(self, model, family, length, latent_dim):
+    super(_Serving, self).__init__()
+    tokens = tf.TensorSpec([None, length], tf.int32)
+    latents = tf.TensorSpec([None, latent_dim], tf.float32)
+    genes = tf.TensorSpec([None, NUM_GENES], tf.float32)
+    if family in ('vae', 'ic50vae', 'implicit'):
+      self.encoder = model.encoder
+      self.decoder = model.decoder
+      args = (None,) if family == 'implicit' else ()
+      self.encode = tf.function(lambda x: self.encoder(x, *args)[1], input_signature=[tokens])
+      self.decode = tf.function(lambda z: self.decoder(z), input_signature=[latents])
+    elif family in TRANSFORMERS:
+      self.model = model
+      self.decode = tf.function(lambda z: self.model(z, training=False), input_signature=[latents])
+    elif family == 'ic50mca':
+      self.model = model
+      self.predict = tf.function(lambda z, g: self.model(encoded_smiles=z, genes=g),
+                                 input_signature=[latents, genes])
+
+def export(model, directory, representation, family, vocab_size, latent_dim=64):
+  """
+  Saves the traced encode / decode / predict functions of <model> with a
+  metadata.json describing it.
+  """
+  length = max_len(representation, family)
+  tf.saved_model.save(_Serving(model, family, length, latent_dim), directory)
+  with open(os.path.join(directory, 'metadata.json'), 'w') as f:
+    json.dump({'representation': representation, 'family': family,
+               'latent_dim': latent_dim, 'vocab_size': vocab_size,
+               'max_len': length}, f)
+
+def load_exported(directory):
+  """
+  Loads an exported model once per process.
+  :return: (serving, metadata) where serving has encode / decode / predict.
+  """
+  key = ('exported', os.path.abspath(directory))
+  with _lock:
+    if key not in _cache:
+      with open(os.path.join(directory, 'metadata.json')) as f:
+        metadata = json.load(f)
+      _cache[key] = (tf.saved_model.load(directory), metadata)
+    return _cache[key]
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+Property maps over a LatentStore whose corpus was encoded again with a new
+checkpoint, with a deterministic stand-in for the LatentModel.
+"""
+
+import numpy as np
+
+import Evaluations.projection as projection
+import Utils.latent_store as latent_store
+
+LATENT_DIM = 4
+
+class RowModel(object):
+  ## Tokens are the corpus rows; latents depend on the row and the weights
+  def __init__(self, offset):
+    self.offset = offset
+
+  def encode_tokens(self, X):
+    rows = np.asarray(X, dtype=np.float32)[:, :1]
+    z_mean = np.concatenate([rows, rows**2/100.0, np.sin(rows), np.full_like(rows, self.offset)],
+                            axis=1)
+    return z_mean, np.zeros_like(z_mean)
+
+def test_map_counts_each_id_once_after_reencoding(tmp_path):
+  tokens = np.arange(50)[:, None]
+  store = latent_store.LatentStore(str(tmp_path/'store'))
+  latent_store.encode_corpus(store, RowModel(0.0), 'first', tokens=tokens[:30], chunk_size=8,
+                             verbose=False)
+  latent_store.encode_corpus(store, RowModel(1.0), 'second', tokens=tokens, chunk_size=16,
+                             verbose=False)
+  assert len(store) == 50
+  assert sum(len(ids) for ids, _ in store.scan_chunks()) == 80
+
+  proj = projection.LatentProjection().fit_store(store)
+  accumulator = projection.property_map(store, proj, np.arange(50, dtype=np.float64))
+  assert accumulator.counts.sum() == len(store)
+  ## Only the latents of the second checkpoint are mapped
+  Z = np.concatenate([np.asarray(Z, dtype=np.float32) for _, Z in store.scan()])
+  assert np.all(Z[:, 3] == 1.0)
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Resuming a GA run from its run log after a crash in the middle of a
+generation, with a deterministic stand-in for the LatentModel.
+"""
+
+import numpy as np
+import pytest
+
+import Optimizations.genetic as genetic
+import Optimizations.run_log as run_log
+
+LATENT_DIM = 4
+
+class ChainModel(object):
+  ## Latents decode to carbon chains whose length depends on the first
+  ## coordinate, and chains encode back to a fixed latent
+  def decode(self, Z, canonical=False):
+    return ['C'*(1 + int(abs(z[0])*7) % 40) for z in Z]
+
+  def encode(self, smiles):
+    Z = np.zeros((len(smiles), LATENT_DIM), dtype=np.float32)
+    Z[:, 0] = [len(s)/7.0 for s in smiles]
+    return Z, np.ones(len(smiles), dtype=bool)
+
+def chain_objective(Z, smiles):
+  return np.array([abs(len(s) - 20) for s in smiles], dtype=np.float64)
+
+def make_optimizer(log):
+  return genetic.GeneticOptimizer(ChainModel(), chain_objective, num_out=5, num_children=4,
+                                  decode_attempts=8, mutation_norm=2.0, seed=0,
+                                  verbose=False, run_log=log)
+
+class Crash(Exception):
+  pass
+
+def test_resume_after_crash_mid_generation(tmp_path, monkeypatch):
+  num_generations, crash_at = 4, 3
+  reference = make_optimizer(run_log.RunLog(str(tmp_path/'reference'), batch_size=1))
+  population = reference.initial_population(['CC', 'CCCC', 'CCCCCC'])
+  final = reference.run(population, num_generations)
+  reference.run_log.flush()
+
+  ## Every append is flushed, then the run dies before the state of
+  ## generation <crash_at> is saved
+  directory = str(tmp_path/'crashed')
+  ga = make_optimizer(run_log.RunLog(directory, batch_size=1))
+  save_state = run_log.RunLog.save_state
+  def crashing_save_state(self, generation, *args, **kwargs):
+    if generation == crash_at:
+      raise Crash()
+    return save_state(self, generation, *args, **kwargs)
+  monkeypatch.setattr(run_log.RunLog, 'save_state', crashing_save_state)
+  population = ga.initial_population(['CC', 'CCCC', 'CCCCCC'])
+  with pytest.raises(Crash):
+    ga.run(population, num_generations)
+  monkeypatch.setattr(run_log.RunLog, 'save_state', save_state)
+  assert len(run_log.RunLog(directory)) > 0
+
+  resumed = make_optimizer(run_log.RunLog(directory, batch_size=1))
+  population, done = resumed.resume()
+  assert done == crash_at - 1
+  population = resumed.run(population, num_generations - done)
+  resumed.run_log.flush()
+
+  assert population.smiles.tolist() == final.smiles.tolist()
+  assert resumed.history[-1]['best_smiles'] == reference.history[-1]['best_smiles']
+  logged = resumed.run_log.smiles()
+  assert logged == reference.run_log.smiles()
+  assert len(logged) == len(set(logged))
+  ids = np.concatenate([part['id'] for part in resumed.run_log.scan(columns=('id',))])
+  assert ids.tolist() == list(range(len(ids)))
+
+def test_truncate_cuts_inside_a_part(tmp_path):
+  log = run_log.RunLog(str(tmp_path), batch_size=4)
+  smiles = ['C'*(i + 1) for i in range(10)]
+  log.append(np.zeros((10, LATENT_DIM)), smiles, np.arange(10.0), 1)
+  log.append(np.zeros((3, LATENT_DIM)), smiles[:3], np.arange(3.0), 2)
+  log.truncate(6)
+  assert len(log) == 6
+  assert log.smiles() == smiles[:6]
+  assert len(run_log.RunLog(str(tmp_path))) == 6